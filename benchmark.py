@@ -0,0 +1,782 @@
+from libraries import *
+from detection_libraries import CompiledModel, Detector, list_images
+import shutil
+import subprocess
+import tempfile
+
+
+# run in a new python process by benchmark_startup: argv = backend, model name, warm-up (True/False), image path
+STARTUP_CODE = """
+import sys
+import time
+st = time.time()
+import json
+import pickle
+import cv2
+from detection_libraries import Detector, bundle_path, load_bundle_config
+times = {'import': time.time() - st}
+backend, model_name, warm_up, filepath = sys.argv[1], sys.argv[2], sys.argv[3] == 'True', sys.argv[4]
+
+st = time.time()
+model_path = './model/{}.hdf5'.format(model_name)
+if backend == 'bundle':
+    C = load_bundle_config(bundle_path(model_path))
+else:
+    with open('./config/{}.pickle'.format(model_name), 'rb') as f_in:
+        C = pickle.load(f_in)
+C.model_path = model_path
+times['config'] = time.time() - st
+
+st = time.time()
+detector = Detector(C, backend=backend)
+times['models'] = time.time() - st
+
+st = time.time()
+if warm_up:
+    detector.warm_up()
+times['warm_up'] = time.time() - st
+
+img = cv2.imread(filepath)
+st = time.time()
+detector.predict(img)
+times['first_image'] = time.time() - st
+st = time.time()
+detector.predict(img)
+times['second_image'] = time.time() - st
+print(json.dumps(times))
+"""
+
+
+def legacy_non_max_suppression(boxes, probs, overlap_thresh=0.9, max_boxes=300):
+    # Previous implementation of non_max_suppression_fast, used as a reference
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    np.testing.assert_array_less(x1, x2)
+    np.testing.assert_array_less(y1, y2)
+
+    if boxes.dtype.kind == "i":
+        boxes = boxes.astype("float")
+
+    pick = []
+    area = (x2 - x1) * (y2 - y1)
+    idxs = np.argsort(probs)
+
+    while len(idxs) > 0:
+        last = len(idxs) - 1
+        i = idxs[last]
+        pick.append(i)
+
+        xx1_int = np.maximum(x1[i], x1[idxs[:last]])
+        yy1_int = np.maximum(y1[i], y1[idxs[:last]])
+        xx2_int = np.minimum(x2[i], x2[idxs[:last]])
+        yy2_int = np.minimum(y2[i], y2[idxs[:last]])
+
+        ww_int = np.maximum(0, xx2_int - xx1_int)
+        hh_int = np.maximum(0, yy2_int - yy1_int)
+
+        area_int = ww_int * hh_int
+        area_union = area[i] + area[idxs[:last]] - area_int
+        overlap = area_int / (area_union + 1e-6)
+
+        idxs = np.delete(idxs, np.concatenate(([last], np.where(overlap > overlap_thresh)[0])))
+
+        if len(pick) >= max_boxes:
+            break
+
+    return boxes[pick].astype("int"), probs[pick]
+
+
+def legacy_calc_rpn(C, img_data, width, height, resized_width, resized_height, img_length_calc_function):
+    # Previous implementation of calc_rpn (one iou() call per anchor and GT bbox), used as a reference
+    downscale = float(C.rpn_stride)
+    anchor_sizes = C.anchor_box_scales  # 128, 256, 512
+    anchor_ratios = C.anchor_box_ratios  # 1:1, 1:2*sqrt(2), 2*sqrt(2):1
+    num_anchors = len(anchor_sizes) * len(anchor_ratios)  # 3x3=9
+
+    # calculate the output map size based on the network architecture
+    (output_width, output_height) = img_length_calc_function(resized_width, resized_height)
+
+    n_anchratios = len(anchor_ratios)  # 3
+
+    # initialise empty output objectives
+    y_rpn_overlap = np.zeros((output_height, output_width, num_anchors))
+    y_is_box_valid = np.zeros((output_height, output_width, num_anchors))
+    y_rpn_regr = np.zeros((output_height, output_width, num_anchors * 4))
+
+    num_bboxes = len(img_data['bboxes'])
+
+    num_anchors_for_bbox = np.zeros(num_bboxes).astype(int)
+    best_anchor_for_bbox = -1 * np.ones((num_bboxes, 4)).astype(int)
+    best_iou_for_bbox = np.zeros(num_bboxes).astype(np.float32)
+    best_x_for_bbox = np.zeros((num_bboxes, 4)).astype(int)
+    best_dx_for_bbox = np.zeros((num_bboxes, 4)).astype(np.float32)
+
+    # get the GT box coordinates, and resize to account for image resizing
+    gta = np.zeros((num_bboxes, 4))
+    for bbox_num, bbox in enumerate(img_data['bboxes']):
+        # get the GT box coordinates, and resize to account for image resizing
+        gta[bbox_num, 0] = bbox['x1'] * (resized_width / float(width))
+        gta[bbox_num, 1] = bbox['x2'] * (resized_width / float(width))
+        gta[bbox_num, 2] = bbox['y1'] * (resized_height / float(height))
+        gta[bbox_num, 3] = bbox['y2'] * (resized_height / float(height))
+
+    # rpn ground truth
+
+    for anchor_size_idx in range(len(anchor_sizes)):
+        for anchor_ratio_idx in range(n_anchratios):
+            anchor_x = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][0]
+            anchor_y = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][1]
+
+            for ix in range(output_width):
+                # x-coordinates of the current anchor box
+                x1_anc = downscale * (ix + 0.5) - anchor_x / 2
+                x2_anc = downscale * (ix + 0.5) + anchor_x / 2
+
+                # ignore boxes that go across image boundaries
+                if x1_anc < 0 or x2_anc > resized_width:
+                    continue
+
+                for jy in range(output_height):
+
+                    # y-coordinates of the current anchor box
+                    y1_anc = downscale * (jy + 0.5) - anchor_y / 2
+                    y2_anc = downscale * (jy + 0.5) + anchor_y / 2
+
+                    # ignore boxes that go across image boundaries
+                    if y1_anc < 0 or y2_anc > resized_height:
+                        continue
+
+                    # bbox_type indicates whether an anchor should be a target
+                    # Initialize with 'negative'
+                    bbox_type = 'neg'
+
+                    # this is the best IOU for the (x,y) coord and the current anchor
+                    # note that this is different from the best IOU for a GT bbox
+                    best_iou_for_loc = 0.0
+
+                    for bbox_num in range(num_bboxes):
+
+                        # get IOU of the current GT box and the current anchor box
+                        curr_iou = iou([gta[bbox_num, 0], gta[bbox_num, 2], gta[bbox_num, 1], gta[bbox_num, 3]],
+                                       [x1_anc, y1_anc, x2_anc, y2_anc])
+                        # calculate the regression targets if they will be needed
+                        if curr_iou > best_iou_for_bbox[bbox_num] or curr_iou > C.rpn_max_overlap:
+                            cx = (gta[bbox_num, 0] + gta[bbox_num, 1]) / 2.0
+                            cy = (gta[bbox_num, 2] + gta[bbox_num, 3]) / 2.0
+                            cxa = (x1_anc + x2_anc) / 2.0
+                            cya = (y1_anc + y2_anc) / 2.0
+
+                            # x,y are the center point of ground-truth bbox
+                            # xa,ya are the center point of anchor bbox (xa=downscale * (ix + 0.5); ya=downscale * (iy+0.5))
+                            # w,h are the width and height of ground-truth bbox
+                            # wa,ha are the width and height of anchor bboxe
+                            # tx = (x - xa) / wa
+                            # ty = (y - ya) / ha
+                            # tw = log(w / wa)
+                            # th = log(h / ha)
+                            tx = (cx - cxa) / (x2_anc - x1_anc)
+                            ty = (cy - cya) / (y2_anc - y1_anc)
+                            tw = np.log((gta[bbox_num, 1] - gta[bbox_num, 0]) / (x2_anc - x1_anc))
+                            th = np.log((gta[bbox_num, 3] - gta[bbox_num, 2]) / (y2_anc - y1_anc))
+
+                        if img_data['bboxes'][bbox_num]['class'] != 'bg':
+
+                            # all GT boxes should be mapped to an anchor box, so we keep track of which anchor box was best
+                            if curr_iou > best_iou_for_bbox[bbox_num]:
+                                best_anchor_for_bbox[bbox_num] = [jy, ix, anchor_ratio_idx, anchor_size_idx]
+                                best_iou_for_bbox[bbox_num] = curr_iou
+                                best_x_for_bbox[bbox_num, :] = [x1_anc, x2_anc, y1_anc, y2_anc]
+                                best_dx_for_bbox[bbox_num, :] = [tx, ty, tw, th]
+
+                            # we set the anchor to positive if the IOU is >0.7 (it does not matter if there was another better box, it just indicates overlap)
+                            if curr_iou > C.rpn_max_overlap:
+                                bbox_type = 'pos'
+                                num_anchors_for_bbox[bbox_num] += 1
+                                # we update the regression layer target if this IOU is the best for the current (x,y) and anchor position
+                                if curr_iou > best_iou_for_loc:
+                                    best_iou_for_loc = curr_iou
+                                    best_regr = (tx, ty, tw, th)
+
+                            # if the IOU is >0.3 and <0.7, it is ambiguous and no included in the objective
+                            if C.rpn_min_overlap < curr_iou < C.rpn_max_overlap:
+                                # gray zone between neg and pos
+                                if bbox_type != 'pos':
+                                    bbox_type = 'neutral'
+
+                    # turn on or off outputs depending on IOUs
+                    if bbox_type == 'neg':
+                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
+                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
+                    elif bbox_type == 'neutral':
+                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
+                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
+                    elif bbox_type == 'pos':
+                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
+                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
+                        start = 4 * (anchor_ratio_idx + n_anchratios * anchor_size_idx)
+                        y_rpn_regr[jy, ix, start:start + 4] = best_regr
+
+    # we ensure that every bbox has at least one positive RPN region
+
+    for idx in range(num_anchors_for_bbox.shape[0]):
+        if num_anchors_for_bbox[idx] == 0:
+            # no box with an IOU greater than zero ...
+            if best_anchor_for_bbox[idx, 0] == -1:
+                continue
+            y_is_box_valid[
+                best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], best_anchor_for_bbox[
+                    idx, 2] + n_anchratios *
+                best_anchor_for_bbox[idx, 3]] = 1
+            y_rpn_overlap[
+                best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], best_anchor_for_bbox[
+                    idx, 2] + n_anchratios *
+                best_anchor_for_bbox[idx, 3]] = 1
+            start = 4 * (best_anchor_for_bbox[idx, 2] + n_anchratios * best_anchor_for_bbox[idx, 3])
+            y_rpn_regr[
+            best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], start:start + 4] = best_dx_for_bbox[idx, :]
+
+    y_rpn_overlap = np.transpose(y_rpn_overlap, (2, 0, 1))
+    y_rpn_overlap = np.expand_dims(y_rpn_overlap, axis=0)
+
+    y_is_box_valid = np.transpose(y_is_box_valid, (2, 0, 1))
+    y_is_box_valid = np.expand_dims(y_is_box_valid, axis=0)
+
+    y_rpn_regr = np.transpose(y_rpn_regr, (2, 0, 1))
+    y_rpn_regr = np.expand_dims(y_rpn_regr, axis=0)
+
+    pos_locs = np.where(np.logical_and(y_rpn_overlap[0, :, :, :] == 1, y_is_box_valid[0, :, :, :] == 1))
+    neg_locs = np.where(np.logical_and(y_rpn_overlap[0, :, :, :] == 0, y_is_box_valid[0, :, :, :] == 1))
+
+    num_pos = len(pos_locs[0])
+
+    # one issue is that the RPN has many more negative than positive regions, so we turn off some of the negative
+    # regions. We also limit it to 256 regions.
+    num_regions = 256
+
+    if len(pos_locs[0]) > num_regions / 2:
+        val_locs = random.sample(range(len(pos_locs[0])), len(pos_locs[0]) - num_regions / 2)
+        y_is_box_valid[0, pos_locs[0][val_locs], pos_locs[1][val_locs], pos_locs[2][val_locs]] = 0
+        num_pos = num_regions / 2
+
+    if len(neg_locs[0]) + num_pos > num_regions:
+        val_locs = random.sample(range(len(neg_locs[0])), len(neg_locs[0]) - num_pos)
+        y_is_box_valid[0, neg_locs[0][val_locs], neg_locs[1][val_locs], neg_locs[2][val_locs]] = 0
+
+    y_rpn_cls = np.concatenate([y_is_box_valid, y_rpn_overlap], axis=1)
+    y_rpn_regr = np.concatenate([np.repeat(y_rpn_overlap, 4, axis=1), y_rpn_regr], axis=1)
+
+    return np.copy(y_rpn_cls), np.copy(y_rpn_regr), num_pos
+
+
+def time_function(function, repeat):
+    """Mean duration of a call to function in milliseconds"""
+    function()
+    st = time.time()
+    for _ in range(repeat):
+        function()
+    return 1000 * (time.time() - st) / repeat
+
+
+def random_boxes(num_boxes, width, height, min_size, max_size, integer=False):
+    x1 = np.random.uniform(0, width - min_size, num_boxes)
+    y1 = np.random.uniform(0, height - min_size, num_boxes)
+    x2 = np.minimum(x1 + np.random.uniform(min_size, max_size, num_boxes), width)
+    y2 = np.minimum(y1 + np.random.uniform(min_size, max_size, num_boxes), height)
+    boxes = np.stack([x1, y1, x2, y2], axis=1)
+    if integer:
+        boxes = np.round(boxes).astype(int)
+        boxes = boxes[(boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])]
+    return boxes
+
+
+def benchmark_nms(repeat, num_boxes=4000, num_rois=300, num_classes=10):
+    print('=== Non-max-suppression')
+
+    # rpn proposals: ~4000 anchors decoded on a 25x18 feature map
+    boxes = random_boxes(num_boxes, 25, 18, 1, 12)
+    probs = np.random.rand(len(boxes))
+
+    legacy = legacy_non_max_suppression(boxes, probs, overlap_thresh=0.7, max_boxes=300)
+    new = non_max_suppression(boxes, probs, overlap_thresh=0.7, max_boxes=300)
+    print('rpn proposals ({} boxes) - same result: {}'.format(
+        len(boxes), np.array_equal(legacy[0], new[0]) and np.array_equal(legacy[1], new[1])))
+    print('    legacy:       {:.2f} ms'.format(time_function(
+        lambda: legacy_non_max_suppression(boxes, probs, overlap_thresh=0.7, max_boxes=300), repeat)))
+    print('    new:          {:.2f} ms'.format(time_function(
+        lambda: non_max_suppression(boxes, probs, overlap_thresh=0.7, max_boxes=300), repeat)))
+    print('    new top_k=2000: {:.2f} ms'.format(time_function(
+        lambda: non_max_suppression(boxes, probs, overlap_thresh=0.7, max_boxes=300, top_k=2000), repeat)))
+
+    # classifier detections: 300 rois spread over the classes, on the resized image
+    boxes = random_boxes(num_rois, 400, 300, 16, 160, integer=True)
+    probs = np.random.rand(len(boxes))
+    class_ids = np.random.randint(0, num_classes, len(boxes))
+
+    def legacy_per_class():
+        return [legacy_non_max_suppression(boxes[class_ids == c], probs[class_ids == c], overlap_thresh=0.2)
+                for c in np.unique(class_ids)]
+
+    def new_per_class():
+        return [non_max_suppression(boxes[class_ids == c], probs[class_ids == c], overlap_thresh=0.2)
+                for c in np.unique(class_ids)]
+
+    def new_batched():
+        return non_max_suppression(boxes, probs, class_ids, overlap_thresh=0.2, class_ids=class_ids)
+
+    legacy = legacy_per_class()
+    batched_boxes, batched_probs, batched_class_ids = new_batched()
+    same = all(np.array_equal(legacy_boxes, batched_boxes[batched_class_ids == c])
+               for c, (legacy_boxes, _) in zip(np.unique(class_ids), legacy))
+    print('classifier detections ({} boxes, {} classes) - same result: {}'.format(len(boxes), num_classes, same))
+    print('    legacy per class: {:.2f} ms'.format(time_function(legacy_per_class, repeat)))
+    print('    new per class:    {:.2f} ms'.format(time_function(new_per_class, repeat)))
+    print('    new batched:      {:.2f} ms'.format(time_function(new_batched, repeat)))
+
+
+def jpeg_with_exif(img, tiff):
+    """JPEG data of img with an APP1 Exif segment holding the TIFF data tiff"""
+    jpeg = cv2.imencode('.jpg', img)[1].tobytes()
+    segment = b'Exif\x00\x00' + tiff
+    return jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(segment) + 2) + segment + jpeg[2:]
+
+
+def orientation_tiff(orientation, ifd_offset=8):
+    """TIFF data of an IFD holding the EXIF orientation tag, at ifd_offset (past the end of the data if > 8)"""
+    return (b'II*\x00' + struct.pack('<I', ifd_offset) + struct.pack('<H', 1) +
+            struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0) + struct.pack('<I', 0))
+
+
+def benchmark_img_sizes(repeat):
+    print('=== Image sizes: read_img_size (header) compared to cv2.imread')
+
+    img = np.random.randint(0, 256, (20, 30, 3)).astype(np.uint8)
+    files = {'plain.jpg': cv2.imencode('.jpg', img)[1].tobytes(), 'plain.png': cv2.imencode('.png', img)[1].tobytes()}
+    for orientation in range(1, 9):
+        files['orientation{}.jpg'.format(orientation)] = jpeg_with_exif(img, orientation_tiff(orientation))
+    # malformed Exif: IFD past the end of the segment, truncated IFD, unknown byte order
+    files['ifd_offset.jpg'] = jpeg_with_exif(img, orientation_tiff(6, ifd_offset=5000))
+    files['short_ifd.jpg'] = jpeg_with_exif(img, orientation_tiff(6)[:12])
+    files['byte_order.jpg'] = jpeg_with_exif(img, b'XX' + orientation_tiff(6)[2:])
+
+    tmp_dir = tempfile.mkdtemp()
+    filepaths = []
+    for name, data in files.items():
+        filepaths.append(os.path.join(tmp_dir, name))
+        with open(filepaths[-1], 'wb') as f:
+            f.write(data)
+
+    for filepath in filepaths:
+        (rows, cols) = cv2.imread(filepath).shape[:2]
+        assert read_img_size(filepath) == (cols, rows), filepath
+    print('{} images (EXIF orientations, malformed Exif) - same size as cv2.imread: {}/{}'.format(
+        len(filepaths), len(filepaths), len(filepaths)))
+
+    # header cut in the start of frame: no size, cv2.imread is left to decide
+    jpeg = files['plain.jpg']
+    sof = max(jpeg.find(marker) for marker in (b'\xff\xc0', b'\xff\xc2'))
+    truncated_path = os.path.join(tmp_dir, 'truncated.jpg')
+    with open(truncated_path, 'wb') as f:
+        f.write(jpeg[:sof + 6])
+    assert read_img_header_size(truncated_path) is None
+    print('start of frame cut short - no header size')
+
+    print('    header:     {:.3f} ms'.format(time_function(lambda: read_img_header_size(filepaths[0]), repeat)))
+    print('    cv2.imread: {:.3f} ms'.format(time_function(lambda: cv2.imread(filepaths[0]), repeat)))
+    shutil.rmtree(tmp_dir)
+
+
+def transposed_img_data(img_data):
+    """Image data of the transposed image (width and height swapped), as the 90 degrees rotations of augment()"""
+    return {'filepath': img_data['filepath'], 'width': img_data['height'], 'height': img_data['width'],
+            'bboxes': [{'class': bbox['class'], 'x1': bbox['y1'], 'x2': bbox['y2'], 'y1': bbox['x1'], 'y2': bbox['x2']}
+                       for bbox in img_data['bboxes']]}
+
+
+def random_img_data(rng, num_bboxes, classes=('a', 'b')):
+    """Image data of a random size (the sizes of the dataset and beyond) with num_bboxes random bboxes"""
+    (width, height) = (int(rng.randint(200, 1200)), int(rng.randint(200, 1200)))
+    bboxes = []
+    for _ in range(num_bboxes):
+        # from a few pixels to the whole image
+        (bbox_width, bbox_height) = (int(rng.randint(4, width + 1)), int(rng.randint(4, height + 1)))
+        (x1, y1) = (int(rng.randint(0, width - bbox_width + 1)), int(rng.randint(0, height - bbox_height + 1)))
+        bboxes.append({'class': classes[rng.randint(len(classes))], 'x1': x1, 'x2': x1 + bbox_width,
+                       'y1': y1, 'y2': y1 + bbox_height})
+    return {'filepath': 'random.jpg', 'width': width, 'height': height, 'bboxes': bboxes}
+
+
+def benchmark_calc_rpn(num_images=20):
+    print('=== Rpn targets (calc_rpn) compared to the per-anchor loop (legacy_calc_rpn)')
+    C = Config()
+    C.im_size = 300
+    # compare the computation of the targets, not the cache
+    C.rpn_target_cache_size = 0
+
+    rng = np.random.RandomState(0)
+    cases = [('random bboxes', random_img_data(rng, int(rng.randint(1, 8)))) for _ in range(num_images)]
+    cases += [('transposed', transposed_img_data(img_data)) for (_, img_data) in list(cases)]
+    # no positive anchor: nothing to map, or only background bboxes (not mapped to an anchor)
+    cases += [('no bbox', random_img_data(rng, 0)), ('background only', random_img_data(rng, 3, classes=('bg',)))]
+    # more than 128 positive anchors: both implementations fail in the sampling of the positive anchors
+    # (random.sample of a float number of anchors) and get_anchor_gt skips the image
+    cases += [('many bboxes', random_img_data(rng, 100))]
+
+    legacy_time = 0
+    new_time = 0
+    for (name, img_data) in cases:
+        (width, height) = (img_data['width'], img_data['height'])
+        (resized_width, resized_height) = get_new_img_size(width, height, C.im_size)
+        calc_args = (C, img_data, width, height, resized_width, resized_height, get_img_output_length)
+
+        # same sampling of the 256 anchors in both implementations
+        random.seed(0)
+        st = time.time()
+        try:
+            legacy = legacy_calc_rpn(*calc_args)
+        except Exception as e:
+            legacy = e
+        legacy_time += time.time() - st
+
+        random.seed(0)
+        st = time.time()
+        try:
+            new = calc_rpn(*calc_args)
+        except Exception as e:
+            new = e
+        new_time += time.time() - st
+
+        if isinstance(legacy, Exception) or isinstance(new, Exception):
+            assert type(legacy) == type(new), '{}: {!r} and {!r}'.format(name, legacy, new)
+            continue
+
+        (y_rpn_cls, y_rpn_regr, legacy_num_pos) = legacy
+        (y_rpn, num_pos) = new
+        (new_y_rpn_cls, new_y_rpn_regr) = y_rpn.dense()
+        assert np.array_equal(np.transpose(y_rpn_cls, (0, 2, 3, 1)).astype(np.float32), new_y_rpn_cls), name
+        assert np.array_equal(np.transpose(y_rpn_regr, (0, 2, 3, 1)).astype(np.float32), new_y_rpn_regr), name
+        assert legacy_num_pos == num_pos, name
+        if name.startswith('no') or name.startswith('background'):
+            assert num_pos == 0, name
+
+    print('same y_rpn_cls, y_rpn_regr and num_pos (or error) on {} random images, their transposes, 2 images without '
+          'positive anchor and an image of 100 bboxes'.format(num_images))
+    print('    legacy: {:.1f} ms per image, new: {:.1f} ms per image'.format(
+        1000 * legacy_time / len(cases), 1000 * new_time / len(cases)))
+
+
+def benchmark_roi_pooling(repeat, num_rois=300, pool_size=7):
+    print('=== Roi pooling: BatchedRoiPooling compared to RoiPoolingConv')
+
+    # feature maps of 400x600 images, and rois of the sizes given by rpn_to_roi, some of them crossing the border
+    feature_map = np.random.rand(2, 25, 37, 512).astype(np.float32)
+    x = np.random.randint(0, 37, (2, num_rois))
+    y = np.random.randint(0, 25, (2, num_rois))
+    w = np.random.randint(1, 20, (2, num_rois))
+    h = np.random.randint(1, 16, (2, num_rois))
+    rois = np.stack([x, y, w, h], axis=2).astype(np.float32)
+    small = (w[0] < pool_size) | (h[0] < pool_size)
+
+    # one image and any number of rois (inference), and batches of num_rois rois per image (training)
+    feature_map_input = Input(shape=(None, None, 512))
+    roi_input = Input(shape=(None, 4))
+    models = [CompiledModel(Model([feature_map_input, roi_input], layer([feature_map_input, roi_input])))
+              for layer in [RoiPoolingConv(pool_size, None), BatchedRoiPooling(pool_size, None)]]
+    batch_models = [Model([feature_map_input, roi_input], layer([feature_map_input, roi_input]))
+                    for layer in [RoiPoolingConv(pool_size, 4), BatchedRoiPooling(pool_size, 4)]]
+
+    # pooled features of the rois: shape=(num_rois, pool_size, pool_size, 512)
+    (reference, batched) = [model.predict([feature_map[:1], rois[:1]])[0] for model in models]
+    assert np.array_equal(reference, batched), np.max(np.abs(reference - batched))
+    (reference, batched) = [model.predict_on_batch([feature_map, rois[:, :4]]) for model in batch_models]
+    assert np.array_equal(reference, batched), np.max(np.abs(reference - batched))
+    print('{} rois ({} smaller than {}x{} features), and a batch of 2 images - same pooled features'.format(
+        num_rois, np.sum(small), pool_size, pool_size))
+
+    for name, model, batch_model in zip(['RoiPoolingConv:   ', 'BatchedRoiPooling:'], models, batch_models):
+        print('    {} {:.2f} ms ({} rois), {:.2f} ms (batch of 2 images)'.format(
+            name, time_function(lambda: model.predict([feature_map[:1], rois[:1]]), repeat), num_rois,
+            time_function(lambda: batch_model.predict_on_batch([feature_map, rois[:, :4]]), repeat)))
+
+
+def random_samples(C, num_images, width=640, height=480):
+    """Samples of get_anchor_gt of random images, each with a bbox of class 'a' and a bbox of class 'b'"""
+    samples = []
+    for i in range(num_images):
+        img = np.random.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        img_data = {'filepath': 'random_{}.jpg'.format(i), 'width': width, 'height': height,
+                    'bboxes': [{'class': 'a', 'x1': width // 8, 'x2': width // 2, 'y1': height // 8, 'y2': height // 2},
+                               {'class': 'b', 'x1': width // 2, 'x2': 7 * width // 8, 'y1': height // 3,
+                                'y2': 7 * height // 8}]}
+        (x_img, y_rpn, _, num_pos) = anchor_gt_sample(img_data, img, C, get_img_output_length)
+        samples.append((x_img, y_rpn, img_data, None, num_pos))
+    return samples
+
+
+def benchmark_fused_step(repeat, batch_size=2):
+    print('=== Fused training step (FusedTrainStep) compared to the separate RPN and classifier steps')
+    import frcnn_train
+
+    # models of random weights, built by initialize_model from the config and the classes of frcnn_train
+    C = Config()
+    C.class_mapping = {'a': 0, 'b': 1, 'bg': 2}
+    C.base_net_weights = './model/random.hdf5'
+    C.fused_training = True
+    frcnn_train.C = C
+    frcnn_train.class_mapping = C.class_mapping
+    frcnn_train.classes_count = {'a': batch_size, 'b': batch_size, 'bg': 0}
+    (model_all, model_rpn, model_classifier, fused_step) = frcnn_train.initialize_model()
+
+    (X, Y, img_datas) = stack_anchor_gt_batch(random_samples(C, batch_size))
+
+    # gradient of the sum of the losses of the fused step
+    random.seed(0)
+    np.random.seed(0)
+    with tf.GradientTape() as tape:
+        (rpn_losses, class_losses, _) = fused_step.losses(X, Y, img_datas, [], [], training=False)
+        loss = tf.add_n(rpn_losses + (class_losses or []))
+    fused_gradients = tape.gradient(loss, fused_step.trainable_weights)
+
+    # gradients of the separate models, with the losses of the fused step (graphs) and the same rois
+    random.seed(0)
+    np.random.seed(0)
+    with tf.GradientTape() as tape:
+        (rpn_cls, rpn_regr) = model_rpn(X, training=False)
+        loss = tf.add_n([loss_function(y_true, y_pred) for loss_function, y_true, y_pred in
+                         zip(fused_step.rpn_losses, Y, [rpn_cls, rpn_regr])])
+    gradients = tape.gradient(loss, fused_step.trainable_weights)
+    (X2, Y1, Y2, img_idx) = frcnn_train.sample_batch_rois([rpn_cls.numpy(), rpn_regr.numpy()], img_datas, [], [])
+    if X2 is not None:
+        (X2, Y1, Y2) = (X2.astype(K.floatx()), Y1.astype(K.floatx()), Y2.astype(K.floatx()))
+        with tf.GradientTape() as tape:
+            (out_class, out_regr) = model_classifier([X[img_idx], X2], training=False)
+            loss = tf.add_n([loss_function(y_true, y_pred) for loss_function, y_true, y_pred in
+                             zip(fused_step.class_losses, [Y1, Y2], [out_class, out_regr])])
+        gradients = [rpn_gradient if class_gradient is None else
+                     class_gradient if rpn_gradient is None else rpn_gradient + class_gradient
+                     for rpn_gradient, class_gradient in
+                     zip(gradients, tape.gradient(loss, fused_step.trainable_weights))]
+
+    difference = max(float(tf.reduce_max(tf.abs(fused_gradient - gradient))) /
+                     max(float(tf.reduce_max(tf.abs(gradient))), 1e-12)
+                     for fused_gradient, gradient in zip(fused_gradients, gradients))
+    print('{} weights, rois of the classifier for {}/{} images - max relative difference of the gradients: '
+          '{:.2e}'.format(len(fused_step.trainable_weights), 0 if X2 is None else len(img_idx), batch_size, difference))
+    # same losses and rois: the gradients only differ by the order of the float32 sums
+    assert X2 is not None, 'no rois for the classifier, the classifier gradients are not compared'
+    assert difference < 1e-4, 'max relative difference of the gradients: {:.2e}'.format(difference)
+
+    def separate_step():
+        model_rpn.train_on_batch(X, Y)
+        (X2, Y1, Y2, img_idx) = frcnn_train.rpn_to_class(X, img_datas, [], [], model_rpn)
+        if X2 is not None:
+            model_classifier.train_on_batch([X[img_idx], X2], [Y1, Y2])
+
+    print('    separate steps: {:.2f} ms'.format(time_function(separate_step, repeat)))
+    print('    fused step:     {:.2f} ms'.format(
+        time_function(lambda: fused_step.train_on_batch(X, Y, img_datas, [], []), repeat)))
+
+
+def benchmark_sample_rois(repeat, num_batches=20, batch_size=2):
+    print('=== Rois of the classifier: sample_batch_rois_tf compared to sample_batch_rois on the same rpn outputs')
+    import frcnn_train
+
+    # sample_batch_rois reads the config and the classes of frcnn_train
+    C = Config()
+    C.class_mapping = {'a': 0, 'b': 1, 'bg': 2}
+    frcnn_train.C = C
+    frcnn_train.class_mapping = C.class_mapping
+    nb_classes = len(C.class_mapping)
+    sample_batch_rois_graph = tf.function(lambda *inputs: sample_batch_rois_tf(*inputs, C, nb_classes))
+
+    batches = []
+    for _ in range(num_batches):
+        # images whose smallest side is C.im_size, with 1 to 3 bboxes, and random rpn outputs on their feature maps
+        img_datas = []
+        for _ in range(batch_size):
+            (width, height) = (C.im_size, np.random.randint(C.im_size, 2 * C.im_size))[::np.random.choice([1, -1])]
+            bboxes = []
+            for _ in range(np.random.randint(1, 4)):
+                (x1, y1) = (np.random.randint(0, width // 2), np.random.randint(0, height // 2))
+                bboxes.append({'class': np.random.choice(['a', 'b']), 'x1': x1, 'y1': y1,
+                               'x2': min(width, x1 + np.random.randint(40, 200)),
+                               'y2': min(height, y1 + np.random.randint(40, 200))})
+            img_datas.append({'filepath': 'random.jpg', 'width': width, 'height': height, 'bboxes': bboxes})
+        (rows, cols) = (2 * C.im_size // 16, 2 * C.im_size // 16)
+        rpn_cls = (1 / (1 + np.exp(-3 * np.random.randn(batch_size, rows, cols, 9)))).astype(np.float32)
+        rpn_regr = (0.6 * np.random.randn(batch_size, rows, cols, 36)).astype(np.float32)
+        batches.append((rpn_cls, rpn_regr, img_datas))
+
+    num_same_pos = 0
+    num_same_images = 0
+    num_same_rois = 0
+    num_rois = 0
+    for (rpn_cls, rpn_regr, img_datas) in batches:
+        num_pos = []
+        (X2, Y1, Y2, img_idx) = frcnn_train.sample_batch_rois([rpn_cls, rpn_regr], img_datas, [], num_pos)
+        (X2_tf, Y1_tf, Y2_tf, img_idx_tf, num_pos_tf) = [
+            Y.numpy() for Y in sample_batch_rois_graph(rpn_cls, rpn_regr, *feature_map_gt_batch(img_datas, C,
+                                                                                                 C.class_mapping))]
+        num_same_pos += num_pos == num_pos_tf.tolist()
+        num_same_images += (img_idx if X2 is not None else []) == img_idx_tf.tolist()
+
+        # the rois are drawn at random in both: the rois of sample_batch_rois_tf must be among the rois (and
+        # targets) that sample_batch_rois draws from
+        for i, rois, y_class, y_regr in zip(img_idx_tf, X2_tf, Y1_tf, Y2_tf):
+            (resized_width, resized_height) = get_new_img_size(img_datas[i]['width'], img_datas[i]['height'],
+                                                               C.im_size)
+            (cols, rows) = get_img_output_length(resized_width, resized_height)
+            R = rpn_to_roi(rpn_cls[i:i + 1, :rows, :cols], rpn_regr[i:i + 1, :rows, :cols], C, K.image_data_format(),
+                           use_regr=True, overlap_thresh=0.7, max_boxes=300, mode='train')
+            (X, Y1_all, Y2_all, _) = calc_iou(R, img_datas[i], C, C.class_mapping)
+            candidates = np.concatenate([X[0], Y1_all[0], Y2_all[0]], axis=1).astype(K.floatx())
+            for sample in np.concatenate([rois, y_class, y_regr], axis=1):
+                num_same_rois += np.any(np.all(candidates == sample, axis=1))
+                num_rois += 1
+
+    print('{} batches of {} images - same number of positive rois per image: {}/{}, same images with rois: {}/{}, '
+          'rois among the candidates of sample_batch_rois: {}/{}'.format(
+              num_batches, batch_size, num_same_pos, num_batches, num_same_images, num_batches, num_same_rois,
+              num_rois))
+    assert num_same_pos == num_batches and num_same_images == num_batches, 'different positive rois or images'
+    assert num_rois > 0 and num_same_rois == num_rois, 'rois of sample_batch_rois_tf not drawn by sample_batch_rois'
+
+    (rpn_cls, rpn_regr, img_datas) = batches[0]
+    gt_batch = feature_map_gt_batch(img_datas, C, C.class_mapping)
+    print('    sample_batch_rois:    {:.2f} ms'.format(
+        time_function(lambda: frcnn_train.sample_batch_rois([rpn_cls, rpn_regr], img_datas, [], []), repeat)))
+    print('    sample_batch_rois_tf: {:.2f} ms'.format(
+        time_function(lambda: sample_batch_rois_graph(rpn_cls, rpn_regr, *gt_batch), repeat)))
+
+
+def benchmark_calls(repeat, num_sizes=10):
+    print('=== Per-call overhead of the inference')
+
+    # the per-roi pooling network on a tiny feature map: the time is spent in the call, not in the layers
+    feature_map_input = Input(shape=(None, None, 512))
+    roi_input = Input(shape=(None, 4))
+    classifier = classifier_layer(feature_map_input, roi_input, None, nb_classes=3)
+    model = Model([feature_map_input, roi_input], classifier)
+    compiled_model = CompiledModel(model)
+
+    # feature maps of various sizes, as given by images of various aspect ratios
+    inputs = [[np.random.rand(1, 2 + i % 3, 2 + i % 4, 512), np.array([[[0, 0, 1, 1]]], dtype=np.float32)]
+              for i in range(num_sizes)]
+    calls = itertools.cycle(inputs)
+
+    same = all(np.allclose(a, b, atol=1e-5) for x in inputs
+               for a, b in zip(model.predict(x), compiled_model.predict(x)))
+    print('classifier on one roi ({} feature map sizes) - same result: {}'.format(num_sizes, same))
+    print('    predict:          {:.2f} ms'.format(time_function(lambda: model.predict(next(calls)), repeat)))
+    print('    predict_on_batch: {:.2f} ms'.format(time_function(lambda: model.predict_on_batch(next(calls)),
+                                                                repeat)))
+    print('    CompiledModel:    {:.2f} ms'.format(time_function(lambda: compiled_model.predict(next(calls)),
+                                                                repeat)))
+
+
+def benchmark_backends(C, filepaths, backends, num_threads=None):
+    print('=== Detection latency per image')
+
+    imgs = [cv2.imread(filepath) for filepath in filepaths]
+    mean_times = {}
+    for backend in backends:
+        detector = Detector(C, backend=backend, num_threads=num_threads)
+        # the first call builds the graphs / allocates the tensors
+        detector.predict(imgs[0])
+
+        times = []
+        for img in imgs:
+            st = time.time()
+            detector.predict(img)
+            times.append(1000 * (time.time() - st))
+        mean_times[backend] = np.mean(times)
+        del detector
+        K.clear_session()
+
+        print('{} ({} images): mean {:.0f} ms, median {:.0f} ms, max {:.0f} ms - x{:.2f} compared to {}'.format(
+            backend, len(times), mean_times[backend], np.median(times), np.max(times),
+            mean_times[backends[0]] / mean_times[backend], backends[0]))
+
+
+def benchmark_startup(model_name, filepath, backends, warm_up):
+    print('=== Startup time')
+
+    for backend in backends:
+        st = time.time()
+        output = subprocess.run([sys.executable, '-c', STARTUP_CODE, backend, model_name, str(warm_up), filepath],
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        total = time.time() - st
+        times = json.loads(output.strip().split('\n')[-1])
+        ready = total - times['first_image'] - times['second_image']
+        print('{} (warm-up: {}): ready to detect in {:.2f} s, first image in {:.2f} s, second image in {:.2f} s'.format(
+            backend, warm_up, ready, times['first_image'], times['second_image']))
+        python_time = ready - sum(times[key] for key in ['import', 'config', 'models', 'warm_up'])
+        print('    imports {:.2f} s, config {:.2f} s, models {:.2f} s, warm-up {:.2f} s, python start and exit '
+              '{:.2f} s'.format(times['import'], times['config'], times['models'], times['warm_up'], python_time))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Faster R-CNN pipeline.')
+    parser.add_argument('--benchmark', required=False, default='nms',
+                        metavar="nms/img_sizes/calc_rpn/roi_pooling/fused_step/sample_rois/calls/backends/startup",
+                        help='Name of the benchmark to run')
+    parser.add_argument('--repeat', required=False, default=20,
+                        metavar="Integer",
+                        help='Number of times each function is called')
+    parser.add_argument('--model_name', required=False,
+                        metavar="name_of_your_model", default='model',
+                        help='Name of the model used by the backends and startup benchmarks')
+    parser.add_argument('--backends', required=False, default="['keras', 'onnx']",
+                        metavar="['keras', 'tflite', 'onnx']",
+                        help='Backends of the Detector compared by the backends and startup benchmarks, the first '
+                             'one is the reference')
+    parser.add_argument('--images', required=False, default='./data',
+                        metavar="/path/to/images/",
+                        help='Directory of the images used by the backends and startup benchmarks')
+    parser.add_argument('--num_images', required=False, default="20",
+                        metavar="Integer/None",
+                        help='Number of images used by the backends benchmark (None for all the images), and of '
+                             'random images of the calc_rpn benchmark')
+    parser.add_argument('--num_threads', required=False, default="None",
+                        metavar="Integer/None",
+                        help="Number of threads of the TFLite and ONNX Runtime backends (None for their default)")
+    parser.add_argument('--warm_up', required=False, default="False",
+                        metavar="True/False",
+                        help='True to warm the Detector up before the first image in the startup benchmark')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    repeat = int(args.repeat)
+
+    if args.benchmark == 'nms':
+        benchmark_nms(repeat)
+    elif args.benchmark == 'img_sizes':
+        benchmark_img_sizes(repeat)
+    elif args.benchmark == 'calc_rpn':
+        benchmark_calc_rpn(eval(args.num_images) or 20)
+    elif args.benchmark == 'roi_pooling':
+        benchmark_roi_pooling(repeat)
+    elif args.benchmark == 'fused_step':
+        benchmark_fused_step(repeat)
+    elif args.benchmark == 'sample_rois':
+        benchmark_sample_rois(repeat)
+    elif args.benchmark == 'calls':
+        benchmark_calls(repeat)
+    elif args.benchmark == 'backends':
+        with open("./config/{}.pickle".format(args.model_name), 'rb') as f_in:
+            C = pickle.load(f_in)
+        C.model_path = "./model/{}.hdf5".format(args.model_name)
+        random.seed(0)
+        benchmark_backends(C, list_images(args.images, eval(args.num_images)), eval(args.backends),
+                           eval(args.num_threads))
+    elif args.benchmark == 'startup':
+        random.seed(0)
+        benchmark_startup(args.model_name, list_images(args.images, 1)[0], eval(args.backends), eval(args.warm_up))
+    else:
+        print('Unknown benchmark: {}'.format(args.benchmark))
@@ -0,0 +1,76 @@
+from libraries import *
+from detection_libraries import CompiledModel, bundle_path, init_models, list_images, parity_report
+
+
+def export_bundle(C, path):
+    """Export the inference bundle of the model C.model_path (see bundle_path)
+
+    The bundle is a SavedModel directory holding the graphs and the weights of the RPN and of the classifier (as
+    the tf.functions of CompiledModel), with a config.json file holding the config (class mapping, image resizing
+    and anchors). load_bundle_config and init_bundle_models load it without building the Keras models.
+
+    Args:
+        C: config
+        path: path of the bundle directory
+    """
+    model_rpn, _, model_classifier_only = init_models(C)
+
+    module = tf.Module()
+    module.rpn = CompiledModel(model_rpn).function
+    module.classifier = CompiledModel(model_classifier_only).function
+    module.rpn_weights = model_rpn.weights
+    module.classifier_weights = model_classifier_only.weights
+    tf.saved_model.save(module, path)
+
+    config = {}
+    for key, value in vars(C).items():
+        try:
+            json.dumps(value)
+        except TypeError:
+            print('{} is not saved in the bundle config'.format(key))
+            continue
+        config[key] = value
+    with open(os.path.join(path, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=4)
+
+    K.clear_session()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Export the inference bundle of a Faster R-CNN model.')
+    parser.add_argument('--model_name', required=False,
+                        metavar="name_of_your_model", default='model',
+                        help='Name of the model being exported')
+    parser.add_argument('--parity_images', required=False, default='./data',
+                        metavar="/path/to/images/",
+                        help='Directory of the images used for the parity report')
+    parser.add_argument('--parity_report', required=False, default="True",
+                        metavar="True/False",
+                        help="True to compare the detections of the bundle and of the Keras models after the export")
+    parser.add_argument('--num_parity', required=False, default=5,
+                        metavar="Integer",
+                        help='Number of images of the parity report')
+    parser.add_argument('--bbox_threshold', required=False, default=0.611,
+                        metavar="Value from 0 to 1",
+                        help="Model probability threshold of the detections compared in the parity report")
+    args = parser.parse_args()
+
+    config_output_filename = "./config/{}.pickle".format(args.model_name)
+
+    with open(config_output_filename, 'rb') as f_in:
+        C = pickle.load(f_in)
+
+    C.model_path = "./model/{}.hdf5".format(args.model_name)
+
+    path = bundle_path(C.model_path)
+    st = time.time()
+    export_bundle(C, path)
+    print('{} written in {:.1f} s'.format(path, time.time() - st))
+
+    if eval(args.parity_report):
+        random.seed(0)
+        parity_report(C, list_images(args.parity_images, int(args.num_parity)), float(args.bbox_threshold), 'bundle')
@@ -3,8 +3,8 @@ import matplotlib.pyplot as plt
 import sys
 import cv2
 import os
-import pandas as pd
-import ast
+
+from split_manifest import load_split_imgs, split_record_path
 
 
 def display_histogram(hist, title, type):
@@ -38,12 +38,10 @@ def get_box_image_ratio(input_path, set):
 
     i = 1
 
-    imgs_record_df = pd.read_csv(input_path)
-    last_row = imgs_record_df.tail(1)
     if (set == 'train'):
-        imgs_temp = ast.literal_eval(last_row['test'].tolist()[0])
+        imgs_temp = load_split_imgs(input_path, 'test')
     elif (set == 'test'):
-        imgs_temp = ast.literal_eval(last_row['train'].tolist()[0])
+        imgs_temp = load_split_imgs(input_path, 'train')
 
     for img_dict in imgs_temp:
         sys.stdout.write('\r' + 'idx=' + str(i))
@@ -85,8 +83,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Use Faster R-CNN to detect insects.')
     parser.add_argument('--split_img_file', required=False,
-                        metavar="path_to_split_image_file", default='./config/model10classes - imgs.csv',
-                        help='Path to the .csv file that contains the train/test/validation split of images')
+                        metavar="path_to_split_image_file", default=split_record_path('model10classes'),
+                        help='Path to the split manifest (.npz) or the .csv file that contains the '
+                             'train/test/validation split of images')
     parser.add_argument('--ratio_area', required=False, default='True',
                         metavar="True/False",
                         help="True if you want to plot the histogram of the ratio of the box area on the picture area")
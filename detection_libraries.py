@@ -10,7 +10,8 @@ def init_models(C):
     input_shape_features = (None, None, num_features)
 
     img_input = Input(shape=input_shape_img)
-    roi_input = Input(shape=(C.num_rois, 4))
+    # the number of rois is variable at inference, all the proposals of an image are classified at once
+    roi_input = Input(shape=(None, 4))
     feature_map_input = Input(shape=input_shape_features)
 
     # define the base network (VGG here, can be Resnet50, Inception, etc)
@@ -20,19 +21,85 @@ def init_models(C):
     num_anchors = len(C.anchor_box_scales) * len(C.anchor_box_ratios)
     rpn_layers = rpn_layer(shared_layers, num_anchors)
 
-    classifier = classifier_layer(feature_map_input, roi_input, C.num_rois, nb_classes=len(C.class_mapping))
+    classifier = classifier_layer(feature_map_input, roi_input, None, nb_classes=len(C.class_mapping),
+                                  batched_pooling=getattr(C, 'batched_roi_pooling', False))
 
     model_rpn = Model(img_input, rpn_layers)
     model_classifier_only = Model([feature_map_input, roi_input], classifier)
 
-    model_classifier = Model([feature_map_input, roi_input], classifier)
-
+    # the models are only used for inference: the weights are read once, for both, and they are not compiled
     print('Loading weights from {}'.format(C.model_path))
-    model_rpn.load_weights(C.model_path, by_name=True)
-    model_classifier.load_weights(C.model_path, by_name=True)
+    Model([img_input, feature_map_input, roi_input], rpn_layers + classifier).load_weights(C.model_path, by_name=True)
+
+    class_mapping = C.class_mapping
+    class_mapping = {v: k for k, v in class_mapping.items()}
+    print(class_mapping)
+
+    return model_rpn, class_mapping, model_classifier_only
+
+
+class CompiledModel:
+    """Keras model called through a tf.function, with the predict() interface of the Keras models used by Detector
+
+    Keras predict() sets up a data adapter and callbacks at each call, which costs more than the networks themselves
+    on a single image. The tf.function is traced once: its input signature keeps the batch size, the height and the
+    width of the feature maps and the number of rois dynamic.
+
+    Args:
+        model: Keras model
+    """
+
+    def __init__(self, model):
+        self.model = model
+        input_signature = [tf.TensorSpec(model_input.shape, tf.float32) for model_input in model.inputs]
+        self.function = tf.function(self.call, input_signature=input_signature)
+
+    def call(self, *inputs):
+        return self.model(list(inputs) if len(inputs) > 1 else inputs[0], training=False)
+
+    def predict(self, inputs):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        outputs = self.function(*[np.asarray(x, dtype=np.float32) for x in inputs])
+        return [output.numpy() for output in outputs]
 
-    model_rpn.compile(optimizer='sgd', loss='mse')
-    model_classifier.compile(optimizer='sgd', loss='mse')
+
+class BundleModel(CompiledModel):
+    """Network of an inference bundle: the tf.function of a CompiledModel, loaded from the SavedModel
+
+    Args:
+        module: loaded SavedModel (it owns the variables of the function)
+        name: name of the function in the module, 'rpn' or 'classifier'
+    """
+
+    def __init__(self, module, name):
+        self.model = module
+        self.function = getattr(module, name)
+
+
+def bundle_path(model_path):
+    """Path of the inference bundle saved by bundle_export.py from the Keras weights model_path"""
+    return os.path.splitext(model_path)[0] + '_bundle'
+
+
+def load_bundle_config(path):
+    """Config saved in an inference bundle (see bundle_export.py), without unpickling the config of the model"""
+    with open(os.path.join(path, 'config.json'), 'r') as f:
+        config = json.load(f)
+
+    C = Config()
+    for key, value in config.items():
+        setattr(C, key, value)
+    return C
+
+
+def init_bundle_models(C):
+    """Same as init_models, with the inference bundle of C.model_path saved by bundle_export.py"""
+    path = bundle_path(C.model_path)
+    print('Loading inference bundle {}'.format(path))
+    module = tf.saved_model.load(path)
+    model_rpn = BundleModel(module, 'rpn')
+    model_classifier_only = BundleModel(module, 'classifier')
 
     class_mapping = C.class_mapping
     class_mapping = {v: k for k, v in class_mapping.items()}
@@ -41,103 +108,417 @@ def init_models(C):
     return model_rpn, class_mapping, model_classifier_only
 
 
-def detect(img, model_rpn, model_classifier_only, C, class_mapping, bbox_threshold, class_to_color):
-    print("Starting detection")
-    st = time.time()
-    X, ratio = format_img(img, C)
+def tflite_model_paths(model_path):
+    """Paths of the TFLite models exported by tflite_export.py from the Keras weights model_path
 
-    X = np.transpose(X, (0, 2, 3, 1))
+    Returns:
+        paths of the RPN model, of the classifier model and of their metadata (names of the inputs and outputs)
+    """
+    base_path = os.path.splitext(model_path)[0]
+    return base_path + '_rpn.tflite', base_path + '_classifier.tflite', base_path + '_tflite.json'
 
-    # get output layer Y1, Y2 from the RPN and the feature maps F
-    # Y1: y_rpn_cls
-    # Y2: y_rpn_regr
-    [Y1, Y2, F] = model_rpn.predict(X)
 
-    # Get bboxes by applying NMS
-    # R.shape = (300, 4)
-    R = rpn_to_roi(Y1, Y2, C, K.image_data_format(), overlap_thresh=0.7)
+class TFLiteModel:
+    """TFLite model, with the predict() interface of the Keras models used by Detector
 
-    # convert from (x1,y1,x2,y2) to (x,y,w,h)
-    R[:, 2] -= R[:, 0]
-    R[:, 3] -= R[:, 1]
+    The interpreter comes from tflite_runtime when it is installed (e.g. on a Raspberry Pi), from tensorflow
+    otherwise. The input shapes are dynamic, the input tensors are resized when the shape of the inputs changes.
 
-    # apply the spatial pyramid pooling to the proposed regions
-    bboxes = {}
-    probs = {}
+    Args:
+        model_path: path of the .tflite file
+        input_names: names of the inputs of the Keras model, in order
+        output_names: names of the outputs of the Keras model, in order
+        num_threads: number of threads of the interpreter (None for the TFLite default)
+    """
 
-    for jk in range(R.shape[0] // C.num_rois + 1):
-        ROIs = np.expand_dims(R[C.num_rois * jk:C.num_rois * (jk + 1), :], axis=0)
-        if ROIs.shape[1] == 0:
-            break
+    def __init__(self, model_path, input_names, output_names, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = tf.lite.Interpreter
 
-        if jk == R.shape[0] // C.num_rois:
-            # pad R
-            curr_shape = ROIs.shape
-            target_shape = (curr_shape[0], C.num_rois, curr_shape[2])
-            ROIs_padded = np.zeros(target_shape).astype(ROIs.dtype)
-            ROIs_padded[:, :curr_shape[1], :] = ROIs
-            ROIs_padded[0, curr_shape[1]:, :] = ROIs[0, 0, :]
-            ROIs = ROIs_padded
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.runner = self.interpreter.get_signature_runner()
+        self.input_names = input_names
+        self.output_names = output_names
 
-        [P_cls, P_regr] = model_classifier_only.predict([F, ROIs])
+    def predict(self, inputs):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        outputs = self.runner(**{name: np.asarray(x, dtype=np.float32) for name, x in zip(self.input_names, inputs)})
+        return [outputs[name] for name in self.output_names]
 
-        # Calculate bboxes coordinates on resized image
-        for ii in range(P_cls.shape[1]):
-            # Ignore 'bg' class
-            if np.max(P_cls[0, ii, :]) < bbox_threshold or np.argmax(P_cls[0, ii, :]) == (P_cls.shape[2] - 1):
-                continue
-
-            cls_name = class_mapping[np.argmax(P_cls[0, ii, :])]
-
-            if cls_name not in bboxes:
-                bboxes[cls_name] = []
-                probs[cls_name] = []
-
-            (x, y, w, h) = ROIs[0, ii, :]
-
-            cls_num = np.argmax(P_cls[0, ii, :])
-            try:
-                (tx, ty, tw, th) = P_regr[0, ii, 4 * cls_num:4 * (cls_num + 1)]
-                tx /= C.classifier_regr_std[0]
-                ty /= C.classifier_regr_std[1]
-                tw /= C.classifier_regr_std[2]
-                th /= C.classifier_regr_std[3]
-                x, y, w, h = apply_regr(x, y, w, h, tx, ty, tw, th)
-            except:
-                pass
-            bboxes[cls_name].append(
-                [C.rpn_stride * x, C.rpn_stride * y, C.rpn_stride * (x + w), C.rpn_stride * (y + h)])
-            probs[cls_name].append(np.max(P_cls[0, ii, :]))
 
-    all_dets = []
+def init_tflite_models(C, num_threads=None):
+    """Same as init_models, with the TFLite models exported from C.model_path by tflite_export.py"""
+    rpn_path, classifier_path, metadata_path = tflite_model_paths(C.model_path)
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
 
-    for key in bboxes:
-        bbox = np.array(bboxes[key])
+    print('Loading TFLite models {} and {} ({})'.format(rpn_path, classifier_path, metadata['quantization']))
+    model_rpn = TFLiteModel(rpn_path, metadata['rpn_inputs'], metadata['rpn_outputs'], num_threads=num_threads)
+    model_classifier_only = TFLiteModel(classifier_path, metadata['classifier_inputs'], metadata['classifier_outputs'],
+                                        num_threads=num_threads)
 
-        new_boxes, new_probs = non_max_suppression_fast(bbox, np.array(probs[key]), overlap_thresh=0.2)
-        for jk in range(new_boxes.shape[0]):
-            (x1, y1, x2, y2) = new_boxes[jk, :]
+    class_mapping = C.class_mapping
+    class_mapping = {v: k for k, v in class_mapping.items()}
+    print(class_mapping)
+
+    return model_rpn, class_mapping, model_classifier_only
+
+
+def onnx_model_paths(model_path):
+    """Paths of the ONNX models exported by onnx_export.py from the Keras weights model_path
+
+    Returns:
+        paths of the RPN model, of the classifier model and of their metadata (names of the inputs and outputs)
+    """
+    base_path = os.path.splitext(model_path)[0]
+    return base_path + '_rpn.onnx', base_path + '_classifier.onnx', base_path + '_onnx.json'
+
+
+class ONNXModel:
+    """ONNX model run by ONNX Runtime on the CPU, with the predict() interface of the Keras models used by Detector
+
+    Args:
+        model_path: path of the .onnx file
+        input_names: names of the inputs of the ONNX graph, in the order of the inputs of the Keras model
+        output_names: names of the outputs of the ONNX graph, in the order of the outputs of the Keras model
+        num_threads: number of threads used by an operator (None for the ONNX Runtime default, one per core)
+    """
+
+    def __init__(self, model_path, input_names, output_names, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = input_names
+        self.output_names = output_names
+
+    def predict(self, inputs):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        return self.session.run(self.output_names, {name: np.asarray(x, dtype=np.float32)
+                                                    for name, x in zip(self.input_names, inputs)})
 
-            # Calculate real coordinates on original image
-            (real_x1, real_y1, real_x2, real_y2) = get_real_coordinates(ratio, x1, y1, x2, y2)
-            cv2.rectangle(img, (real_x1, real_y1), (real_x2, real_y2),
-                          (int(class_to_color[key][0]), int(class_to_color[key][1]), int(class_to_color[key][2])),
-                          4)
 
-            textLabel = '{}: {}'.format(key, int(100 * new_probs[jk]))
-            all_dets.append((key, 100 * new_probs[jk], ((real_x1, real_y1), (real_x2, real_y2))))
+def init_onnx_models(C, num_threads=None):
+    """Same as init_models, with the ONNX models exported from C.model_path by onnx_export.py"""
+    rpn_path, classifier_path, metadata_path = onnx_model_paths(C.model_path)
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
 
-            (retval, baseLine) = cv2.getTextSize(textLabel, cv2.FONT_HERSHEY_COMPLEX, 1, 1)
-            textOrg = (real_x1, real_y1 - 0)
+    print('Loading ONNX models {} and {}'.format(rpn_path, classifier_path))
+    model_rpn = ONNXModel(rpn_path, metadata['rpn_inputs'], metadata['rpn_outputs'], num_threads=num_threads)
+    model_classifier_only = ONNXModel(classifier_path, metadata['classifier_inputs'], metadata['classifier_outputs'],
+                                      num_threads=num_threads)
 
-            cv2.rectangle(img, (textOrg[0] - 5, textOrg[1] + baseLine - 5),
-                          (textOrg[0] + retval[0] + 5, textOrg[1] - retval[1] - 5), (0, 0, 0), 1)
-            cv2.rectangle(img, (textOrg[0] - 5, textOrg[1] + baseLine - 5),
-                          (textOrg[0] + retval[0] + 5, textOrg[1] - retval[1] - 5), (255, 255, 255), -1)
-            cv2.putText(img, textLabel, textOrg, cv2.FONT_HERSHEY_DUPLEX, 1, (0, 0, 0), 1)
-            cv2.putText(img,"A", (10, 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0))
+    class_mapping = C.class_mapping
+    class_mapping = {v: k for k, v in class_mapping.items()}
+    print(class_mapping)
+
+    return model_rpn, class_mapping, model_classifier_only
+
+
+def list_images(directory, num_images):
+    """Paths of at most num_images images of a directory, picked at random"""
+    filepaths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                       if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+    random.shuffle(filepaths)
+    return filepaths[:num_images]
+
+
+class Detector:
+    """Faster R-CNN inference engine owning the models and the config
+
+    predict() runs the whole detection pipeline on one image (RPN, proposals, classifier, per-class NMS) and
+    returns the detections as a numpy structured array, without drawing anything.
+
+    The networks run with Keras (backend='keras', see CompiledModel), with the inference bundle saved by
+    bundle_export.py (backend='bundle'), with the TFLite models exported by tflite_export.py (backend='tflite') or
+    with the ONNX models exported by onnx_export.py (backend='onnx'). The post-processing (rpn_to_roi, NMS) is the
+    same numpy code for all of them.
+
+    Args:
+        C: config
+        rpn_overlap_thresh: overlap threshold of the NMS applied on the RPN proposals
+        overlap_thresh: overlap threshold of the per-class NMS applied on the final bboxes
+            (has to be < rpn_overlap_thresh)
+        backend: 'keras', 'bundle', 'tflite' or 'onnx'
+        num_threads: number of threads of the TFLite interpreters or of the ONNX Runtime sessions (None for their
+            default)
+    """
+
+    def __init__(self, C, rpn_overlap_thresh=0.7, overlap_thresh=0.2, backend='keras', num_threads=None):
+        self.C = C
+        self.rpn_overlap_thresh = rpn_overlap_thresh
+        self.overlap_thresh = overlap_thresh
+        self.backend = backend
+
+        if backend == 'keras':
+            model_rpn, self.class_mapping, model_classifier_only = init_models(C)
+            self.model_rpn = CompiledModel(model_rpn)
+            self.model_classifier_only = CompiledModel(model_classifier_only)
+        elif backend == 'bundle':
+            self.model_rpn, self.class_mapping, self.model_classifier_only = init_bundle_models(C)
+        elif backend == 'tflite':
+            self.model_rpn, self.class_mapping, self.model_classifier_only = init_tflite_models(C, num_threads)
+        elif backend == 'onnx':
+            self.model_rpn, self.class_mapping, self.model_classifier_only = init_onnx_models(C, num_threads)
+        else:
+            raise ValueError('Unknown backend {}, expected keras, bundle, tflite or onnx'.format(backend))
+        self.nb_classes = len(C.class_mapping)
+
+        # box: (x1, y1, x2, y2) on the original image
+        # resized_box: (x1, y1, x2, y2) on the image resized to C.im_size, as fed to the network
+        # class_id: key of class_mapping, score: probability of the class, all_probs: probabilities of all classes
+        self.dtype = np.dtype([('box', np.int64, (4,)), ('resized_box', np.int64, (4,)), ('class_id', np.int64),
+                               ('score', np.float32), ('all_probs', np.float32, (self.nb_classes,))])
+
+    def warm_up(self):
+        """Run the detection once on a blank image, so that the first real image does not pay for the allocation
+        of the buffers (and the tracing of the tf.functions with the Keras backend)"""
+        st = time.time()
+        self.predict(np.zeros((self.C.im_size, self.C.im_size * 4 // 3, 3), dtype=np.uint8))
+        print('Warm-up done in {:.2f} s'.format(time.time() - st))
+
+    def predict(self, img, bbox_threshold=0.0):
+        """Detect the objects in one image
+
+        Args:
+            img: cv2 image (BGR), already pre-processed
+            bbox_threshold: detections whose probability is lower are dropped
+
+        Returns:
+            dets: structured array of the detections (see self.dtype), grouped by class
+        """
+        return self.predict_batch([img], bbox_threshold)[0]
+
+    def predict_batch(self, images, bbox_threshold=0.0):
+        """Detect the objects in several images, running the base network and the RPN once per image size
+
+        The images are resized to C.im_size, and the images of the same size (most images of a camera or of a
+        dataset) go through the base network and the RPN in one call. The images are not padded to a common shape,
+        which would change the features near their border, so every image gets the same detections as with
+        predict().
+
+        Args:
+            images: list of cv2 images (BGR), already pre-processed
+            bbox_threshold: detections whose probability is lower are dropped
+
+        Returns:
+            list of the structured arrays of the detections of each image (see predict)
+        """
+        return self.predict_formatted([format_img(img, self.C) for img in images], bbox_threshold)
+
+    def predict_formatted(self, inputs, bbox_threshold=0.0):
+        """Same as predict_batch, for images already formatted with format_img (e.g. by a loading thread)
+
+        Args:
+            inputs: list of the (X, ratio) returned by format_img for each image
+            bbox_threshold: detections whose probability is lower are dropped
+
+        Returns:
+            list of the structured arrays of the detections of each image (see predict)
+        """
+        # indices of the images of each size, in the order of the inputs
+        size_groups = OrderedDict()
+        for i, (X, _) in enumerate(inputs):
+            size_groups.setdefault(X.shape, []).append(i)
+
+        all_dets = [None] * len(inputs)
+        for group in size_groups.values():
+            # (1, channel, height, width) images of the same size to a (batch, height, width, channel) batch
+            X_batch = np.concatenate([np.transpose(inputs[i][0], (0, 2, 3, 1)) for i in group]).astype(np.float32)
+
+            # get output layer Y1, Y2 from the RPN and the feature maps F
+            # Y1: y_rpn_cls
+            # Y2: y_rpn_regr
+            [Y1_batch, Y2_batch, F_batch] = self.model_rpn.predict(X_batch)
+
+            for j, i in enumerate(group):
+                all_dets[i] = self.detect_rpn_outputs(Y1_batch[j:j + 1], Y2_batch[j:j + 1], F_batch[j:j + 1],
+                                                      inputs[i][1], bbox_threshold)
+
+        return all_dets
+
+    def detect_rpn_outputs(self, Y1, Y2, F, ratio, bbox_threshold=0.0):
+        """Detections of one image from the outputs of the RPN
+
+        Args:
+            Y1, Y2, F: rpn_cls, rpn_regr and feature map of the image, shape=(1, rows, cols, ...)
+            ratio: resize ratio of the image (see format_img)
+            bbox_threshold: detections whose probability is lower are dropped
+
+        Returns:
+            structured array of the detections of the image (see predict)
+        """
+        # Get bboxes by applying NMS
+        # R.shape = (300, 4)
+        R = rpn_to_roi(Y1, Y2, self.C, K.image_data_format(), overlap_thresh=self.rpn_overlap_thresh)
+
+        # convert from (x1,y1,x2,y2) to (x,y,w,h)
+        R[:, 2] -= R[:, 0]
+        R[:, 3] -= R[:, 1]
+
+        # apply the spatial pyramid pooling to all the proposed regions in a single call
+        ROIs = np.expand_dims(R, axis=0)
+        if ROIs.shape[1] > 0:
+            [P_cls, P_regr] = self.model_classifier_only.predict([F, ROIs])
+        else:
+            P_cls = np.zeros((1, 0, self.nb_classes))
+            P_regr = np.zeros((1, 0, 4 * (self.nb_classes - 1)))
+
+        return self.postprocess(P_cls, P_regr, ROIs, ratio, bbox_threshold)
+
+    def postprocess(self, P_cls, P_regr, ROIs, ratio, bbox_threshold=0.0):
+        """Convert the classifier outputs of one image into detections
+
+        Args:
+            P_cls: shape=(1, num_rois, nb_classes) class probabilities
+            P_regr: shape=(1, num_rois, 4 * (nb_classes - 1)) class-specific regressions
+            ROIs: shape=(1, num_rois, 4) rois on the feature map, with ordering (x, y, w, h)
+            ratio: resize ratio between the network input and the original image
+            bbox_threshold: detections whose probability is lower are dropped
+
+        Returns:
+            dets: structured array of the detections (see self.dtype), grouped by class
+        """
+        # Calculate bboxes coordinates on resized image
+        detections = decode_classifier_output(P_cls, P_regr, ROIs, self.C, bbox_threshold)
+
+        picks = []
+        for cls_num, (bbox, prob, all_prob) in detections.items():
+            picks.append((cls_num,) + non_max_suppression(bbox, prob, all_prob, overlap_thresh=self.overlap_thresh))
+
+        dets = np.zeros(sum(len(pick[2]) for pick in picks), dtype=self.dtype)
+        start = 0
+        for cls_num, new_boxes, new_probs, new_all_probs in picks:
+            end = start + len(new_probs)
+            dets['resized_box'][start:end] = new_boxes
+            dets['class_id'][start:end] = cls_num
+            dets['score'][start:end] = new_probs
+            dets['all_probs'][start:end] = new_all_probs
+            start = end
+
+        # Calculate real coordinates on original image (same as get_real_coordinates)
+        dets['box'] = np.round(dets['resized_box'] // ratio)
+
+        return dets
+
+
+def compare_detections(reference, dets, iou_threshold=0.5):
+    """Match detections to reference detections (see Detector.predict)
+
+    Each reference detection, by decreasing score, is matched to the unmatched detection of the same class with the
+    highest IoU, if it is at least iou_threshold.
+
+    Returns:
+        dict with the number of reference detections and detections, the number of matches, the mean IoU and the
+        mean and max absolute score difference of the matches
+    """
+    ious = iou_np(reference['box'], dets['box'])
+    matched = np.zeros(len(dets), dtype=bool)
+    match_ious = []
+    score_diffs = []
+    for i in np.argsort(-reference['score']):
+        candidates = np.where((dets['class_id'] == reference['class_id'][i]) & ~matched
+                              & (ious[i] >= iou_threshold))[0]
+        if len(candidates) == 0:
+            continue
+        j = candidates[np.argmax(ious[i, candidates])]
+        matched[j] = True
+        match_ious.append(ious[i, j])
+        score_diffs.append(abs(float(reference['score'][i]) - float(dets['score'][j])))
+
+    return {'reference_dets': len(reference), 'dets': len(dets), 'matched': len(match_ious),
+            'mean_iou': np.mean(match_ious) if match_ious else np.nan,
+            'mean_score_diff': np.mean(score_diffs) if score_diffs else np.nan,
+            'max_score_diff': np.max(score_diffs) if score_diffs else np.nan}
+
+
+def parity_report(C, filepaths, bbox_threshold, backend, num_threads=None):
+    """Compare the detections of the exported models of a backend with the ones of the Keras models on images
+
+    Args:
+        C: config
+        filepaths: paths of the images
+        bbox_threshold: detections whose probability is lower are dropped
+        backend: 'tflite' or 'onnx' (see Detector)
+        num_threads: number of threads of the backend (see Detector)
+
+    Returns:
+        pandas DataFrame with one row per image (see compare_detections) and the time of both backends
+    """
+    detectors = {'keras': Detector(C), backend: Detector(C, backend=backend, num_threads=num_threads)}
+
+    rows = []
+    for filepath in filepaths:
+        img = cv2.imread(filepath)
+        dets = {}
+        times = {}
+        for name, detector in detectors.items():
+            st = time.time()
+            dets[name] = detector.predict(img, bbox_threshold)
+            times[name] = time.time() - st
+        row = {'filepath': filepath}
+        row.update(compare_detections(dets['keras'], dets[backend]))
+        row.update({'keras_time': times['keras'], backend + '_time': times[backend]})
+        rows.append(row)
+
+    report = pd.DataFrame(rows)
+    print('Parity of the {} models on {} images:'.format(backend, len(report)))
+    print('    - detections: {} with keras, {} with {}, {} matched (same class, IoU >= 0.5)'.format(
+        report['reference_dets'].sum(), report['dets'].sum(), backend, report['matched'].sum()))
+    print('    - mean IoU of the matches: {:.4f}'.format(report['mean_iou'].mean()))
+    print('    - score difference of the matches: mean {:.4f}, max {:.4f}'.format(
+        report['mean_score_diff'].mean(), report['max_score_diff'].max()))
+    print('    - time per image: {:.3f} s with keras, {:.3f} s with {}'.format(
+        report['keras_time'].mean(), report[backend + '_time'].mean(), backend))
+    return report
+
+
+def draw_detections(img, dets, class_mapping, class_to_color):
+    """Draw the bboxes and labels of the detections returned by Detector.predict on the image"""
+    for det in dets:
+        key = class_mapping[det['class_id']]
+        (real_x1, real_y1, real_x2, real_y2) = det['box'].tolist()
+
+        cv2.rectangle(img, (real_x1, real_y1), (real_x2, real_y2),
+                      (int(class_to_color[key][0]), int(class_to_color[key][1]), int(class_to_color[key][2])),
+                      4)
+
+        textLabel = '{}: {}'.format(key, int(100 * det['score']))
+
+        (retval, baseLine) = cv2.getTextSize(textLabel, cv2.FONT_HERSHEY_COMPLEX, 1, 1)
+        textOrg = (real_x1, real_y1 - 0)
+
+        cv2.rectangle(img, (textOrg[0] - 5, textOrg[1] + baseLine - 5),
+                      (textOrg[0] + retval[0] + 5, textOrg[1] - retval[1] - 5), (0, 0, 0), 1)
+        cv2.rectangle(img, (textOrg[0] - 5, textOrg[1] + baseLine - 5),
+                      (textOrg[0] + retval[0] + 5, textOrg[1] - retval[1] - 5), (255, 255, 255), -1)
+        cv2.putText(img, textLabel, textOrg, cv2.FONT_HERSHEY_DUPLEX, 1, (0, 0, 0), 1)
+
+
+def detect(img, detector, bbox_threshold, class_to_color):
+    print("Starting detection")
+    st = time.time()
+
+    dets = detector.predict(img, bbox_threshold)
+
+    draw_detections(img, dets, detector.class_mapping, class_to_color)
+    if len(dets) > 0:
+        cv2.putText(img,"A", (10, 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0))
+
+    all_dets = []
+    for det in dets:
+        (real_x1, real_y1, real_x2, real_y2) = det['box'].tolist()
+        all_dets.append((detector.class_mapping[det['class_id']], 100 * det['score'],
+                         ((real_x1, real_y1), (real_x2, real_y2))))
 
-    if C.verbose:
+    if detector.C.verbose:
         print(all_dets)
         print('Elapsed time = {}'.format(time.time() - st))
 
@@ -2,6 +2,8 @@ import sklearn.metrics
 import os
 
 from libraries import *
+from detection_libraries import Detector, draw_detections
+from split_manifest import SplitManifest, load_split_imgs, split_record_path
 
 bbox_threshold = 0.611
 
@@ -29,42 +31,73 @@ def preprocess_img(img, noise_reduction, histogram_equalization, gamma_correctio
     return img
 
 
-def init_models():
-    num_features = 512
+def load_image(item):
+    """Read and pre-process one image, and format it for the detector
 
-    input_shape_img = (None, None, 3)
-    input_shape_features = (None, None, num_features)
+    Args:
+        item: path of the image, or img_data given by the image cache (see test_items)
 
-    img_input = Input(shape=input_shape_img)
-    roi_input = Input(shape=(C.num_rois, 4))
-    feature_map_input = Input(shape=input_shape_features)
+    Returns:
+        initial_img: image as read from the disk (the cached image for img_data)
+        img: pre-processed image
+        (X, ratio): img formatted by format_img
+    """
+    if isinstance(item, dict):
+        # the image cache holds the images already pre-processed and resized
+        img = read_img(item)
+        return img, img, format_img(img, C)
 
-    # define the base network (VGG here, can be Resnet50, Inception, etc)
-    shared_layers = nn_base(img_input, trainable=True)
+    initial_img = cv2.imread(item)
+    img = preprocess_img(initial_img, noise_reduction, histogram_equalization, gamma_correction)
+    return initial_img, img, format_img(img, C)
 
-    # define the RPN, built on the base layers
-    num_anchors = len(C.anchor_box_scales) * len(C.anchor_box_ratios)
-    rpn_layers = rpn_layer(shared_layers, num_anchors)
 
-    classifier = classifier_layer(feature_map_input, roi_input, C.num_rois, nb_classes=len(C.class_mapping))
+def test_items(test_imgs):
+    """Items given to detect_images for the annotated images test_imgs
 
-    model_rpn = Model(img_input, rpn_layers)
-    model_classifier_only = Model([feature_map_input, roi_input], classifier)
+    Without --image_cache, the items are the image paths. With it, the images are read from the image cache and
+    the img_data are replaced by the cached ones, whose bboxes match the cached images.
 
-    model_classifier = Model([feature_map_input, roi_input], classifier)
+    Returns:
+        test_imgs: img_data of the images
+        items: items for detect_images
+    """
+    if image_cache is None:
+        return test_imgs, [img_data['filepath'] for img_data in test_imgs]
+    test_imgs = image_cache.update(test_imgs)
+    return test_imgs, test_imgs
 
-    print('Loading weights from {}'.format(C.model_path))
-    model_rpn.load_weights(C.model_path, by_name=True)
-    model_classifier.load_weights(C.model_path, by_name=True)
 
-    model_rpn.compile(optimizer='sgd', loss='mse')
-    model_classifier.compile(optimizer='sgd', loss='mse')
+def detect_images(filepaths, bbox_threshold=0.0):
+    """Run the detector on images, batch_size images at a time
 
-    class_mapping = C.class_mapping
-    class_mapping = {v: k for k, v in class_mapping.items()}
-    print(class_mapping)
+    The images are read and pre-processed by a PrefetchLoader while the previous ones are in the network.
 
-    return model_rpn, class_mapping, model_classifier_only
+    Args:
+        filepaths: paths of the images, or img_data given by the image cache (see load_image)
+        bbox_threshold: detections whose probability is lower are dropped
+
+    Yields:
+        initial_img: image as read from the disk (the cached image for img_data)
+        img: pre-processed image given to the detector
+        dets: detections of the image (see Detector.predict)
+    """
+    loader = PrefetchLoader(filepaths, load_image, prefetch=prefetch, workers=prefetch_workers)
+    loaded_imgs = iter(loader)
+    while True:
+        batch = list(itertools.islice(loaded_imgs, batch_size))
+        if not batch:
+            break
+
+        st = time.time()
+        all_dets = detector.predict_formatted([inputs for _, _, inputs in batch], bbox_threshold)
+        print('Elapsed time = {} for {} images ({} images ready in the loader queue)'.format(
+            time.time() - st, len(batch), loader.queue_depths[-1]))
+
+        for (initial_img, img, _), dets in zip(batch, all_dets):
+            yield initial_img, img, dets
+
+    print(loader.summary())
 
 
 def draw_box_on_images(noise_reduction, histogram_equalization, gamma_correction):
@@ -79,12 +112,11 @@ def draw_box_on_images(noise_reduction, histogram_equalization, gamma_correction
                     test_imgs.append(os.path.join(dir_path, img_name))
     else:
         if from_csv:
-            imgs_record_df = pd.read_csv(imgs_record_path)
-            last_row = imgs_record_df.tail(1)
-            test_imgs_temp = ast.literal_eval(last_row['test'].tolist()[0])
-            test_imgs = []
-            for img_dict in test_imgs_temp:
-                test_imgs.append(img_dict['filepath'])
+            if imgs_record_path.endswith('.csv'):
+                test_imgs = [img_dict['filepath'] for img_dict in load_split_imgs(imgs_record_path, 'test')]
+            else:
+                with SplitManifest(imgs_record_path) as manifest:
+                    test_imgs = manifest.filepaths('test')
         else:
             test_imgs_temp = os.listdir(data_test_path)
             test_imgs = []
@@ -102,116 +134,17 @@ def draw_box_on_images(noise_reduction, histogram_equalization, gamma_correction
     # classes = {}
 
     # for idx, img_name in enumerate(imgs_path):
+    test_imgs = [filepath for filepath in test_imgs
+                 if filepath.lower().endswith(('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff'))]
     length = len(test_imgs)
     print(length)
-    for idx, filepath in enumerate(test_imgs):
+    for idx, (filepath, (initial_img, _, dets)) in enumerate(zip(test_imgs, detect_images(test_imgs, bbox_threshold))):
         print("Progression : " + str(idx + 1) + "/" + str(length))
-        if not filepath.lower().endswith(('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff')):
-            continue
         print(filepath)
-        st = time.time()
-
-        img = cv2.imread(filepath)
-
-        initial_img = img.copy()
-
-        img = preprocess_img(img, noise_reduction, histogram_equalization, gamma_correction)
-
-        X, ratio = format_img(img, C)
-
-        X = np.transpose(X, (0, 2, 3, 1))
-
-        # get output layer Y1, Y2 from the RPN and the feature maps F
-        # Y1: y_rpn_cls
-        # Y2: y_rpn_regr
-        [Y1, Y2, F] = model_rpn.predict(X)
-
-        # Get bboxes by applying NMS
-        # R.shape = (300, 4)
-        R = rpn_to_roi(Y1, Y2, C, K.image_data_format(), overlap_thresh=0.7)
-
-        # convert from (x1,y1,x2,y2) to (x,y,w,h)
-        R[:, 2] -= R[:, 0]
-        R[:, 3] -= R[:, 1]
-
-        # apply the spatial pyramid pooling to the proposed regions
-        bboxes = {}
-        probs = {}
-
-        for jk in range(R.shape[0] // C.num_rois + 1):
-            ROIs = np.expand_dims(R[C.num_rois * jk:C.num_rois * (jk + 1), :], axis=0)
-            if ROIs.shape[1] == 0:
-                break
-
-            if jk == R.shape[0] // C.num_rois:
-                # pad R
-                curr_shape = ROIs.shape
-                target_shape = (curr_shape[0], C.num_rois, curr_shape[2])
-                ROIs_padded = np.zeros(target_shape).astype(ROIs.dtype)
-                ROIs_padded[:, :curr_shape[1], :] = ROIs
-                ROIs_padded[0, curr_shape[1]:, :] = ROIs[0, 0, :]
-                ROIs = ROIs_padded
-
-            [P_cls, P_regr] = model_classifier_only.predict([F, ROIs])
-
-            # Calculate bboxes coordinates on resized image
-            for ii in range(P_cls.shape[1]):
-                # Ignore 'bg' class
-                if np.max(P_cls[0, ii, :]) < bbox_threshold or np.argmax(P_cls[0, ii, :]) == (P_cls.shape[2] - 1):
-                    continue
-
-                cls_name = class_mapping[np.argmax(P_cls[0, ii, :])]
-
-                if cls_name not in bboxes:
-                    bboxes[cls_name] = []
-                    probs[cls_name] = []
-
-                (x, y, w, h) = ROIs[0, ii, :]
-
-                cls_num = np.argmax(P_cls[0, ii, :])
-                try:
-                    (tx, ty, tw, th) = P_regr[0, ii, 4 * cls_num:4 * (cls_num + 1)]
-                    tx /= C.classifier_regr_std[0]
-                    ty /= C.classifier_regr_std[1]
-                    tw /= C.classifier_regr_std[2]
-                    th /= C.classifier_regr_std[3]
-                    x, y, w, h = apply_regr(x, y, w, h, tx, ty, tw, th)
-                except:
-                    pass
-                bboxes[cls_name].append(
-                    [C.rpn_stride * x, C.rpn_stride * y, C.rpn_stride * (x + w), C.rpn_stride * (y + h)])
-                probs[cls_name].append(np.max(P_cls[0, ii, :]))
-
-        all_dets = []
-
-        for key in bboxes:
-            bbox = np.array(bboxes[key])
-
-            new_boxes, new_probs = non_max_suppression_fast(bbox, np.array(probs[key]), overlap_thresh=0.2)
-            # Has to be < overlap_threshold used in the return value of rpn
-            for jk in range(new_boxes.shape[0]):
-                (x1, y1, x2, y2) = new_boxes[jk, :]
-
-                # Calculate real coordinates on original image
-                (real_x1, real_y1, real_x2, real_y2) = get_real_coordinates(ratio, x1, y1, x2, y2)
-
-                cv2.rectangle(initial_img, (real_x1, real_y1), (real_x2, real_y2),
-                              (int(class_to_color[key][0]), int(class_to_color[key][1]), int(class_to_color[key][2])),
-                              4)
-
-                textLabel = '{}: {}'.format(key, int(100 * new_probs[jk]))
-                all_dets.append((key, 100 * new_probs[jk]))
-
-                (retval, baseLine) = cv2.getTextSize(textLabel, cv2.FONT_HERSHEY_COMPLEX, 1, 1)
-                textOrg = (real_x1, real_y1 - 0)
 
-                cv2.rectangle(initial_img, (textOrg[0] - 5, textOrg[1] + baseLine - 5),
-                              (textOrg[0] + retval[0] + 5, textOrg[1] - retval[1] - 5), (0, 0, 0), 1)
-                cv2.rectangle(initial_img, (textOrg[0] - 5, textOrg[1] + baseLine - 5),
-                              (textOrg[0] + retval[0] + 5, textOrg[1] - retval[1] - 5), (255, 255, 255), -1)
-                cv2.putText(initial_img, textLabel, textOrg, cv2.FONT_HERSHEY_DUPLEX, 1, (0, 0, 0), 1)
+        draw_detections(initial_img, dets, class_mapping, class_to_color)
+        all_dets = [(class_mapping[det['class_id']], 100 * det['score']) for det in dets]
 
-        print('Elapsed time = {}'.format(time.time() - st))
         print(all_dets)
         plt.figure(figsize=(10, 10))
         plt.grid()
@@ -334,11 +267,34 @@ def modified_average_precision_score(T, P):
     return modified_ap
 
 
+def format_for_map(img, dets):
+    """Format the detections of one image for get_map and get_map_all
+
+    Args:
+        img: image given to the detector
+        dets: detections of the image (see Detector.predict)
+
+    Returns:
+        all_dets: list of dicts, one per detection, with bboxes on the resized image
+        fx, fy: ratios between the original image and the resized image
+    """
+    (height, width, _) = img.shape
+    (resized_width, resized_height) = get_new_img_size(width, height, C.im_size)
+    fx = width / float(resized_width)
+    fy = height / float(resized_height)
+
+    all_dets = []
+    for det in dets:
+        (x1, y1, x2, y2) = det['resized_box']
+        all_dets.append({'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2, 'class': class_mapping[det['class_id']],
+                         'prob': det['score'], 'all_probs': det['all_probs']})
+
+    return all_dets, fx, fy
+
+
 def accuracy():
     if from_csv:
-        imgs_record_df = pd.read_csv(imgs_record_path)
-        last_row = imgs_record_df.tail(1)
-        test_imgs = ast.literal_eval(last_row['test'].tolist()[0])
+        test_imgs = load_split_imgs(imgs_record_path, 'test')
     else:
         test_imgs, _, _ = get_data(test_path, data_test_path)
 
@@ -350,99 +306,13 @@ def accuracy():
     P_all_conf = np.empty((0, nbr_classes), float)
     mAPs = []
     # mROC_AUCs = []
-    for idx, img_data in enumerate(test_imgs):
+    test_imgs, items = test_items(test_imgs)
+    for idx, (img_data, (_, img, dets)) in enumerate(zip(test_imgs, detect_images(items))):
         print('{}/{}'.format(idx, len(test_imgs)))
-        st = time.time()
-        filepath = img_data['filepath']
-        print(filepath)
+        print(img_data['filepath'])
+
+        all_dets, fx, fy = format_for_map(img, dets)
 
-        img = cv2.imread(filepath)
-
-        img = preprocess_img(img, noise_reduction, histogram_equalization, gamma_correction)
-
-        X, fx, fy = format_img_map(img, C)
-
-        # Change X (img) shape from (1, channel, height, width) to (1, height, width, channel)
-        X = np.transpose(X, (0, 2, 3, 1))
-
-        # get the feature maps and output from the RPN
-        [Y1, Y2, F] = model_rpn.predict(X)
-
-        R = rpn_to_roi(Y1, Y2, C, K.image_data_format(), overlap_thresh=0.7)
-
-        # convert from (x1,y1,x2,y2) to (x,y,w,h)
-        R[:, 2] -= R[:, 0]
-        R[:, 3] -= R[:, 1]
-
-        # apply the spatial pyramid pooling to the proposed regions
-        bboxes = {}
-        probs = {}
-        all_probs = {}
-
-        for jk in range(R.shape[0] // C.num_rois + 1):
-            ROIs = np.expand_dims(R[C.num_rois * jk:C.num_rois * (jk + 1), :], axis=0)
-            if ROIs.shape[1] == 0:
-                break
-
-            if jk == R.shape[0] // C.num_rois:
-                # pad R
-                curr_shape = ROIs.shape
-                target_shape = (curr_shape[0], C.num_rois, curr_shape[2])
-                ROIs_padded = np.zeros(target_shape).astype(ROIs.dtype)
-                ROIs_padded[:, :curr_shape[1], :] = ROIs
-                ROIs_padded[0, curr_shape[1]:, :] = ROIs[0, 0, :]
-                ROIs = ROIs_padded
-
-            [P_cls, P_regr] = model_classifier_only.predict([F, ROIs])
-
-            # Calculate all classes' bboxes coordinates on resized image (300, 400)
-            # Drop 'bg' classes bboxes
-            for ii in range(P_cls.shape[1]):
-
-                # If class name is 'bg', continue
-                if np.argmax(P_cls[0, ii, :]) == (P_cls.shape[2] - 1):
-                    continue
-
-                # Get class name
-                cls_name = class_mapping[np.argmax(P_cls[0, ii, :])]
-
-                if cls_name not in bboxes:
-                    bboxes[cls_name] = []
-                    probs[cls_name] = []
-                    all_probs[cls_name] = []
-
-                (x, y, w, h) = ROIs[0, ii, :]
-
-                cls_num = np.argmax(P_cls[0, ii, :])
-                try:
-                    (tx, ty, tw, th) = P_regr[0, ii, 4 * cls_num:4 * (cls_num + 1)]
-                    tx /= C.classifier_regr_std[0]
-                    ty /= C.classifier_regr_std[1]
-                    tw /= C.classifier_regr_std[2]
-                    th /= C.classifier_regr_std[3]
-                    x, y, w, h = apply_regr(x, y, w, h, tx, ty, tw, th)
-                except:
-                    pass
-                bboxes[cls_name].append([16 * x, 16 * y, 16 * (x + w), 16 * (y + h)])
-                probs[cls_name].append(np.max(P_cls[0, ii, :]))
-                all_probs[cls_name].append(list(P_cls[0, ii, :]))
-
-        all_dets = []
-
-        for key in bboxes:
-            bbox = np.array(bboxes[key])
-            all_prob = np.array(all_probs[key])
-
-            # Apply non-max-suppression on final bboxes to get the output bounding boxes
-            new_boxes, new_probs, new_all_prob = non_max_suppression_fast_with_all_probs(bbox, np.array(probs[key]),
-                                                                                         all_prob, overlap_thresh=0.2)
-            for jk in range(new_boxes.shape[0]):
-                (x1, y1, x2, y2) = new_boxes[jk, :]
-                det = {'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2, 'class': key, 'prob': new_probs[jk],
-                       'all_probs': new_all_prob[jk]}
-                all_dets.append(det)
-
-        print('Elapsed time = {}'.format(time.time() - st))
         t, p = get_map(all_dets, img_data['bboxes'], (fx, fy))  # p contient les proba de prédiction des classes
         T_all_for_image_conf, P_all_for_image_conf = get_map_all(all_dets, img_data['bboxes'], (fx, fy), class_mapping)
         for T_all_box_conf in T_all_for_image_conf:
@@ -569,102 +439,13 @@ def evaluate_trap_results():
         T_all_conf = np.empty((0, nbr_classes), int)
         P_all_conf = np.empty((0, nbr_classes), float)
 
-        for idx, img_data in enumerate(test_imgs):
+        test_imgs, items = test_items(test_imgs)
+        for idx, (img_data, (_, img, dets)) in enumerate(zip(test_imgs, detect_images(items))):
             print('{}/{}'.format(idx, len(test_imgs)))
-            st = time.time()
-            filepath = img_data['filepath']
-            print(filepath)
-
-
-
-            img = cv2.imread(filepath)
-
-            img = preprocess_img(img, noise_reduction, histogram_equalization, gamma_correction)
-
-            X, fx, fy = format_img_map(img, C)
-
-            # Change X (img) shape from (1, channel, height, width) to (1, height, width, channel)
-            X = np.transpose(X, (0, 2, 3, 1))
-
-            # get the feature maps and output from the RPN
-            [Y1, Y2, F] = model_rpn.predict(X)
-
-            R = rpn_to_roi(Y1, Y2, C, K.image_data_format(), overlap_thresh=0.7)
+            print(img_data['filepath'])
 
-            # convert from (x1,y1,x2,y2) to (x,y,w,h)
-            R[:, 2] -= R[:, 0]
-            R[:, 3] -= R[:, 1]
+            all_dets, fx, fy = format_for_map(img, dets)
 
-            # apply the spatial pyramid pooling to the proposed regions
-            bboxes = {}
-            probs = {}
-            all_probs = {}
-
-            for jk in range(R.shape[0] // C.num_rois + 1):
-                ROIs = np.expand_dims(R[C.num_rois * jk:C.num_rois * (jk + 1), :], axis=0)
-                if ROIs.shape[1] == 0:
-                    break
-
-                if jk == R.shape[0] // C.num_rois:
-                    # pad R
-                    curr_shape = ROIs.shape
-                    target_shape = (curr_shape[0], C.num_rois, curr_shape[2])
-                    ROIs_padded = np.zeros(target_shape).astype(ROIs.dtype)
-                    ROIs_padded[:, :curr_shape[1], :] = ROIs
-                    ROIs_padded[0, curr_shape[1]:, :] = ROIs[0, 0, :]
-                    ROIs = ROIs_padded
-
-                [P_cls, P_regr] = model_classifier_only.predict([F, ROIs])
-
-                # Calculate all classes' bboxes coordinates on resized image (300, 400)
-                # Drop 'bg' classes bboxes
-                for ii in range(P_cls.shape[1]):
-
-                    # If class name is 'bg', continue
-                    if np.argmax(P_cls[0, ii, :]) == (P_cls.shape[2] - 1):
-                        continue
-
-                    # Get class name
-                    cls_name = class_mapping[np.argmax(P_cls[0, ii, :])]
-
-                    if cls_name not in bboxes:
-                        bboxes[cls_name] = []
-                        probs[cls_name] = []
-                        all_probs[cls_name] = []
-
-                    (x, y, w, h) = ROIs[0, ii, :]
-
-                    cls_num = np.argmax(P_cls[0, ii, :])
-                    try:
-                        (tx, ty, tw, th) = P_regr[0, ii, 4 * cls_num:4 * (cls_num + 1)]
-                        tx /= C.classifier_regr_std[0]
-                        ty /= C.classifier_regr_std[1]
-                        tw /= C.classifier_regr_std[2]
-                        th /= C.classifier_regr_std[3]
-                        x, y, w, h = apply_regr(x, y, w, h, tx, ty, tw, th)
-                    except:
-                        pass
-                    bboxes[cls_name].append([16 * x, 16 * y, 16 * (x + w), 16 * (y + h)])
-                    probs[cls_name].append(np.max(P_cls[0, ii, :]))
-                    all_probs[cls_name].append(list(P_cls[0, ii, :]))
-
-            all_dets = []
-
-            for key in bboxes:
-                bbox = np.array(bboxes[key])
-                all_prob = np.array(all_probs[key])
-
-                # Apply non-max-suppression on final bboxes to get the output bounding boxes
-                new_boxes, new_probs, new_all_prob = non_max_suppression_fast_with_all_probs(bbox, np.array(probs[key]),
-                                                                                             all_prob,
-                                                                                             overlap_thresh=0.2)
-                for jk in range(new_boxes.shape[0]):
-                    (x1, y1, x2, y2) = new_boxes[jk, :]
-                    det = {'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2, 'class': key, 'prob': new_probs[jk],
-                           'all_probs': new_all_prob[jk]}
-                    all_dets.append(det)
-
-            print('Elapsed time = {}'.format(time.time() - st))
             t, p = get_map(all_dets, img_data['bboxes'], (fx, fy))  # p contient les proba de prédiction des classes
             T_all_for_image_conf, P_all_for_image_conf = get_map_all(all_dets, img_data['bboxes'], (fx, fy),
                                                                      class_mapping)
@@ -759,6 +540,37 @@ if __name__ == "__main__":
                         metavar="directory_name",
                         help="Name of the directory in which the processed images will be saved when show_images is "
                              "True")
+    parser.add_argument('--pre_nms_top_n', required=False, default="None",
+                        metavar="Integer/None",
+                        help="Number of rpn proposals with the highest objectness kept before the non-max-suppression "
+                             "(None to keep all of them)")
+    parser.add_argument('--min_objectness', required=False, default=0.0,
+                        metavar="Value from 0 to 1",
+                        help="Rpn proposals with a lower objectness are dropped before the non-max-suppression")
+    parser.add_argument('--batched_roi_pooling', required=False, default="False",
+                        metavar="True/False",
+                        help="Pool all the rois at once instead of one resize per roi (same pooled features)")
+    parser.add_argument('--batch_size', required=False, default=1,
+                        metavar="Integer",
+                        help="Number of images going through the base network and the RPN in one call (only the images "
+                             "of the same size share a call, so the detections do not depend on it)")
+    parser.add_argument('--prefetch', required=False, default=4,
+                        metavar="Integer",
+                        help="Number of images read and pre-processed ahead while the network runs (0 to disable)")
+    parser.add_argument('--prefetch_workers', required=False, default=2,
+                        metavar="Integer",
+                        help="Number of threads reading and pre-processing the images")
+    parser.add_argument('--image_cache', required=False, default="None",
+                        metavar="/path/to/image/cache/",
+                        help="Directory of the cache of resized and pre-processed images read when evaluating the "
+                             "model (None to read the images from the dataset)")
+    parser.add_argument('--backend', required=False, default="keras",
+                        metavar="keras/bundle/tflite/onnx",
+                        help="Runtime of the networks: keras, or the models exported by bundle_export.py (bundle), by "
+                             "tflite_export.py (tflite) or by onnx_export.py (onnx)")
+    parser.add_argument('--num_threads', required=False, default="None",
+                        metavar="Integer/None",
+                        help="Number of threads of the tflite and onnx backends (None for their default)")
 
     args = parser.parse_args()
 
@@ -772,6 +584,9 @@ if __name__ == "__main__":
     histogram_equalization = eval(args.histogram_equalization)
     gamma_correction = eval(args.gamma_correction)
     processed_directory = args.processed_directory
+    batch_size = int(args.batch_size)
+    prefetch = int(args.prefetch)
+    prefetch_workers = int(args.prefetch_workers)
 
     try:
         os.mkdir('predictions/{}'.format(processed_directory))
@@ -793,7 +608,7 @@ if __name__ == "__main__":
     test_path = args.annotations  # Test data (annotation file)
     data_test_path = args.dataset
 
-    imgs_record_path = "./config/{} - imgs.csv".format(model_name)
+    imgs_record_path = split_record_path(model_name)
 
     # output_results_filename = "./results/{}".format(model_name)
     # if not os.path.exists(output_results_filename):
@@ -812,9 +627,23 @@ if __name__ == "__main__":
     C.rot_90 = False
 
     C.model_path = "./model/{}.hdf5".format(model_name)  # UPDATE WEIGHTS PATH HERE !!!!!!!!
+    C.pre_nms_top_n_test = eval(args.pre_nms_top_n)
+    C.min_objectness_test = float(args.min_objectness)
+    C.batched_roi_pooling = eval(args.batched_roi_pooling)
+
+    if args.image_cache == "None":
+        image_cache = None
+    else:
+        image_cache = ImageCache(args.image_cache, C.im_size,
+                                 variant=image_cache_variant(noise_reduction, histogram_equalization,
+                                                             gamma_correction, C.gamma_value,
+                                                             C.noise_reduction_shape),
+                                 preprocess=lambda img: preprocess_img(img, noise_reduction, histogram_equalization,
+                                                                       gamma_correction))
 
     # record_df = plot_some_graphs(C)
-    model_rpn, class_mapping, model_classifier_only = init_models()
+    detector = Detector(C, backend=args.backend, num_threads=eval(args.num_threads))
+    class_mapping = detector.class_mapping
     nbr_classes = len(class_mapping.keys()) - 1
     print(nbr_classes)
 
@@ -1,5 +1,6 @@
 from libraries import *
 from recorder import Recorder
+from split_manifest import save_split_manifest, load_split_imgs, split_record_path
 import pandas as pd
 from multiprocessing import Process, Value
 from sklearn.model_selection import KFold, train_test_split
@@ -7,9 +8,12 @@ from sklearn.model_selection import KFold, train_test_split
 best_loss = 1000000
 a = 6
 
-def train_model(train_imgs, num_epochs, record_filepath, model_rpn, model_classifier, model_all):
+def train_model(train_imgs, num_epochs, record_filepath, model_rpn, model_classifier, model_all, fused_step=None):
     recorder = Recorder(record_filepath)
+    train_imgs = use_image_cache(train_imgs, C)
     losses = np.zeros((len(train_imgs), 5))
+    # worker processes preparing the samples, or images kept in memory, for every epoch (if any)
+    data_pool = get_anchor_gt_pool(C, get_img_output_length, mode='train')
     rpn_accuracy_rpn_monitor = []
     rpn_accuracy_for_epoch = []
 
@@ -18,39 +22,54 @@ def train_model(train_imgs, num_epochs, record_filepath, model_rpn, model_classi
         progbar = generic_utils.Progbar(len(train_imgs))
         print('Epoch {}/{}'.format(epoch_num + 1, num_epochs))
         random.shuffle(train_imgs)
-        data_gen_train = get_anchor_gt(train_imgs, C, get_img_output_length,
-                                       mode='train')  # TODO: tester mode:'augmentation'
-
-        for iter_num in range(len(train_imgs)):
+        data_gen_train = get_anchor_gt_loader(train_imgs, C, get_img_output_length,
+                                              mode='train', pool=data_pool)  # TODO: tester mode:'augmentation'
+
+        num_batches = 0
+        num_imgs = 0
+        for iter_num, batch in enumerate(batch_by_aspect_ratio(data_gen_train, C.batch_size,
+                                                               C.aspect_ratio_bucket_width)):
+            num_batches = iter_num + 1
+            num_imgs += len(batch)
             try:
 
-                # Generate X (x_img) and label Y ([y_rpn_cls, y_rpn_regr])
-                X, Y, img_data, _, _ = next(data_gen_train)
+                # Stack the images X (x_img) and the labels Y ([y_rpn_cls, y_rpn_regr]) of the batch
+                X, Y, img_datas = stack_anchor_gt_batch(batch)
 
-                # Train rpn model and get loss value [_, loss_rpn_cls, loss_rpn_regr]
-                loss_rpn = model_rpn.train_on_batch(X, Y)
-                losses[iter_num, 0] = loss_rpn[1]
-                losses[iter_num, 1] = loss_rpn[2]
+                if fused_step is not None:
+                    # Train the rpn and the classifier in one step [_, loss_rpn_cls, loss_rpn_regr],
+                    # [_, loss_class_cls, loss_class_regr, class_acc] (None without matching bboxes)
+                    loss_rpn, loss_class = fused_step.train_on_batch(X, Y, img_datas, rpn_accuracy_rpn_monitor,
+                                                                     rpn_accuracy_for_epoch)
+                    losses[iter_num, 0] = loss_rpn[1]
+                    losses[iter_num, 1] = loss_rpn[2]
 
-                X2, Y1, Y2, sel_samples = rpn_to_class(X, img_data, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch, model_rpn)
+                    if loss_class is None:
+                        continue
+                else:
+                    # Train rpn model and get loss value [_, loss_rpn_cls, loss_rpn_regr]
+                    loss_rpn = model_rpn.train_on_batch(X, Y)
+                    losses[iter_num, 0] = loss_rpn[1]
+                    losses[iter_num, 1] = loss_rpn[2]
 
-                if X2 is None:
-                    continue
+                    X2, Y1, Y2, img_idx = rpn_to_class(X, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch, model_rpn)
 
-                # training_data: [X, X2[:, sel_samples, :]]
-                # labels: [Y1[:, sel_samples, :], Y2[:, sel_samples, :]]
-                #  X                     => img_data resized image
-                #  X2[:, sel_samples, :] => num_rois (4 in here) bboxes which contains selected neg and pos
-                #  Y1[:, sel_samples, :] => one hot encode for num_rois bboxes which contains selected neg and pos
-                #  Y2[:, sel_samples, :] => labels and gt bboxes for num_rois bboxes which contains selected neg and pos
-                loss_class = model_classifier.train_on_batch([X, X2[:, sel_samples, :]],
-                                                             [Y1[:, sel_samples, :], Y2[:, sel_samples, :]])
+                    if X2 is None:
+                        continue
+
+                    # training_data: [X[img_idx], X2]
+                    # labels: [Y1, Y2]
+                    #  X[img_idx] => resized images of the batch with matching bboxes
+                    #  X2         => num_rois (4 in here) bboxes per image which contains selected neg and pos
+                    #  Y1         => one hot encode for num_rois bboxes which contains selected neg and pos
+                    #  Y2         => labels and gt bboxes for num_rois bboxes which contains selected neg and pos
+                    loss_class = model_classifier.train_on_batch([X[img_idx], X2], [Y1, Y2])
 
                 losses[iter_num, 2] = loss_class[1]
                 losses[iter_num, 3] = loss_class[2]
                 losses[iter_num, 4] = loss_class[3]
 
-                progbar.update(iter_num + 1,
+                progbar.update(num_imgs,
                                [('rpn_cls', np.mean(losses[:iter_num + 1, 0])),
                                 ('rpn_regr', np.mean(losses[:iter_num + 1, 1])),
                                 ('final_cls', np.mean(losses[:iter_num + 1, 2])),
@@ -64,11 +83,14 @@ def train_model(train_imgs, num_epochs, record_filepath, model_rpn, model_classi
                 print('Exception: {}'.format(e))
                 continue
 
-        loss_rpn_cls = np.mean(losses[:, 0])
-        loss_rpn_regr = np.mean(losses[:, 1])
-        loss_class_cls = np.mean(losses[:, 2])
-        loss_class_regr = np.mean(losses[:, 3])
-        class_acc = np.mean(losses[:, 4])
+        # stop preparing the samples of the epoch
+        data_gen_train.close()
+
+        loss_rpn_cls = np.mean(losses[:num_batches, 0])
+        loss_rpn_regr = np.mean(losses[:num_batches, 1])
+        loss_class_cls = np.mean(losses[:num_batches, 2])
+        loss_class_regr = np.mean(losses[:num_batches, 3])
+        class_acc = np.mean(losses[:num_batches, 4])
 
         if len(rpn_accuracy_for_epoch) == 0:
             mean_overlapping_bboxes = 0
@@ -88,18 +110,27 @@ def train_model(train_imgs, num_epochs, record_filepath, model_rpn, model_classi
             print('Loss Detector regression: {}'.format(loss_class_regr))
             print('Total loss: {}'.format(curr_loss))
             print('Elapsed time: {}'.format(elapsed_time))
+            stats = cache_stats(data_pool)
+            print('Anchor grid cache: {} hits, {} misses'.format(stats['anchor_grid_hits'], stats['anchor_grid_misses']))
+            print('RPN target cache: {} hits, {} misses, {} evictions ({:.1f} MB)'.format(
+                stats['rpn_target_hits'], stats['rpn_target_misses'], stats['rpn_target_evictions'],
+                stats['rpn_target_nbytes'] / 2 ** 20))
 
         model_all.save_weights(C.temp_model_path)
         recorder.add_new_entry(class_acc, loss_rpn_cls, loss_rpn_regr, loss_class_cls, loss_class_regr,
                                curr_loss, elapsed_time)
 
+    if data_pool is not None:
+        data_pool.close()
+
     # recorder.show_graphs()
     recorder.save_graphs()
     model_all.save_weights(C.model_path)
     os.remove(C.temp_model_path)
 
 
-def val_model(train_imgs, val_imgs, param, paramNames, record_path, validation_code, model_rpn, model_classifier, model_all):
+def val_model(train_imgs, val_imgs, param, paramNames, record_path, validation_code, model_rpn, model_classifier, model_all,
+              fused_step=None):
     global last_epoch
 
     for i in range(len(paramNames)):
@@ -119,8 +150,12 @@ def val_model(train_imgs, val_imgs, param, paramNames, record_path, validation_c
             pass
 
     recorder = Recorder(os.path.join(record_path, validation_code), has_validation=True)
+    train_imgs = use_image_cache(train_imgs, C)
+    val_imgs = use_image_cache(val_imgs, C)
     losses = np.zeros((len(train_imgs), 5))
     losses_val = np.zeros((len(val_imgs), 5))
+    # worker processes preparing the samples, or images kept in memory, for every epoch and validation phase (if any)
+    data_pool = get_anchor_gt_pool(C, get_img_output_length, mode='train')
     best_loss_val = float('inf')
     curr_loss_val = float('inf')
     best_epoch = -1
@@ -134,38 +169,53 @@ def val_model(train_imgs, val_imgs, param, paramNames, record_path, validation_c
         rpn_accuracy_for_epoch = []
         print('Epoch {}/{}'.format(epoch_num + 1, num_epochs))
 
-        data_gen_train = get_anchor_gt(train_imgs, C, get_img_output_length, mode='train')
+        data_gen_train = get_anchor_gt_loader(train_imgs, C, get_img_output_length, mode='train', pool=data_pool)
 
-        for iter_num in range(len(train_imgs)):
+        num_batches = 0
+        num_imgs = 0
+        for iter_num, batch in enumerate(batch_by_aspect_ratio(data_gen_train, C.batch_size,
+                                                               C.aspect_ratio_bucket_width)):
+            num_batches = iter_num + 1
+            num_imgs += len(batch)
             try:
 
-                # Generate X (x_img) and label Y ([y_rpn_cls, y_rpn_regr])
-                X, Y, img_data, _, _ = next(data_gen_train)
+                # Stack the images X (x_img) and the labels Y ([y_rpn_cls, y_rpn_regr]) of the batch
+                X, Y, img_datas = stack_anchor_gt_batch(batch)
 
-                # Train rpn model and get loss value [_, loss_rpn_cls, loss_rpn_regr]
-                loss_rpn = model_rpn.train_on_batch(X, Y)
-                losses[iter_num, 0] = loss_rpn[1]
-                losses[iter_num, 1] = loss_rpn[2]
+                if fused_step is not None:
+                    # Train the rpn and the classifier in one step [_, loss_rpn_cls, loss_rpn_regr],
+                    # [_, loss_class_cls, loss_class_regr, class_acc] (None without matching bboxes)
+                    loss_rpn, loss_class = fused_step.train_on_batch(X, Y, img_datas, rpn_accuracy_rpn_monitor,
+                                                                     rpn_accuracy_for_epoch)
+                    losses[iter_num, 0] = loss_rpn[1]
+                    losses[iter_num, 1] = loss_rpn[2]
 
-                X2, Y1, Y2, sel_samples = rpn_to_class(X, img_data, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch, model_rpn)
+                    if loss_class is None:
+                        continue
+                else:
+                    # Train rpn model and get loss value [_, loss_rpn_cls, loss_rpn_regr]
+                    loss_rpn = model_rpn.train_on_batch(X, Y)
+                    losses[iter_num, 0] = loss_rpn[1]
+                    losses[iter_num, 1] = loss_rpn[2]
 
-                if X2 is None:
-                    continue
+                    X2, Y1, Y2, img_idx = rpn_to_class(X, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch, model_rpn)
 
-                # training_data: [X, X2[:, sel_samples, :]]
-                # labels: [Y1[:, sel_samples, :], Y2[:, sel_samples, :]]
-                #  X                     => img_data resized image
-                #  X2[:, sel_samples, :] => num_rois (4 in here) bboxes which contains selected neg and pos
-                #  Y1[:, sel_samples, :] => one hot encode for num_rois bboxes which contains selected neg and pos
-                #  Y2[:, sel_samples, :] => labels and gt bboxes for num_rois bboxes which contains selected neg and pos
-                loss_class = model_classifier.train_on_batch([X, X2[:, sel_samples, :]],
-                                                             [Y1[:, sel_samples, :], Y2[:, sel_samples, :]])
+                    if X2 is None:
+                        continue
+
+                    # training_data: [X[img_idx], X2]
+                    # labels: [Y1, Y2]
+                    #  X[img_idx] => resized images of the batch with matching bboxes
+                    #  X2         => num_rois (4 in here) bboxes per image which contains selected neg and pos
+                    #  Y1         => one hot encode for num_rois bboxes which contains selected neg and pos
+                    #  Y2         => labels and gt bboxes for num_rois bboxes which contains selected neg and pos
+                    loss_class = model_classifier.train_on_batch([X[img_idx], X2], [Y1, Y2])
 
                 losses[iter_num, 2] = loss_class[1]
                 losses[iter_num, 3] = loss_class[2]
                 losses[iter_num, 4] = loss_class[3]
 
-                progbar.update(iter_num + 1,
+                progbar.update(num_imgs,
                                [('rpn_cls', np.mean(losses[:iter_num + 1, 0])),
                                 ('rpn_regr', np.mean(losses[:iter_num + 1, 1])),
                                 ('final_cls', np.mean(losses[:iter_num + 1, 2])),
@@ -179,11 +229,14 @@ def val_model(train_imgs, val_imgs, param, paramNames, record_path, validation_c
                 print('Exception: {}'.format(e))
                 continue
 
-        loss_rpn_cls = np.mean(losses[:, 0])
-        loss_rpn_regr = np.mean(losses[:, 1])
-        loss_class_cls = np.mean(losses[:, 2])
-        loss_class_regr = np.mean(losses[:, 3])
-        class_acc = np.mean(losses[:, 4])
+        # stop preparing the samples of the epoch
+        data_gen_train.close()
+
+        loss_rpn_cls = np.mean(losses[:num_batches, 0])
+        loss_rpn_regr = np.mean(losses[:num_batches, 1])
+        loss_class_cls = np.mean(losses[:num_batches, 2])
+        loss_class_regr = np.mean(losses[:num_batches, 3])
+        class_acc = np.mean(losses[:num_batches, 4])
 
         if len(rpn_accuracy_for_epoch) == 0:
             mean_overlapping_bboxes = 0
@@ -203,38 +256,54 @@ def val_model(train_imgs, val_imgs, param, paramNames, record_path, validation_c
             print('Loss Detector regression: {}'.format(loss_class_regr))
             print('Total loss: {}'.format(curr_loss))
             print('Elapsed time: {}'.format(elapsed_time))
+            stats = cache_stats(data_pool)
+            print('Anchor grid cache: {} hits, {} misses'.format(stats['anchor_grid_hits'], stats['anchor_grid_misses']))
+            print('RPN target cache: {} hits, {} misses, {} evictions ({:.1f} MB)'.format(
+                stats['rpn_target_hits'], stats['rpn_target_misses'], stats['rpn_target_evictions'],
+                stats['rpn_target_nbytes'] / 2 ** 20))
 
         print('Start of the validation phase')
-        data_gen_val = get_anchor_gt(val_imgs, C, get_img_output_length, mode='train')
-
-        for iter_num_val in range(len(val_imgs)):
+        data_gen_val = get_anchor_gt_loader(val_imgs, C, get_img_output_length, mode='train', pool=data_pool)
+
+        num_batches_val = 0
+        num_imgs_val = 0
+        for iter_num_val, batch_val in enumerate(batch_by_aspect_ratio(data_gen_val, C.batch_size,
+                                                                       C.aspect_ratio_bucket_width)):
+            num_batches_val = iter_num_val + 1
+            num_imgs_val += len(batch_val)
             try:
-                # Generate X (x_img) and label Y ([y_rpn_cls, y_rpn_regr])
-                X_val, Y_val, img_data_val, _, _ = next(data_gen_val)
-                loss_rpn_val = model_rpn.test_on_batch(X_val, Y_val)
-                losses_val[iter_num_val, 0] = loss_rpn_val[1]
-                losses_val[iter_num_val, 1] = loss_rpn_val[2]
+                # Stack the images X (x_img) and the labels Y ([y_rpn_cls, y_rpn_regr]) of the batch
+                X_val, Y_val, img_datas_val = stack_anchor_gt_batch(batch_val)
+                if fused_step is not None:
+                    loss_rpn_val, loss_class_val = fused_step.test_on_batch(X_val, Y_val, img_datas_val, [], [])
+                    losses_val[iter_num_val, 0] = loss_rpn_val[1]
+                    losses_val[iter_num_val, 1] = loss_rpn_val[2]
+
+                    if loss_class_val is None:
+                        continue
+                else:
+                    loss_rpn_val = model_rpn.test_on_batch(X_val, Y_val)
+                    losses_val[iter_num_val, 0] = loss_rpn_val[1]
+                    losses_val[iter_num_val, 1] = loss_rpn_val[2]
 
-                X2_val, Y1_val, Y2_val, sel_samples_val = rpn_to_class(X_val, img_data_val, [], [], model_rpn)
+                    X2_val, Y1_val, Y2_val, img_idx_val = rpn_to_class(X_val, img_datas_val, [], [], model_rpn)
 
-                if X2_val is None:
-                    continue
+                    if X2_val is None:
+                        continue
 
-                # training_data: [X, X2[:, sel_samples, :]]
-                # labels: [Y1[:, sel_samples, :], Y2[:, sel_samples, :]]
-                #  X                     => img_data resized image
-                #  X2[:, sel_samples, :] => num_rois (4 in here) bboxes which contains selected neg and pos
-                #  Y1[:, sel_samples, :] => one hot encode for num_rois bboxes which contains selected neg and pos
-                #  Y2[:, sel_samples, :] => labels and gt bboxes for num_rois bboxes which contains selected neg and pos
-                loss_class_val = model_classifier.test_on_batch([X_val, X2_val[:, sel_samples_val, :]],
-                                                                [Y1_val[:, sel_samples_val, :],
-                                                                 Y2_val[:, sel_samples_val, :]])
+                    # training_data: [X[img_idx], X2]
+                    # labels: [Y1, Y2]
+                    #  X[img_idx] => resized images of the batch with matching bboxes
+                    #  X2         => num_rois (4 in here) bboxes per image which contains selected neg and pos
+                    #  Y1         => one hot encode for num_rois bboxes which contains selected neg and pos
+                    #  Y2         => labels and gt bboxes for num_rois bboxes which contains selected neg and pos
+                    loss_class_val = model_classifier.test_on_batch([X_val[img_idx_val], X2_val], [Y1_val, Y2_val])
 
                 losses_val[iter_num_val, 2] = loss_class_val[1]
                 losses_val[iter_num_val, 3] = loss_class_val[2]
                 losses_val[iter_num_val, 4] = loss_class_val[3]
 
-                progbar_val.update(iter_num_val + 1,
+                progbar_val.update(num_imgs_val,
                                    [('rpn_cls_val', np.mean(losses_val[:iter_num_val + 1, 0])),
                                     ('rpn_regr_val', np.mean(losses_val[:iter_num_val + 1, 1])),
                                     ('final_cls_val', np.mean(losses_val[:iter_num_val + 1, 2])),
@@ -248,13 +317,14 @@ def val_model(train_imgs, val_imgs, param, paramNames, record_path, validation_c
                 print('Exception: {}'.format(e))
                 continue
 
+        data_gen_val.close()
         print('End of the validation phase')
 
-        loss_rpn_cls_val = np.mean(losses_val[:, 0])
-        loss_rpn_regr_val = np.mean(losses_val[:, 1])
-        loss_class_cls_val = np.mean(losses_val[:, 2])
-        loss_class_regr_val = np.mean(losses_val[:, 3])
-        class_acc_val = np.mean(losses_val[:, 4])
+        loss_rpn_cls_val = np.mean(losses_val[:num_batches_val, 0])
+        loss_rpn_regr_val = np.mean(losses_val[:num_batches_val, 1])
+        loss_class_cls_val = np.mean(losses_val[:num_batches_val, 2])
+        loss_class_regr_val = np.mean(losses_val[:num_batches_val, 3])
+        class_acc_val = np.mean(losses_val[:num_batches_val, 4])
         curr_loss_val = loss_rpn_cls_val + loss_rpn_regr_val + loss_class_cls_val + loss_class_regr_val
 
         if C.verbose:
@@ -286,20 +356,71 @@ def val_model(train_imgs, val_imgs, param, paramNames, record_path, validation_c
                                                loss_rpn_cls_val, loss_rpn_regr_val, loss_class_cls_val,
                                                loss_class_regr_val, curr_loss_val, best_loss_val)
 
+    if data_pool is not None:
+        data_pool.close()
+
     # recorder.show_graphs()
     recorder.save_graphs()
     return curr_loss_val, best_loss_val, best_epoch
 
 
-def rpn_to_class(X, img_data, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch, model_rpn):
+def rpn_to_class(X, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch, model_rpn):
+    """Select the rois of the classifier among the rpn proposals of a batch of images
+
+    Args:
+        X: shape=(batch_size, rows, cols, 3), images stacked by stack_anchor_gt_batch
+        img_datas: augmented image data of the images
+
+    Returns:
+        X2, Y1, Y2, img_idx of sample_batch_rois
+    """
     # Get predicted rpn from rpn model [rpn_cls, rpn_regr]
     P_rpn = model_rpn.predict_on_batch(X)
 
+    return sample_batch_rois(P_rpn, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch)
+
+
+def sample_batch_rois(P_rpn, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch):
+    """Select the rois of the classifier among the rpn proposals of a batch of images
+
+    Args:
+        P_rpn: [rpn_cls, rpn_regr] outputs of the rpn on the images of the batch
+        img_datas: augmented image data of the images
+
+    Returns:
+        X2: shape=(n, num_rois, 4) rois of the n images of the batch with matching bboxes, None if n = 0
+        Y1: shape=(n, num_rois, nb_classes) one hot code of their classes
+        Y2: shape=(n, num_rois, 8*(nb_classes-1)) labels and regression targets
+        img_idx: indices of the n images in the batch
+    """
+    X2_batch, Y1_batch, Y2_batch, img_idx = [], [], [], []
+    for i, img_data in enumerate(img_datas):
+        # Keep the part of the outputs computed on the image, not on the padding
+        (resized_width, resized_height) = get_new_img_size(img_data['width'], img_data['height'], C.im_size)
+        (cols, rows) = get_img_output_length(resized_width, resized_height)
+
+        samples = sample_rois(P_rpn[0][i:i + 1, :rows, :cols], P_rpn[1][i:i + 1, :rows, :cols], img_data,
+                              rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch)
+        if samples is None:
+            continue
+
+        (X2, Y1, Y2, sel_samples) = samples
+        X2_batch.append(X2[0, sel_samples, :])
+        Y1_batch.append(Y1[0, sel_samples, :])
+        Y2_batch.append(Y2[0, sel_samples, :])
+        img_idx.append(i)
+
+    if len(img_idx) == 0:
+        return None, None, None, None
+
+    return np.stack(X2_batch), np.stack(Y1_batch), np.stack(Y2_batch), img_idx
+
+
+def sample_rois(rpn_cls, rpn_regr, img_data, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch):
     # R: bboxes (shape=(300,4))
     # Convert rpn layer to roi bboxes
-    R = rpn_to_roi(P_rpn[0], P_rpn[1], C, K.image_data_format(), use_regr=True, overlap_thresh=0.7,
-                   max_boxes=300)
-
+    R = rpn_to_roi(rpn_cls, rpn_regr, C, K.image_data_format(), use_regr=True, overlap_thresh=0.7,
+                   max_boxes=300, mode='train')
     # note: calc_iou converts from (x1,y1,x2,y2) to (x,y,w,h) format
     # X2: bboxes that iou > C.classifier_min_overlap for all gt bboxes in 300 non_max_suppression bboxes
     # Y1: one hot code for bboxes from above => x_roi (X)
@@ -310,7 +431,7 @@ def rpn_to_class(X, img_data, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch,
     if X2 is None:
         rpn_accuracy_rpn_monitor.append(0)
         rpn_accuracy_for_epoch.append(0)
-        return None, None, None, None
+        return None
 
     # Find out the positive anchors and negative anchors
     neg_samples = np.where(Y1[0, :, -1] == 1)
@@ -352,19 +473,188 @@ def rpn_to_class(X, img_data, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch,
         selected_pos_samples = pos_samples.tolist()
         selected_neg_samples = neg_samples.tolist()
         if np.random.randint(0, 2):
-            sel_samples = random.choice(neg_samples)
+            sel_samples = [random.choice(neg_samples)]
         else:
-            sel_samples = random.choice(pos_samples)
+            sel_samples = [random.choice(pos_samples)]
 
     return X2, Y1, Y2, sel_samples
 
 
+class FusedTrainStep:
+    """Training step of the RPN and of the classifier running the base network once
+
+    The separate step runs the base network three times per batch (model_rpn.train_on_batch, the predict_on_batch of
+    rpn_to_class and model_classifier.train_on_batch). Here the feature map and the rpn outputs are computed once
+    under a tf.GradientTape, the rois of the classifier are sampled from these rpn outputs (sample_batch_rois), the
+    classifier runs on the same feature map, and the gradient of the sum of the rpn and classifier losses is applied
+    in one Adam update. As in the separate step, no gradient flows through the selection of the rois.
+
+    With in_graph_rois, the rois are selected by sample_batch_rois_tf instead of sample_batch_rois (NumPy), so the
+    losses and their gradient are computed by a single tf.function, without copying the rpn outputs to NumPy.
+
+    Args:
+        model_features: model of the images giving [feature map, rpn_cls, rpn_regr]
+        model_classifier_head: classifier of [feature map, rois], sharing its layers with model_classifier
+        num_anchors: number of anchors (9 in here)
+        nb_classes: number of classes, including 'bg'
+        lr: learning rate of the Adam optimizer
+        in_graph_rois: True to select the rois of the classifier in the graph of the step
+    """
+
+    def __init__(self, model_features, model_classifier_head, num_anchors, nb_classes, lr=1e-5, in_graph_rois=False):
+        self.model_features = model_features
+        self.model_classifier_head = model_classifier_head
+        self.nb_classes = nb_classes
+        self.in_graph_rois = in_graph_rois
+        # the losses run in graphs as in the compiled models, which round them slightly differently than eager ops
+        rpn_spec = [tf.TensorSpec((None, None, None, None), K.floatx())] * 2
+        class_spec = [tf.TensorSpec((None, None, None), K.floatx())] * 2
+        self.rpn_losses = [tf.function(loss, input_signature=rpn_spec)
+                           for loss in [rpn_loss_cls(num_anchors), rpn_loss_regr(num_anchors)]]
+        self.class_losses = [tf.function(loss, input_signature=class_spec)
+                             for loss in [class_loss_cls, class_loss_regr(nb_classes - 1)]]
+        self.optimizer = Adam(lr=lr)
+
+        # the weights of the base layers are in both models
+        weights = model_features.trainable_weights + model_classifier_head.trainable_weights
+        self.trainable_weights = list(OrderedDict((id(weight), weight) for weight in weights).values())
+        feature_weights = set(id(weight) for weight in model_features.trainable_weights)
+        self.classifier_weights = set(id(weight) for weight in self.trainable_weights
+                                      if id(weight) not in feature_weights)
+
+        # images, rpn targets and GT bboxes of feature_map_gt_batch
+        graph_spec = ([tf.TensorSpec((None, None, None, 3), K.floatx())] + rpn_spec +
+                      [tf.TensorSpec((None, 2), tf.int32), tf.TensorSpec((None, None, 4), tf.float64),
+                       tf.TensorSpec((None, None), tf.int32)])
+        self.graph_train_step = tf.function(self.graph_gradients, input_signature=graph_spec)
+        self.graph_test_step = tf.function(lambda *inputs: self.graph_losses(*inputs, training=False),
+                                           input_signature=graph_spec)
+
+    def losses(self, X, Y, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch, training):
+        """rpn losses, and classifier losses and accuracy (None if no roi of the batch matches a bbox)"""
+        (feature_map, rpn_cls, rpn_regr) = self.model_features(X, training=training)
+        rpn_losses = [loss(y_true, y_pred) for loss, y_true, y_pred in zip(self.rpn_losses, Y, [rpn_cls, rpn_regr])]
+
+        X2, Y1, Y2, img_idx = sample_batch_rois([rpn_cls.numpy(), rpn_regr.numpy()], img_datas,
+                                                rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch)
+        if X2 is None:
+            return rpn_losses, None, None
+        # cast as the inputs of train_on_batch
+        (X2, Y1, Y2) = (X2.astype(K.floatx()), Y1.astype(K.floatx()), Y2.astype(K.floatx()))
+
+        (out_class, out_regr) = self.model_classifier_head([tf.gather(feature_map, img_idx), X2], training=training)
+        class_losses = [loss(y_true, y_pred) for loss, y_true, y_pred in zip(self.class_losses, [Y1, Y2],
+                                                                             [out_class, out_regr])]
+        class_acc = K.mean(K.cast(K.equal(K.argmax(Y1, axis=-1), K.argmax(out_class, axis=-1)), K.floatx()))
+        return rpn_losses, class_losses, class_acc
+
+    def graph_losses(self, X, y_rpn_cls, y_rpn_regr, feature_sizes, gt_boxes, gt_classes, training):
+        """losses with the rois selected in the graph
+
+        Returns:
+            rpn_losses, class_losses, class_acc: as losses, the classifier losses and accuracy being 0 if no roi of
+                the batch matches a bbox
+            has_rois: True if some roi of the batch matches a bbox
+            num_pos: number of positive rois of every image
+        """
+        (feature_map, rpn_cls, rpn_regr) = self.model_features(X, training=training)
+        rpn_losses = [loss(y_true, y_pred) for loss, y_true, y_pred in zip(self.rpn_losses, [y_rpn_cls, y_rpn_regr],
+                                                                           [rpn_cls, rpn_regr])]
+
+        X2, Y1, Y2, img_idx, num_pos = sample_batch_rois_tf(tf.stop_gradient(rpn_cls), tf.stop_gradient(rpn_regr),
+                                                            feature_sizes, gt_boxes, gt_classes, C, self.nb_classes)
+        has_rois = tf.size(img_idx) > 0
+
+        def classifier_losses():
+            (out_class, out_regr) = self.model_classifier_head([tf.gather(feature_map, img_idx), X2],
+                                                               training=training)
+            class_losses = [loss(y_true, y_pred) for loss, y_true, y_pred in zip(self.class_losses, [Y1, Y2],
+                                                                                 [out_class, out_regr])]
+            class_acc = K.mean(K.cast(K.equal(K.argmax(Y1, axis=-1), K.argmax(out_class, axis=-1)), K.floatx()))
+            return class_losses + [class_acc]
+
+        (loss_class_cls, loss_class_regr, class_acc) = tf.cond(has_rois, classifier_losses,
+                                                               lambda: [tf.zeros((), K.floatx())] * 3)
+        return rpn_losses, [loss_class_cls, loss_class_regr], class_acc, has_rois, num_pos
+
+    def graph_gradients(self, *inputs):
+        """graph_losses of a training step and their gradient"""
+        with tf.GradientTape() as tape:
+            outputs = self.graph_losses(*inputs, training=True)
+            loss = tf.add_n(outputs[0] + outputs[1])
+        return outputs + (tape.gradient(loss, self.trainable_weights),)
+
+    def run_graph_step(self, graph_step, X, Y, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch):
+        """Run graph_train_step or graph_test_step on a batch of stack_anchor_gt_batch
+
+        Returns:
+            rpn_losses, class_losses, class_acc: as losses
+            gradients: gradient of the loss (training step only), None for the classifier layers if no roi of the
+                batch matches a bbox
+        """
+        feature_sizes, gt_boxes, gt_classes = feature_map_gt_batch(img_datas, C, class_mapping)
+        outputs = graph_step(np.asarray(X, K.floatx()), np.asarray(Y[0], K.floatx()), np.asarray(Y[1], K.floatx()),
+                             feature_sizes, gt_boxes, gt_classes)
+        (rpn_losses, class_losses, class_acc, has_rois, num_pos) = outputs[:5]
+        gradients = outputs[5] if len(outputs) > 5 else None
+
+        rpn_accuracy_rpn_monitor.extend(num_pos.numpy().tolist())
+        rpn_accuracy_for_epoch.extend(num_pos.numpy().tolist())
+
+        if not has_rois:
+            class_losses = None
+            if gradients is not None:
+                gradients = [None if id(weight) in self.classifier_weights else gradient
+                             for gradient, weight in zip(gradients, self.trainable_weights)]
+        return rpn_losses, class_losses, class_acc, gradients
+
+    def train_on_batch(self, X, Y, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch):
+        """Train the RPN and the classifier on a batch of stack_anchor_gt_batch
+
+        Returns:
+            loss_rpn: [loss, loss_rpn_cls, loss_rpn_regr], as model_rpn.train_on_batch
+            loss_class: [loss, loss_class_cls, loss_class_regr, class_acc], as model_classifier.train_on_batch, None
+                if no roi of the batch matches a bbox (the RPN is still trained)
+        """
+        if self.in_graph_rois:
+            (rpn_losses, class_losses, class_acc, gradients) = self.run_graph_step(
+                self.graph_train_step, X, Y, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch)
+        else:
+            with tf.GradientTape() as tape:
+                (rpn_losses, class_losses, class_acc) = self.losses(X, Y, img_datas, rpn_accuracy_rpn_monitor,
+                                                                    rpn_accuracy_for_epoch, training=True)
+                loss = tf.add_n(rpn_losses + (class_losses or []))
+            gradients = tape.gradient(loss, self.trainable_weights)
+
+        # without rois, the classifier layers get no gradient
+        self.optimizer.apply_gradients([(gradient, weight) for gradient, weight in zip(gradients, self.trainable_weights)
+                                        if gradient is not None])
+        return self.loss_values(rpn_losses, class_losses, class_acc)
+
+    def test_on_batch(self, X, Y, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch):
+        """Losses of train_on_batch, without training"""
+        if self.in_graph_rois:
+            return self.loss_values(*self.run_graph_step(self.graph_test_step, X, Y, img_datas,
+                                                         rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch)[:3])
+        return self.loss_values(*self.losses(X, Y, img_datas, rpn_accuracy_rpn_monitor, rpn_accuracy_for_epoch,
+                                             training=False))
+
+    @staticmethod
+    def loss_values(rpn_losses, class_losses, class_acc):
+        rpn_losses = [float(loss) for loss in rpn_losses]
+        loss_rpn = [sum(rpn_losses)] + rpn_losses
+        if class_losses is None:
+            return loss_rpn, None
+        class_losses = [float(loss) for loss in class_losses]
+        return loss_rpn, [sum(class_losses)] + class_losses + [float(class_acc)]
+
+
 """
     Define the base network (VGG)
 """
 
 
-def initialize_model():
+def initialize_model(lr=1e-5):
     img_input = Input(shape=(None, None, 3))
     roi_input = Input(shape=(None, 4))
     shared_layers = nn_base(img_input, trainable=True)
@@ -373,7 +663,9 @@ def initialize_model():
     # Define the RPN, built on the base layers
     rpn = rpn_layer(shared_layers, num_anchors)
 
-    classifier = classifier_layer(shared_layers, roi_input, C.num_rois, nb_classes=len(classes_count))
+    classifier_head = classifier_layers(C.num_rois, nb_classes=len(classes_count),
+                                        batched_pooling=getattr(C, 'batched_roi_pooling', False))
+    classifier = classifier_layer(shared_layers, roi_input, C.num_rois, layers=classifier_head)
 
     base_model_rpn = Model(img_input, rpn[:2])
     base_model_classifier = Model([img_input, roi_input], classifier)
@@ -387,12 +679,24 @@ def initialize_model():
     except Exception as e:
         print('Exception: {}'.format(e))
 
-    base_model_rpn.compile(optimizer=Adam(lr=1e-5), loss=[rpn_loss_cls(num_anchors), rpn_loss_regr(num_anchors)])
-    base_model_classifier.compile(optimizer=Adam(lr=1e-5),
+    base_model_rpn.compile(optimizer=Adam(lr=lr), loss=[rpn_loss_cls(num_anchors), rpn_loss_regr(num_anchors)])
+    base_model_classifier.compile(optimizer=Adam(lr=lr),
                                   loss=[class_loss_cls, class_loss_regr(len(classes_count) - 1)],
                                   metrics={'dense_class_{}'.format(len(classes_count)): 'accuracy'})
     base_model_all.compile(optimizer='sgd', loss='mae')
-    return base_model_all, base_model_rpn, base_model_classifier
+
+    # The fused training step runs the classifier on the feature map of the base layers (same layers and weights)
+    fused_step = None
+    if getattr(C, 'fused_training', False):
+        feature_map_input = Input(shape=(None, None, 512))
+        model_features = Model(img_input, [shared_layers] + rpn[:2])
+        model_classifier_head = Model([feature_map_input, roi_input],
+                                      classifier_layer(feature_map_input, roi_input, C.num_rois,
+                                                       layers=classifier_head))
+        fused_step = FusedTrainStep(model_features, model_classifier_head, num_anchors, len(classes_count), lr=lr,
+                                    in_graph_rois=getattr(C, 'in_graph_rois', False))
+
+    return base_model_all, base_model_rpn, base_model_classifier, fused_step
 
 
 def split_imgs(imgs, val_split, test_split):
@@ -423,14 +727,14 @@ def run_validation_phase(best_loss_val):
         config = tf.compat.v1.ConfigProto(device_count={'GPU': 0})
         session = tf.compat.v1.InteractiveSession(config=config)
 
-    model_all, model_rpn, model_classifier = initialize_model()
+    model_all, model_rpn, model_classifier, fused_step = initialize_model()
 
     print("Best loss: {}".format(best_loss))
     print("=== Validation step code: {}".format(validation_code))
     curr_loss_val, best_loss_val.value, best_epoch = val_model(train_imgs, val_imgs,
                                                          params, paramNames,
                                                          record_path, validation_code,
-                                                         model_rpn, model_classifier, model_all)
+                                                         model_rpn, model_classifier, model_all, fused_step)
 
     K.clear_session()
     tf.keras.backend.clear_session()
@@ -474,6 +778,49 @@ if __name__ == "__main__":
     parser.add_argument('--use_gpu', required=False, default="True",
                         metavar="True/False",
                         help="True if you want to run the training on a gpu, False otherwise")
+    parser.add_argument('--data_workers', required=False, default=0,
+                        metavar="Integer",
+                        help="Number of processes preparing the training samples (0 to prepare them in the training "
+                             "process)")
+    parser.add_argument('--data_prefetch', required=False, default=8,
+                        metavar="Integer",
+                        help="Number of training samples prepared ahead by the data workers")
+    parser.add_argument('--data_pipeline', required=False, default='python',
+                        metavar="python/tf.data",
+                        help="python to prepare the training samples with the get_anchor_gt generator (in "
+                             "--data_workers processes), tf.data to prepare them with a tf.data pipeline "
+                             "(--data_workers images in parallel, all the cores if 0)")
+    parser.add_argument('--data_cache', required=False, default="False",
+                        metavar="True/False",
+                        help="True to keep the images read in memory for the next epochs (tf.data pipeline), "
+                             "rows x cols x 3 bytes per image: use it with --image_cache")
+    parser.add_argument('--rpn_target_cache', required=False, default=256,
+                        metavar="Size in MB",
+                        help="Memory budget of the cache of the rpn targets of the augmented images (0 to disable it), "
+                             "shared between the --data_workers processes")
+    parser.add_argument('--image_cache', required=False, default="None",
+                        metavar="/path/to/image/cache/",
+                        help="Directory of the cache of resized images read during the training (None to read the "
+                             "images from the dataset)")
+    parser.add_argument('--batch_size', required=False, default=1,
+                        metavar="Integer",
+                        help="Number of images per training step, batched by aspect ratio")
+    parser.add_argument('--fused_training', required=False, default="False",
+                        metavar="True/False",
+                        help="True to train the rpn and the classifier in one step computing the feature map once, "
+                             "False to train them one after the other")
+    parser.add_argument('--pre_nms_top_n', required=False, default="None",
+                        metavar="Integer/None",
+                        help="Number of rpn proposals with the highest objectness kept before the non-max-suppression "
+                             "when sampling the rois of the classifier (None to keep all of them)")
+    parser.add_argument('--min_objectness', required=False, default=0.0,
+                        metavar="Value from 0 to 1",
+                        help="Rpn proposals with a lower objectness are dropped before the non-max-suppression when "
+                             "sampling the rois of the classifier")
+    parser.add_argument('--in_graph_rois', required=False, default="False",
+                        metavar="True/False",
+                        help="With --fused_training, True to select the rois of the classifier in the TensorFlow graph "
+                             "of the training step, False to select them with NumPy")
     args = parser.parse_args()
 
     use_gpu = eval(args.use_gpu)
@@ -481,17 +828,15 @@ if __name__ == "__main__":
     num_epochs = int(args.num_epochs)
 
     validation_record_path = "./other/logs/{}.csv".format(args.model_name)
-    imgs_record_path = "./config/{} - imgs.csv".format(args.model_name)
+    imgs_record_path = "./config/{} - imgs.npz".format(args.model_name)
 
     last_validation_code = args.validation_code 
 
     if last_validation_code is not None:
         start_from_last_step = True
-        imgs_record_df = pd.read_csv(imgs_record_path)       
         validation_record_df = pd.read_csv(validation_record_path)
     else:
         start_from_last_step = False
-        imgs_record_df = pd.DataFrame(columns=['train', 'val', 'test'])
         validation_record_df = pd.DataFrame(columns=['validation_code', 'curr_loss', 'best_loss', 'best_epoch'])
 
     train_path = args.annotations  # Training data (annotation file)
@@ -525,6 +870,17 @@ if __name__ == "__main__":
     C.model_path = output_weight_path
     C.temp_model_path = output_temp_weight_path
     C.num_rois = num_rois
+    C.data_workers = int(args.data_workers)
+    C.data_prefetch = int(args.data_prefetch)
+    C.data_pipeline = args.data_pipeline
+    C.data_cache = eval(args.data_cache)
+    C.rpn_target_cache_size = float(args.rpn_target_cache)
+    C.image_cache_path = None if args.image_cache == "None" else args.image_cache
+    C.batch_size = int(args.batch_size)
+    C.fused_training = eval(args.fused_training)
+    C.in_graph_rois = eval(args.in_graph_rois)
+    C.pre_nms_top_n_train = eval(args.pre_nms_top_n)
+    C.min_objectness_train = float(args.min_objectness)
 
     C.base_net_weights = base_weight_path
 
@@ -593,16 +949,14 @@ if __name__ == "__main__":
     # combinations = it.product(*(param[Name] for Name in paramNames))
     
     if start_from_last_step:
-        last_row = imgs_record_df.tail(1)
-        train_imgs = ast.literal_eval(last_row['train'].tolist()[0])
-        val_imgs = ast.literal_eval(last_row['val'].tolist()[0])
-        test_imgs = ast.literal_eval(last_row['test'].tolist()[0])
+        split_path = split_record_path(args.model_name)
+        train_imgs = load_split_imgs(split_path, 'train')
+        val_imgs = load_split_imgs(split_path, 'val')
+        test_imgs = load_split_imgs(split_path, 'test')
     else:
         random.shuffle(all_imgs)
         train_imgs, val_imgs, test_imgs = split_imgs(all_imgs, VALIDATION_SPLIT, TESTING_SPLIT)
-        new_row = {'train': train_imgs, 'val': val_imgs, 'test': test_imgs}
-        imgs_record_df = imgs_record_df.append(new_row, ignore_index=True)
-        imgs_record_df.to_csv(imgs_record_path, index=0)
+        save_split_manifest(imgs_record_path, train_imgs, val_imgs, test_imgs)
 
     best_values = {}
 
@@ -638,8 +992,9 @@ if __name__ == "__main__":
 
     else:
         num_epochs = args.num_epochs
-        model_all, model_rpn, model_classifier = initialize_model()
-        train_model(all_imgs, math.ceil(num_epochs), os.path.join(C.record_path, "Training"), model_rpn, model_classifier, model_all)
+        model_all, model_rpn, model_classifier, fused_step = initialize_model()
+        train_model(all_imgs, math.ceil(num_epochs), os.path.join(C.record_path, "Training"), model_rpn, model_classifier, model_all,
+                    fused_step)
 
     tf.keras.backend.clear_session()
     print('Training complete, exiting.')
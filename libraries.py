@@ -11,6 +11,14 @@ import pickle
 import math
 import cv2
 import copy
+import json
+import struct
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import threading
+from queue import Empty, Full
 from matplotlib import pyplot as plt
 import tensorflow as tf
 import pandas as pd
@@ -75,6 +83,24 @@ class Config:
         # number of ROIs at once
         self.num_rois = 4
 
+        # pool all the ROIs at once with BatchedRoiPooling instead of one resize per ROI (same pooled features as
+        # RoiPoolingConv)
+        self.batched_roi_pooling = False
+
+        # number of images per training step, grouped by aspect ratio (see batch_by_aspect_ratio)
+        self.batch_size = 1
+
+        # width of the aspect ratio buckets in log2(width / height): the aspect ratios of the images of a batch
+        # differ by less than a factor 2 ** 0.25 (~19%)
+        self.aspect_ratio_bucket_width = 0.25
+
+        # train the RPN and the classifier in one step computing the feature map once (FusedTrainStep of frcnn_train)
+        self.fused_training = False
+
+        # with the fused training, select the rois of the classifier in the graph of the step (sample_batch_rois_tf)
+        # instead of with NumPy (sample_batch_rois of frcnn_train)
+        self.in_graph_rois = False
+
         # stride at the RPN (this depends on the network configuration)
         self.rpn_stride = 16
 
@@ -92,6 +118,34 @@ class Config:
         self.classifier_min_overlap = 0.1
         self.classifier_max_overlap = 0.5
 
+        # number of processes preparing the training samples (get_anchor_gt_loader), 0 to prepare them in the training
+        # process, and number of samples prepared ahead
+        self.data_workers = 0
+        self.data_prefetch = 8
+
+        # 'python' to prepare the training samples with get_anchor_gt (in C.data_workers processes), 'tf.data' to
+        # prepare them with a tf.data pipeline (AnchorGtDataset, C.data_workers images in parallel, all the cores if
+        # 0), and for the tf.data pipeline, True to keep the images read in memory for the next epochs (ImgDatasetCache,
+        # rows x cols x 3 bytes per image until the end of the training: use it with the image cache, whose images
+        # are resized to C.im_size)
+        self.data_pipeline = 'python'
+        self.data_cache = False
+
+        # memory budget (in MB) of the cache of the rpn targets before sampling (RpnTargetCache), 0 to disable it
+        # (split between the data_workers processes, which have a cache each)
+        self.rpn_target_cache_size = 256
+
+        # directory of the image cache (ImageCache) read by get_anchor_gt, None to read the images from the dataset
+        self.image_cache_path = None
+
+        # filtering of the rpn proposals before the non-max-suppression, for training and for test
+        # only the pre_nms_top_n proposals with the highest objectness are kept (None to keep all of them)
+        self.pre_nms_top_n_train = None
+        self.pre_nms_top_n_test = None
+        # proposals with an objectness lower than min_objectness are dropped
+        self.min_objectness_train = 0.0
+        self.min_objectness_test = 0.0
+
         self.histogram_equalization = False
         self.gamma_correction = False
         self.gamma_value = 4.0
@@ -117,9 +171,158 @@ def adjust_gamma(image, gamma=2.0):
     # apply gamma correction using the lookup table
     return cv2.LUT(image, table)
 
+
+def _jpeg_orientation(exif):
+    """EXIF orientation tag of the TIFF data of an APP1 Exif segment (1 if absent or malformed)"""
+    if exif[:2] == b'II':
+        endian = '<'
+    elif exif[:2] == b'MM':
+        endian = '>'
+    else:
+        return 1
+    try:
+        ifd_offset = struct.unpack(endian + 'I', exif[4:8])[0]
+        (num_entries,) = struct.unpack(endian + 'H', exif[ifd_offset:ifd_offset + 2])
+        for i in range(num_entries):
+            entry = exif[ifd_offset + 2 + 12 * i:ifd_offset + 14 + 12 * i]
+            if len(entry) < 12:
+                break
+            tag, _, _ = struct.unpack(endian + 'HHI', entry[:8])
+            if tag == 0x0112:
+                return struct.unpack(endian + 'H', entry[8:10])[0]
+    except struct.error:
+        # offset past the end of the segment, or truncated IFD
+        pass
+    return 1
+
+
+def read_img_header_size(filepath):
+    """Read the size of a JPEG or PNG image from its header, without decoding it
+
+    The size is the one of the image returned by cv2.imread: the width and the height of a JPEG image are swapped
+    when its EXIF orientation rotates it by 90 degrees.
+
+    Returns:
+        (width, height), or None if the header could not be read (other formats, PNG with EXIF data, truncated or
+        malformed header, ...)
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(8)
+
+            if head == b'\x89PNG\r\n\x1a\n':
+                size = None
+                while True:
+                    chunk = f.read(8)
+                    if len(chunk) < 8:
+                        return None
+                    length, chunk_type = struct.unpack('>I4s', chunk)
+                    if chunk_type == b'IHDR':
+                        size = struct.unpack('>II', f.read(8))
+                        f.seek(length - 8 + 4, 1)
+                    elif chunk_type == b'eXIf':
+                        # the orientation of PNG images is left to cv2.imread
+                        return None
+                    elif chunk_type == b'IDAT':
+                        return size
+                    else:
+                        f.seek(length + 4, 1)
+
+            if head[:2] != b'\xff\xd8':
+                return None
+            f.seek(2)
+            orientation = 1
+            while True:
+                byte = f.read(1)
+                while byte == b'\xff':
+                    byte = f.read(1)
+                if not byte:
+                    return None
+                marker = byte[0]
+                if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                    continue
+                length_bytes = f.read(2)
+                if len(length_bytes) < 2:
+                    return None
+                length = struct.unpack('>H', length_bytes)[0]
+                if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                    # start of frame: precision, height, width
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    if orientation in (5, 6, 7, 8):
+                        return height, width
+                    return width, height
+                segment = f.read(length - 2)
+                if marker == 0xe1 and segment[:6] == b'Exif\x00\x00':
+                    orientation = _jpeg_orientation(segment[6:])
+    except (struct.error, ValueError):
+        # short IHDR or start of frame
+        return None
+
+
+def read_img_size(filepath):
+    """(width, height) of the image returned by cv2.imread, from its header when possible"""
+    size = read_img_header_size(filepath)
+    if size is None:
+        img = cv2.imread(filepath)
+        (rows, cols) = img.shape[:2]
+        size = (cols, rows)
+    return size
+
+
+def read_img_sizes(filepaths, sizes_path=None, workers=8):
+    """Read the sizes of images in a thread pool, with a cache of the sizes in a sidecar JSON file
+
+    Args:
+        filepaths: paths of the images
+        sizes_path: sidecar file caching the sizes by path and modification time (None for no cache)
+        workers: number of threads reading the headers
+
+    Returns:
+        dict{key: filepath, value: (width, height)}
+    """
+    cached = {}
+    if sizes_path is not None and os.path.exists(sizes_path):
+        with open(sizes_path, 'r') as f:
+            cached = json.load(f)
+
+    sizes = {}
+    entries = {}
+    missing = []
+    for filepath in filepaths:
+        mtime = os.path.getmtime(filepath)
+        entry = cached.get(filepath)
+        if entry is not None and entry[0] == mtime:
+            sizes[filepath] = (entry[1], entry[2])
+            entries[filepath] = entry
+        else:
+            missing.append((filepath, mtime))
+
+    if missing:
+        print('Reading the size of {} images'.format(len(missing)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, ((filepath, mtime), size) in enumerate(
+                    zip(missing, executor.map(read_img_size, [filepath for filepath, _ in missing]))):
+                if (i + 1) % 500 == 0 or i + 1 == len(missing):
+                    sys.stdout.write('\r' + 'idx=' + str(i + 1))
+                sizes[filepath] = size
+                entries[filepath] = [mtime, size[0], size[1]]
+        print()
+
+        if sizes_path is not None:
+            cached.update(entries)
+            tmp_path = sizes_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, sizes_path)
+
+    return sizes
+
+
 def get_data(input_path, data_path):
     """Parse the data from annotation file
 
+    The image sizes are read from the image headers (read_img_sizes) and cached in <input_path>.sizes.json.
+
     Args:
         input_path: annotation file path
 
@@ -139,18 +342,12 @@ def get_data(input_path, data_path):
 
     visualise = True
 
-    i = 1
-
     with open(input_path, 'r') as f:
 
         print('Parsing annotation files')
 
         for line in f:
 
-            # Print process
-            sys.stdout.write('\r' + 'idx=' + str(i))
-            i += 1
-
             line_split = line.strip().split(',')
 
             # Make sure the info saved in annotation file matching the format (path_filename, x1, y1, x2, y2, class_name)
@@ -183,11 +380,10 @@ def get_data(input_path, data_path):
                 all_imgs[filename] = {}
                 thepath = os.path.join(data_path, filename)
                 # print(thepath)
-                img = cv2.imread(thepath)
-                (rows, cols) = img.shape[:2]
+                # the size is read afterwards from the image headers (read_img_sizes)
                 all_imgs[filename]['filepath'] = thepath
-                all_imgs[filename]['width'] = cols
-                all_imgs[filename]['height'] = rows
+                all_imgs[filename]['width'] = None
+                all_imgs[filename]['height'] = None
                 all_imgs[filename]['bboxes'] = []
             # if np.random.randint(0,6) > 0:
             # 	all_imgs[filename]['imageset'] = 'trainval'
@@ -197,8 +393,12 @@ def get_data(input_path, data_path):
             all_imgs[filename]['bboxes'].append(
                 {'class': class_name, 'x1': int(x1), 'x2': int(x2), 'y1': int(y1), 'y2': int(y2)})
 
+        # sizes cached next to the annotation file, by image path and modification time
+        sizes = read_img_sizes([all_imgs[key]['filepath'] for key in all_imgs], sizes_path=input_path + '.sizes.json')
+
         all_data = []
         for key in all_imgs:
+            (all_imgs[key]['width'], all_imgs[key]['height']) = sizes[all_imgs[key]['filepath']]
             all_data.append(all_imgs[key])
 
         # make sure the bg class is last in the list
@@ -220,15 +420,17 @@ class RoiPoolingConv(Layer):
         pool_size: int
             Size of pooling region to use. pool_size = 7 will result in a 7x7 region.
         num_rois: number of regions of interest to be used
+            None for a variable number of rois, known only when the layer is called (used at inference)
     # Input shape
         list of two 4D tensors [X_img,X_roi] with shape:
         X_img:
-        `(1, rows, cols, channels)`
+        `(batch_size, rows, cols, channels)`
         X_roi:
-        `(1,num_rois,4)` list of rois, with ordering (x,y,w,h)
+        `(batch_size,num_rois,4)` list of rois, with ordering (x,y,w,h), the rois of X_roi[i] are pooled from X_img[i]
+        (batch_size has to be 1 when num_rois is None)
     # Output shape
         3D tensor with shape:
-        `(1, num_rois, channels, pool_size, pool_size)`
+        `(batch_size, num_rois, channels, pool_size, pool_size)`
     '''
 
     def __init__(self, pool_size, num_rois, **kwargs):
@@ -244,6 +446,15 @@ class RoiPoolingConv(Layer):
     def compute_output_shape(self, input_shape):
         return None, self.num_rois, self.pool_size, self.pool_size, self.nb_channels
 
+    def pool_roi(self, img, roi):
+        x = K.cast(roi[0], 'int32')
+        y = K.cast(roi[1], 'int32')
+        w = K.cast(roi[2], 'int32')
+        h = K.cast(roi[3], 'int32')
+
+        # Resized roi of the image to pooling size (7x7)
+        return tf.image.resize(img[:, y:y + h, x:x + w, :], (self.pool_size, self.pool_size))
+
     def call(self, x, mask=None):
         assert (len(x) == 2)
 
@@ -253,40 +464,127 @@ class RoiPoolingConv(Layer):
         # x[1] is roi with shape (num_rois,4) with ordering (x,y,w,h)
         rois = x[1]
 
-        input_shape = K.shape(img)
+        if self.num_rois is None:
+            # The number of rois is only known at run time, pool them one by one inside the graph
+            final_output = tf.map_fn(lambda roi: self.pool_roi(img, roi)[0], rois[0], fn_output_signature=K.floatx())
+
+            # Reshape to (1, num_rois, pool_size, pool_size, nb_channels)
+            return K.expand_dims(final_output, axis=0)
+
+        def pool_image_rois(inputs):
+            # the num_rois rois of one image of the batch: (num_rois, pool_size, pool_size, nb_channels)
+            (image, image_rois) = inputs
+            image = K.expand_dims(image, axis=0)
+            return K.concatenate([self.pool_roi(image, image_rois[roi_idx]) for roi_idx in range(self.num_rois)],
+                                 axis=0)
+
+        # Shape (batch_size, num_rois, pool_size, pool_size, nb_channels), might be (1, 4, 7, 7, 512)
+        return tf.map_fn(pool_image_rois, (img, rois), fn_output_signature=K.floatx())
+
+    def get_config(self):
+        config = {'pool_size': self.pool_size,
+                  'num_rois': self.num_rois}
+        base_config = super(RoiPoolingConv, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class BatchedRoiPooling(Layer):
+    '''Batched ROI pooling layer for 2D inputs.
+    Same output as RoiPoolingConv (the layer has no weights), but all the rois are pooled at once with a few gathers
+    instead of one resize per roi. Each roi is sampled as the bilinear resize of RoiPoolingConv samples its cropped
+    roi (half pixel centres, samples clamped to the roi), with the same arithmetic.
+    # Arguments
+        pool_size: int
+            Size of pooling region to use. pool_size = 7 will result in a 7x7 region.
+        num_rois: number of regions of interest to be used
+            None for a variable number of rois, known only when the layer is called (used at inference)
+    # Input shape
+        list of two 4D tensors [X_img,X_roi] with shape:
+        X_img:
+        `(batch_size, rows, cols, channels)`
+        X_roi:
+        `(batch_size,num_rois,4)` list of rois, with ordering (x,y,w,h), the rois of X_roi[i] are pooled from X_img[i]
+    # Output shape
+        3D tensor with shape:
+        `(batch_size, num_rois, pool_size, pool_size, channels)`
+    '''
 
-        outputs = []
+    def __init__(self, pool_size, num_rois, **kwargs):
+        self.dim_ordering = K.image_data_format()
+        self.pool_size = pool_size
+        self.num_rois = num_rois
 
-        for roi_idx in range(self.num_rois):
-            x = rois[0, roi_idx, 0]
-            y = rois[0, roi_idx, 1]
-            w = rois[0, roi_idx, 2]
-            h = rois[0, roi_idx, 3]
+        super(BatchedRoiPooling, self).__init__(**kwargs)
 
-            x = K.cast(x, 'int32')
-            y = K.cast(y, 'int32')
-            w = K.cast(w, 'int32')
-            h = K.cast(h, 'int32')
+    def build(self, input_shape):
+        self.nb_channels = input_shape[0][3]
 
-            # Resized roi of the image to pooling size (7x7)
-            rs = tf.image.resize(img[:, y:y + h, x:x + w, :], (self.pool_size, self.pool_size))
-            outputs.append(rs)
+    def compute_output_shape(self, input_shape):
+        return None, self.num_rois, self.pool_size, self.pool_size, self.nb_channels
 
-        final_output = K.concatenate(outputs, axis=0)
+    def sample_points(self, start, length, size):
+        """Rows (or columns) of the bilinear samples of the rois, as in tf.image.resize of the cropped rois
+
+        Args:
+            start, length: shape=(n,) int32 first row and number of rows of the rois
+            size: number of rows of the image
+
+        Returns:
+            lower, upper: shape=(n, pool_size) int32 rows of the two samples of each point
+            lerp: shape=(n, pool_size) weight of the upper sample
+        """
+        # the crop of RoiPoolingConv stops at the border of the image
+        length = K.minimum(start + length, size) - start
+        # divided as in the resize (a division by a constant would be turned into a product by grappler)
+        scale = tf.math.divide_no_nan(K.cast(length, 'float32'), float(self.pool_size))
+        points = (K.cast(tf.range(self.pool_size), 'float32')[None, :] + 0.5) * scale[:, None] - 0.5
+        floor = tf.floor(points)
+        lower = K.maximum(K.cast(floor, 'int32'), 0)
+        upper = K.minimum(K.cast(tf.math.ceil(points), 'int32'), length[:, None] - 1)
+        return start[:, None] + lower, start[:, None] + upper, points - floor
 
-        # Reshape to (1, num_rois, pool_size, pool_size, nb_channels)
-        # Might be (1, 4, 7, 7, 3)
-        final_output = K.reshape(final_output, (1, self.num_rois, self.pool_size, self.pool_size, self.nb_channels))
+    def call(self, x, mask=None):
+        assert (len(x) == 2)
 
-        # permute_dimensions is similar to transpose
-        final_output = K.permute_dimensions(final_output, (0, 1, 2, 3, 4))
+        # x[0] is image with shape (batch_size, rows, cols, channels)
+        img = x[0]
 
-        return final_output
+        # x[1] is roi with shape (batch_size,num_rois,4) with ordering (x,y,w,h), truncated to integers as in
+        # RoiPoolingConv, and flattened to (batch_size*num_rois,4)
+        (batch_size, num_rois) = (K.shape(x[1])[0], K.shape(x[1])[1])
+        rois = K.cast(K.reshape(x[1], (-1, 4)), 'int32')
+
+        (top_rows, bottom_rows, y_lerp) = self.sample_points(rois[:, 1], rois[:, 3], K.shape(img)[1])
+        (left_cols, right_cols, x_lerp) = self.sample_points(rois[:, 0], rois[:, 2], K.shape(img)[2])
+
+        # the features flattened to (batch_size*rows*cols, channels), and the offset of the image of each roi
+        (rows, cols) = (K.shape(img)[1], K.shape(img)[2])
+        features = K.reshape(img, (-1, self.nb_channels))
+        image_offsets = K.flatten(K.tile(K.expand_dims(tf.range(batch_size) * rows * cols, axis=1), [1, num_rois]))
+
+        def gather(sample_rows, sample_cols):
+            # features at (sample_rows[i], sample_cols[j]) for every point (i, j) of every roi
+            indices = image_offsets[:, None, None] + sample_rows[:, :, None] * cols + sample_cols[:, None, :]
+            return K.gather(features, indices)
+
+        x_lerp = K.cast(x_lerp[:, None, :, None], K.floatx())
+        y_lerp = K.cast(y_lerp[:, :, None, None], K.floatx())
+        # interpolation of tf.image.resize
+        top_left = gather(top_rows, left_cols)
+        top_right = gather(top_rows, right_cols)
+        bottom_left = gather(bottom_rows, left_cols)
+        bottom_right = gather(bottom_rows, right_cols)
+        top = top_left + (top_right - top_left) * x_lerp
+        bottom = bottom_left + (bottom_right - bottom_left) * x_lerp
+        final_output = top + (bottom - top) * y_lerp
+
+        # Reshape to (batch_size, num_rois, pool_size, pool_size, nb_channels)
+        return tf.reshape(final_output, [batch_size, num_rois, self.pool_size, self.pool_size, self.nb_channels])
 
     def get_config(self):
         config = {'pool_size': self.pool_size,
                   'num_rois': self.num_rois}
-        base_config = super(RoiPoolingConv, self).get_config()
+        base_config = super(BatchedRoiPooling, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
 
@@ -367,45 +665,76 @@ def rpn_layer(base_layers, num_anchors):
     return [x_class, x_regr, base_layers]
 
 
-def classifier_layer(base_layers, input_rois, num_rois, nb_classes=4):
-    """Create a classifier layer
+def classifier_layers(num_rois, nb_classes=4, batched_pooling=False):
+    """Create the layers of a classifier layer, to apply them with classifier_layer
+
+    The layers can be applied to several inputs (e.g. the base layers and a feature map input), the classifiers then
+    share their weights.
 
     Args:
-        base_layers: vgg
-        input_rois: `(1,num_rois,4)` list of rois, with ordering (x,y,w,h)
         num_rois: number of rois to be processed in one time (4 in here)
+            None to process all the rois of an image in one time (at inference)
+        nb_classes: number of classes, including 'bg'
+        batched_pooling: pool the rois with BatchedRoiPooling instead of RoiPoolingConv
 
     Returns:
-        list(out_class, out_regr)
-        out_class: classifier layer output
-        out_regr: regression layer output
+        list(roi_pooling, hidden_layers, class_layer, regr_layer)
     """
-
-    input_shape = (num_rois, 7, 7, 512)
-
     pooling_regions = 7
 
     # out_roi_pool.shape = (1, num_rois, channels, pool_size, pool_size)
     # num_rois (4) 7x7 roi pooling
-    out_roi_pool = RoiPoolingConv(pooling_regions, num_rois)([base_layers, input_rois])
+    if batched_pooling:
+        roi_pooling = BatchedRoiPooling(pooling_regions, num_rois)
+    else:
+        roi_pooling = RoiPoolingConv(pooling_regions, num_rois)
 
     # Flatten the convlutional layer and connected to 2 FC and 2 dropout
-    out = TimeDistributed(Flatten(name='flatten'))(out_roi_pool)
-    out = TimeDistributed(Dense(4096, activation='relu', name='fc1'))(out)
-    out = TimeDistributed(Dropout(0.5))(out)
-    out = TimeDistributed(Dense(4096, activation='relu', name='fc2'))(out)
-    out = TimeDistributed(Dropout(0.5))(out)
+    hidden_layers = [TimeDistributed(Flatten(name='flatten')),
+                     TimeDistributed(Dense(4096, activation='relu', name='fc1')),
+                     TimeDistributed(Dropout(0.5)),
+                     TimeDistributed(Dense(4096, activation='relu', name='fc2')),
+                     TimeDistributed(Dropout(0.5))]
 
     # There are two output layer
     # out_class: softmax acivation function for classify the class name of the object
     # out_regr: linear activation function for bboxes coordinates regression
-    out_class = TimeDistributed(Dense(nb_classes, activation='softmax', kernel_initializer='zero'),
-                                name='dense_class_{}'.format(nb_classes))(out)
+    class_layer = TimeDistributed(Dense(nb_classes, activation='softmax', kernel_initializer='zero'),
+                                  name='dense_class_{}'.format(nb_classes))
     # note: no regression target for bg class
-    out_regr = TimeDistributed(Dense(4 * (nb_classes - 1), activation='linear', kernel_initializer='zero'),
-                               name='dense_regress_{}'.format(nb_classes))(out)
+    regr_layer = TimeDistributed(Dense(4 * (nb_classes - 1), activation='linear', kernel_initializer='zero'),
+                                 name='dense_regress_{}'.format(nb_classes))
+
+    return [roi_pooling, hidden_layers, class_layer, regr_layer]
 
-    return [out_class, out_regr]
+
+def classifier_layer(base_layers, input_rois, num_rois, nb_classes=4, batched_pooling=False, layers=None):
+    """Create a classifier layer
+
+    Args:
+        base_layers: vgg
+        input_rois: `(batch_size,num_rois,4)` list of rois, with ordering (x,y,w,h)
+        num_rois: number of rois to be processed in one time (4 in here)
+            None to process all the rois of an image in one time (at inference)
+        nb_classes: number of classes, including 'bg'
+        batched_pooling: pool the rois with BatchedRoiPooling instead of RoiPoolingConv
+        layers: layers of classifier_layers to apply, to share them with another classifier layer (new layers if
+            None)
+
+    Returns:
+        list(out_class, out_regr)
+        out_class: classifier layer output
+        out_regr: regression layer output
+    """
+    if layers is None:
+        layers = classifier_layers(num_rois, nb_classes=nb_classes, batched_pooling=batched_pooling)
+    (roi_pooling, hidden_layers, class_layer, regr_layer) = layers
+
+    out = roi_pooling([base_layers, input_rois])
+    for layer in hidden_layers:
+        out = layer(out)
+
+    return [class_layer(out), regr_layer(out)]
 
 
 def union(au, bu, area_intersection):
@@ -437,27 +766,208 @@ def iou(a, b):
     return float(area_i) / float(area_u + 1e-6)
 
 
-def calc_rpn(C, img_data, width, height, resized_width, resized_height, img_length_calc_function):
-    """(Important part!) Calculate the rpn for all anchors
-        If feature map has shape 38x50=1900, there are 1900x9=17100 potential anchors
+def iou_np(a, b):
+    """Vectorized version of iou() between two sets of boxes
 
     Args:
-        C: config
-        img_data: augmented image data
-        width: original image width (e.g. 600)
-        height: original image height (e.g. 800)
-        resized_width: resized image width according to C.im_size (e.g. 300)
-        resized_height: resized image height according to C.im_size (e.g. 400)
-        img_length_calc_function: function to calculate final layer's feature map (of base model) size according to input image size
+        a: array of shape (N, 4) with ordering (x1,y1,x2,y2)
+        b: array of shape (M, 4) with ordering (x1,y1,x2,y2)
+
+    Returns:
+        overlaps: array of shape (N, M), overlaps[i, j] is equal to iou(a[i], b[j])
+    """
+    a = np.asarray(a, dtype=np.float64).reshape((-1, 4))
+    b = np.asarray(b, dtype=np.float64).reshape((-1, 4))
+
+    # intersection
+    x = np.maximum(a[:, None, 0], b[None, :, 0])
+    y = np.maximum(a[:, None, 1], b[None, :, 1])
+    w = np.minimum(a[:, None, 2], b[None, :, 2]) - x
+    h = np.minimum(a[:, None, 3], b[None, :, 3]) - y
+    area_i = np.where((w < 0) | (h < 0), 0.0, w * h)
+
+    # union
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    area_u = area_a[:, None] + area_b[None, :] - area_i
+
+    overlaps = area_i / (area_u + 1e-6)
+
+    # invalid boxes have no overlap with anything
+    invalid_a = (a[:, 0] >= a[:, 2]) | (a[:, 1] >= a[:, 3])
+    invalid_b = (b[:, 0] >= b[:, 2]) | (b[:, 1] >= b[:, 3])
+    overlaps[invalid_a, :] = 0.0
+    overlaps[:, invalid_b] = 0.0
+
+    return overlaps
+
+
+def rpn_regr_targets(anchors, gta):
+    """Calculate the rpn regression targets (tx, ty, tw, th) of anchors with respect to ground-truth boxes
+
+    Args:
+        anchors: array of shape (N, 4) with ordering (x1,y1,x2,y2)
+        gta: array of shape (N, 4) with ordering (x1,x2,y1,y2), as built in calc_rpn
+
+    Returns:
+        targets: array of shape (N, 4) with ordering (tx,ty,tw,th)
+    """
+    # x,y are the center point of ground-truth bbox
+    # xa,ya are the center point of anchor bbox (xa=downscale * (ix + 0.5); ya=downscale * (iy+0.5))
+    # w,h are the width and height of ground-truth bbox
+    # wa,ha are the width and height of anchor bboxe
+    # tx = (x - xa) / wa
+    # ty = (y - ya) / ha
+    # tw = log(w / wa)
+    # th = log(h / ha)
+    cx = (gta[:, 0] + gta[:, 1]) / 2.0
+    cy = (gta[:, 2] + gta[:, 3]) / 2.0
+    cxa = (anchors[:, 0] + anchors[:, 2]) / 2.0
+    cya = (anchors[:, 1] + anchors[:, 3]) / 2.0
+
+    tx = (cx - cxa) / (anchors[:, 2] - anchors[:, 0])
+    ty = (cy - cya) / (anchors[:, 3] - anchors[:, 1])
+    tw = np.log((gta[:, 1] - gta[:, 0]) / (anchors[:, 2] - anchors[:, 0]))
+    th = np.log((gta[:, 3] - gta[:, 2]) / (anchors[:, 3] - anchors[:, 1]))
+
+    return np.stack([tx, ty, tw, th], axis=1)
+
+
+def _best_anchor_for_bbox(bbox_overlaps, anchor_jy, anchor_ix, anchor_idx):
+    """Find the anchor with the best IOU for one GT box
+
+    Anchors are visited by anchor type, then x, then y and the best IOU is kept as float32: a later anchor only
+    replaces the current best one if its IOU is larger than the float32 value of the best IOU.
+
+    Args:
+        bbox_overlaps: IOU of every valid anchor with the GT box
+        anchor_jy, anchor_ix, anchor_idx: position and type of every valid anchor
 
     Returns:
-        y_rpn_cls: list(num_bboxes, y_is_box_valid + y_rpn_overlap)
-            y_is_box_valid: 0 or 1 (0 means the box is invalid, 1 means the box is valid)
-            y_rpn_overlap: 0 or 1 (0 means the box is not an object, 1 means the box is an object)
-        y_rpn_regr: list(num_bboxes, 4*y_rpn_overlap + y_rpn_regr)
-            y_rpn_regr: x1,y1,x2,y2 bunding boxes coordinates
+        index of the best anchor, None if no anchor overlaps the GT box
+    """
+    if len(bbox_overlaps) == 0 or np.max(bbox_overlaps) <= 0:
+        return None
+
+    # only the anchors with an IOU equal to the best one in float32 can be selected
+    lower = np.nextafter(np.float32(np.max(bbox_overlaps)), np.float32(-np.inf))
+    candidates = np.nonzero(bbox_overlaps > lower)[0]
+    candidates = candidates[np.lexsort((anchor_jy[candidates], anchor_ix[candidates], anchor_idx[candidates]))]
+
+    best_anchor = None
+    best_iou = np.float32(0)
+    for idx in candidates:
+        if float(bbox_overlaps[idx]) > float(best_iou):
+            best_anchor = idx
+            best_iou = np.float32(bbox_overlaps[idx])
+
+    return best_anchor
+
+
+class AnchorGridCache:
+    """Bounded LRU cache of the anchors of a feature map
+
+    The anchors only depend on the feature map shape and on the anchor configuration (C.anchor_box_scales,
+    C.anchor_box_ratios and C.rpn_stride). Most images are resized to a few shapes, so the anchors are computed once
+    per shape and shared by calc_rpn (training targets) and rpn_to_roi (decoding of the rpn outputs).
+
+    Args:
+        max_size: maximum number of feature map shapes kept in the cache
+    """
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._grids = OrderedDict()
+
+    def __len__(self):
+        return len(self._grids)
+
+    def clear(self):
+        self._grids.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, C, rows, cols):
+        """Get the anchors of a feature map
+
+        Args:
+            C: config
+            rows: feature map height
+            cols: feature map width
+
+        Returns:
+            anchor_boxes: shape=(4, rows, cols, num_anchors), (x1,y1,x2,y2) of the anchors on the resized image
+            anchor_grid: shape=(4, rows, cols, num_anchors), (x,y,w,h) of the anchors on the feature map
+            Both arrays are read-only, the anchor index is anchor_ratio_idx + len(anchor_ratios) * anchor_size_idx
+        """
+        key = (rows, cols, tuple(C.anchor_box_scales), tuple(tuple(ratio) for ratio in C.anchor_box_ratios),
+               C.rpn_stride)
+
+        if key in self._grids:
+            self.hits += 1
+            self._grids.move_to_end(key)
+            return self._grids[key]
+
+        self.misses += 1
+        grids = self._build(C, rows, cols)
+        self._grids[key] = grids
+        if len(self._grids) > self.max_size:
+            self._grids.popitem(last=False)
+        return grids
+
+    @staticmethod
+    def _build(C, rows, cols):
+        downscale = float(C.rpn_stride)
+        shape = (rows, cols, len(C.anchor_box_scales) * len(C.anchor_box_ratios))
+
+        # size of every anchor type on the resized image
+        anchor_x = np.array([size * ratio[0] for size in C.anchor_box_scales for ratio in C.anchor_box_ratios])
+        anchor_y = np.array([size * ratio[1] for size in C.anchor_box_scales for ratio in C.anchor_box_ratios])
+
+        # anchors centered on each point of the feature map, in pixels of the resized image
+        center_x = downscale * (np.arange(cols) + 0.5)
+        center_y = downscale * (np.arange(rows) + 0.5)
+        anchor_boxes = np.stack([
+            np.broadcast_to(center_x[None, :, None] - anchor_x[None, None, :] / 2, shape),
+            np.broadcast_to(center_y[:, None, None] - anchor_y[None, None, :] / 2, shape),
+            np.broadcast_to(center_x[None, :, None] + anchor_x[None, None, :] / 2, shape),
+            np.broadcast_to(center_y[:, None, None] + anchor_y[None, None, :] / 2, shape)])
+
+        # anchors on the feature map, with top left corner at (X - anchor_x / 2, Y - anchor_y / 2)
+        # e.g. anchor_x = (128 * 1) / 16 = 8 => width of the anchor on the feature map
+        anchor_x = np.array([(size * ratio[0]) / C.rpn_stride
+                             for size in C.anchor_box_scales for ratio in C.anchor_box_ratios])
+        anchor_y = np.array([(size * ratio[1]) / C.rpn_stride
+                             for size in C.anchor_box_scales for ratio in C.anchor_box_ratios])
+        X, Y = np.meshgrid(np.arange(cols), np.arange(rows))
+        anchor_grid = np.stack([
+            X[:, :, None] - anchor_x[None, None, :] / 2,
+            Y[:, :, None] - anchor_y[None, None, :] / 2,
+            np.broadcast_to(anchor_x, shape),
+            np.broadcast_to(anchor_y, shape)])
+
+        anchor_boxes.setflags(write=False)
+        anchor_grid.setflags(write=False)
+        return anchor_boxes, anchor_grid
+
+
+# Anchors shared by the training target generation and the inference decoding
+anchor_grid_cache = AnchorGridCache()
+
+
+def calc_rpn_targets(C, img_data, width, height, resized_width, resized_height, img_length_calc_function):
+    """Calculate the rpn targets of all anchors, before the sampling of the 256 anchors of calc_rpn
+
+    Args: see calc_rpn
+
+    Returns:
+        shape: (rows, cols, num_anchors) of the feature map
+        pos_idx: positive anchors (y_rpn_overlap = 1), indexed in the (num_anchors, rows, cols) order
+        neg_idx: negative anchors (y_rpn_overlap = 0 and y_is_box_valid = 1), in the same order
+        pos_regr: shape=(len(pos_idx), 4), regression targets of the positive anchors
     """
-    downscale = float(C.rpn_stride)
     anchor_sizes = C.anchor_box_scales  # 128, 256, 512
     anchor_ratios = C.anchor_box_ratios  # 1:1, 1:2*sqrt(2), 2*sqrt(2):1
     num_anchors = len(anchor_sizes) * len(anchor_ratios)  # 3x3=9
@@ -465,8 +975,6 @@ def calc_rpn(C, img_data, width, height, resized_width, resized_height, img_leng
     # calculate the output map size based on the network architecture
     (output_width, output_height) = img_length_calc_function(resized_width, resized_height)
 
-    n_anchratios = len(anchor_ratios)  # 3
-
     # initialise empty output objectives
     y_rpn_overlap = np.zeros((output_height, output_width, num_anchors))
     y_is_box_valid = np.zeros((output_height, output_width, num_anchors))
@@ -474,12 +982,6 @@ def calc_rpn(C, img_data, width, height, resized_width, resized_height, img_leng
 
     num_bboxes = len(img_data['bboxes'])
 
-    num_anchors_for_bbox = np.zeros(num_bboxes).astype(int)
-    best_anchor_for_bbox = -1 * np.ones((num_bboxes, 4)).astype(int)
-    best_iou_for_bbox = np.zeros(num_bboxes).astype(np.float32)
-    best_x_for_bbox = np.zeros((num_bboxes, 4)).astype(int)
-    best_dx_for_bbox = np.zeros((num_bboxes, 4)).astype(np.float32)
-
     # get the GT box coordinates, and resize to account for image resizing
     gta = np.zeros((num_bboxes, 4))
     for bbox_num, bbox in enumerate(img_data['bboxes']):
@@ -489,152 +991,246 @@ def calc_rpn(C, img_data, width, height, resized_width, resized_height, img_leng
         gta[bbox_num, 2] = bbox['y1'] * (resized_height / float(height))
         gta[bbox_num, 3] = bbox['y2'] * (resized_height / float(height))
 
+    # 'bg' boxes are never used as a target
+    is_object = np.array([bbox['class'] != 'bg' for bbox in img_data['bboxes']], dtype=bool)
+
     # rpn ground truth
 
-    for anchor_size_idx in range(len(anchor_sizes)):
-        for anchor_ratio_idx in range(n_anchratios):
-            anchor_x = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][0]
-            anchor_y = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][1]
+    # anchor coordinates for every (jy, ix, anchor) position of the feature map
+    # the anchor index is anchor_ratio_idx + n_anchratios * anchor_size_idx
+    anchor_boxes, _ = anchor_grid_cache.get(C, output_height, output_width)
+    (x1_anc, y1_anc, x2_anc, y2_anc) = anchor_boxes
 
-            for ix in range(output_width):
-                # x-coordinates of the current anchor box
-                x1_anc = downscale * (ix + 0.5) - anchor_x / 2
-                x2_anc = downscale * (ix + 0.5) + anchor_x / 2
+    # ignore boxes that go across image boundaries
+    valid = (x1_anc >= 0) & (x2_anc <= resized_width) & (y1_anc >= 0) & (y2_anc <= resized_height)
+    (valid_jy, valid_ix, valid_anc) = np.nonzero(valid)
+    anchors = np.stack([x1_anc[valid], y1_anc[valid], x2_anc[valid], y2_anc[valid]], axis=1)
 
-                # ignore boxes that go across image boundaries
-                if x1_anc < 0 or x2_anc > resized_width:
-                    continue
+    # IOU of every valid anchor (rows) with every GT box (columns)
+    overlaps = iou_np(gta[:, (0, 2, 1, 3)], anchors).T
 
-                for jy in range(output_height):
+    # we set the anchor to positive if the IOU is >0.7 (it does not matter if there was another better box, it just indicates overlap)
+    pos_overlaps = (overlaps > C.rpn_max_overlap) & is_object
+    # if the IOU is >0.3 and <0.7, it is ambiguous and no included in the objective
+    neutral_overlaps = (C.rpn_min_overlap < overlaps) & (overlaps < C.rpn_max_overlap) & is_object
 
-                    # y-coordinates of the current anchor box
-                    y1_anc = downscale * (jy + 0.5) - anchor_y / 2
-                    y2_anc = downscale * (jy + 0.5) + anchor_y / 2
+    is_pos = np.any(pos_overlaps, axis=1)
+    is_neutral = np.logical_and(np.any(neutral_overlaps, axis=1), np.logical_not(is_pos))
+    num_anchors_for_bbox = np.sum(pos_overlaps, axis=0)
 
-                    # ignore boxes that go across image boundaries
-                    if y1_anc < 0 or y2_anc > resized_height:
-                        continue
+    # turn on or off outputs depending on IOUs
+    y_is_box_valid[valid_jy, valid_ix, valid_anc] = np.logical_not(is_neutral)
+    y_rpn_overlap[valid_jy, valid_ix, valid_anc] = is_pos
 
-                    # bbox_type indicates whether an anchor should be a target
-                    # Initialize with 'negative'
-                    bbox_type = 'neg'
-
-                    # this is the best IOU for the (x,y) coord and the current anchor
-                    # note that this is different from the best IOU for a GT bbox
-                    best_iou_for_loc = 0.0
-
-                    for bbox_num in range(num_bboxes):
-
-                        # get IOU of the current GT box and the current anchor box
-                        curr_iou = iou([gta[bbox_num, 0], gta[bbox_num, 2], gta[bbox_num, 1], gta[bbox_num, 3]],
-                                       [x1_anc, y1_anc, x2_anc, y2_anc])
-                        # calculate the regression targets if they will be needed
-                        if curr_iou > best_iou_for_bbox[bbox_num] or curr_iou > C.rpn_max_overlap:
-                            cx = (gta[bbox_num, 0] + gta[bbox_num, 1]) / 2.0
-                            cy = (gta[bbox_num, 2] + gta[bbox_num, 3]) / 2.0
-                            cxa = (x1_anc + x2_anc) / 2.0
-                            cya = (y1_anc + y2_anc) / 2.0
-
-                            # x,y are the center point of ground-truth bbox
-                            # xa,ya are the center point of anchor bbox (xa=downscale * (ix + 0.5); ya=downscale * (iy+0.5))
-                            # w,h are the width and height of ground-truth bbox
-                            # wa,ha are the width and height of anchor bboxe
-                            # tx = (x - xa) / wa
-                            # ty = (y - ya) / ha
-                            # tw = log(w / wa)
-                            # th = log(h / ha)
-                            tx = (cx - cxa) / (x2_anc - x1_anc)
-                            ty = (cy - cya) / (y2_anc - y1_anc)
-                            tw = np.log((gta[bbox_num, 1] - gta[bbox_num, 0]) / (x2_anc - x1_anc))
-                            th = np.log((gta[bbox_num, 3] - gta[bbox_num, 2]) / (y2_anc - y1_anc))
-
-                        if img_data['bboxes'][bbox_num]['class'] != 'bg':
-
-                            # all GT boxes should be mapped to an anchor box, so we keep track of which anchor box was best
-                            if curr_iou > best_iou_for_bbox[bbox_num]:
-                                best_anchor_for_bbox[bbox_num] = [jy, ix, anchor_ratio_idx, anchor_size_idx]
-                                best_iou_for_bbox[bbox_num] = curr_iou
-                                best_x_for_bbox[bbox_num, :] = [x1_anc, x2_anc, y1_anc, y2_anc]
-                                best_dx_for_bbox[bbox_num, :] = [tx, ty, tw, th]
-
-                            # we set the anchor to positive if the IOU is >0.7 (it does not matter if there was another better box, it just indicates overlap)
-                            if curr_iou > C.rpn_max_overlap:
-                                bbox_type = 'pos'
-                                num_anchors_for_bbox[bbox_num] += 1
-                                # we update the regression layer target if this IOU is the best for the current (x,y) and anchor position
-                                if curr_iou > best_iou_for_loc:
-                                    best_iou_for_loc = curr_iou
-                                    best_regr = (tx, ty, tw, th)
-
-                            # if the IOU is >0.3 and <0.7, it is ambiguous and no included in the objective
-                            if C.rpn_min_overlap < curr_iou < C.rpn_max_overlap:
-                                # gray zone between neg and pos
-                                if bbox_type != 'pos':
-                                    bbox_type = 'neutral'
-
-                    # turn on or off outputs depending on IOUs
-                    if bbox_type == 'neg':
-                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
-                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
-                    elif bbox_type == 'neutral':
-                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
-                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
-                    elif bbox_type == 'pos':
-                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
-                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
-                        start = 4 * (anchor_ratio_idx + n_anchratios * anchor_size_idx)
-                        y_rpn_regr[jy, ix, start:start + 4] = best_regr
+    # the regression target of a positive anchor is taken from the GT box with the best IOU
+    pos_idx = np.nonzero(is_pos)[0]
+    if len(pos_idx) > 0:
+        best_bbox_for_loc = np.argmax(np.where(pos_overlaps[pos_idx], overlaps[pos_idx], -1.0), axis=1)
+        best_regr = rpn_regr_targets(anchors[pos_idx], gta[best_bbox_for_loc])
+        for i in range(4):
+            y_rpn_regr[valid_jy[pos_idx], valid_ix[pos_idx], 4 * valid_anc[pos_idx] + i] = best_regr[:, i]
 
     # we ensure that every bbox has at least one positive RPN region
 
-    for idx in range(num_anchors_for_bbox.shape[0]):
-        if num_anchors_for_bbox[idx] == 0:
-            # no box with an IOU greater than zero ...
-            if best_anchor_for_bbox[idx, 0] == -1:
-                continue
-            y_is_box_valid[
-                best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], best_anchor_for_bbox[
-                    idx, 2] + n_anchratios *
-                best_anchor_for_bbox[idx, 3]] = 1
-            y_rpn_overlap[
-                best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], best_anchor_for_bbox[
-                    idx, 2] + n_anchratios *
-                best_anchor_for_bbox[idx, 3]] = 1
-            start = 4 * (best_anchor_for_bbox[idx, 2] + n_anchratios * best_anchor_for_bbox[idx, 3])
-            y_rpn_regr[
-            best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], start:start + 4] = best_dx_for_bbox[idx, :]
+    for bbox_num in range(num_bboxes):
+        if num_anchors_for_bbox[bbox_num] > 0 or not is_object[bbox_num]:
+            continue
+        best_anchor = _best_anchor_for_bbox(overlaps[:, bbox_num], valid_jy, valid_ix, valid_anc)
+        # no box with an IOU greater than zero ...
+        if best_anchor is None:
+            continue
+        best_dx = rpn_regr_targets(anchors[best_anchor:best_anchor + 1], gta[bbox_num:bbox_num + 1])
+        (jy, ix, anc) = (valid_jy[best_anchor], valid_ix[best_anchor], valid_anc[best_anchor])
+        y_is_box_valid[jy, ix, anc] = 1
+        y_rpn_overlap[jy, ix, anc] = 1
+        y_rpn_regr[jy, ix, 4 * anc:4 * anc + 4] = best_dx[0].astype(np.float32)
+
+    # positive anchors are always valid, the sampling of calc_rpn picks among the positive and negative anchors
+    y_rpn_overlap = np.transpose(y_rpn_overlap, (2, 0, 1)).ravel()
+    y_is_box_valid = np.transpose(y_is_box_valid, (2, 0, 1)).ravel()
+    pos_idx = np.flatnonzero(np.logical_and(y_rpn_overlap == 1, y_is_box_valid == 1))
+    neg_idx = np.flatnonzero(np.logical_and(y_rpn_overlap == 0, y_is_box_valid == 1))
+
+    (pos_anc, pos_jy, pos_ix) = np.unravel_index(pos_idx, (num_anchors, output_height, output_width))
+    pos_regr = y_rpn_regr.reshape((output_height, output_width, num_anchors, 4))[pos_jy, pos_ix, pos_anc]
+
+    return (output_height, output_width, num_anchors), pos_idx, neg_idx, pos_regr
+
+
+class SparseRpnTargets:
+    """Rpn targets of one image, as the indices of the anchors they concern
+
+    The anchors are indexed in the order of the rpn outputs, (jy * cols + ix) * num_anchors + anchor. dense() gives
+    the y_rpn_cls and y_rpn_regr arrays expected by model_rpn, so the targets can be kept, cached and sent to other
+    processes in this form, and only densified right before train_on_batch.
+
+    Args:
+        shape: (rows, cols, num_anchors) of the rpn outputs
+        valid_idx: anchors counted in the loss (y_is_box_valid = 1)
+        pos_idx: positive anchors (y_rpn_overlap = 1)
+        pos_regr: shape=(len(pos_idx), 4), float32, regression targets of the positive anchors
+    """
+
+    def __init__(self, shape, valid_idx, pos_idx, pos_regr):
+        self.shape = tuple(shape)
+        self.valid_idx = valid_idx
+        self.pos_idx = pos_idx
+        self.pos_regr = pos_regr
+
+    @property
+    def nbytes(self):
+        return self.valid_idx.nbytes + self.pos_idx.nbytes + self.pos_regr.nbytes
+
+    def dense(self):
+        """Dense targets: [y_rpn_cls, y_rpn_regr]
+
+        Returns:
+            y_rpn_cls: shape=(1, rows, cols, 2*num_anchors), float32, y_is_box_valid + y_rpn_overlap
+            y_rpn_regr: shape=(1, rows, cols, 8*num_anchors), float32, 4*y_rpn_overlap + y_rpn_regr
+        """
+        (rows, cols, num_anchors) = self.shape
+        y_rpn_cls = np.zeros((rows * cols, 2 * num_anchors), dtype=np.float32)
+        y_rpn_regr = np.zeros((rows * cols, 8 * num_anchors), dtype=np.float32)
 
-    y_rpn_overlap = np.transpose(y_rpn_overlap, (2, 0, 1))
-    y_rpn_overlap = np.expand_dims(y_rpn_overlap, axis=0)
+        y_rpn_cls[self.valid_idx // num_anchors, self.valid_idx % num_anchors] = 1
+        (pos_loc, pos_anc) = (self.pos_idx // num_anchors, self.pos_idx % num_anchors)
+        y_rpn_cls[pos_loc, num_anchors + pos_anc] = 1
+        for i in range(4):
+            y_rpn_regr[pos_loc, 4 * pos_anc + i] = 1
+            y_rpn_regr[pos_loc, 4 * num_anchors + 4 * pos_anc + i] = self.pos_regr[:, i]
 
-    y_is_box_valid = np.transpose(y_is_box_valid, (2, 0, 1))
-    y_is_box_valid = np.expand_dims(y_is_box_valid, axis=0)
+        return [y_rpn_cls.reshape((1, rows, cols, 2 * num_anchors)),
+                y_rpn_regr.reshape((1, rows, cols, 8 * num_anchors))]
 
-    y_rpn_regr = np.transpose(y_rpn_regr, (2, 0, 1))
-    y_rpn_regr = np.expand_dims(y_rpn_regr, axis=0)
 
-    pos_locs = np.where(np.logical_and(y_rpn_overlap[0, :, :, :] == 1, y_is_box_valid[0, :, :, :] == 1))
-    neg_locs = np.where(np.logical_and(y_rpn_overlap[0, :, :, :] == 0, y_is_box_valid[0, :, :, :] == 1))
+class RpnTargetCache:
+    """Bounded LRU cache of the rpn targets of calc_rpn_targets
 
-    num_pos = len(pos_locs[0])
+    augment() only produces a few geometric variants of an image (flips and rotations), so the targets before the
+    sampling of calc_rpn are computed once per variant. They are keyed by the augmented bboxes and the image sizes
+    (which identify the image, its geometric variant and C.im_size), the feature map size and the anchor
+    configuration. The targets are kept in the sparse form of calc_rpn_targets, as read-only arrays.
+
+    The memory budget is C.rpn_target_cache_size (in MB, 0 disables the cache): the least recently used targets are
+    evicted beyond it.
+    """
+
+    def __init__(self):
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._targets = OrderedDict()
+        # the targets are computed in parallel by the map of anchor_gt_dataset
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._targets)
+
+    def clear(self):
+        self._targets.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, C, img_data, width, height, resized_width, resized_height, img_length_calc_function):
+        """Get the rpn targets of calc_rpn_targets"""
+        max_bytes = int(getattr(C, 'rpn_target_cache_size', 0) * 2 ** 20)
+        if max_bytes <= 0:
+            return calc_rpn_targets(C, img_data, width, height, resized_width, resized_height,
+                                    img_length_calc_function)
+
+        key = (tuple((bbox['class'], bbox['x1'], bbox['x2'], bbox['y1'], bbox['y2']) for bbox in img_data['bboxes']),
+               width, height, resized_width, resized_height, img_length_calc_function(resized_width, resized_height),
+               tuple(C.anchor_box_scales), tuple(tuple(ratio) for ratio in C.anchor_box_ratios), C.rpn_stride,
+               C.rpn_min_overlap, C.rpn_max_overlap)
+
+        with self._lock:
+            if key in self._targets:
+                self.hits += 1
+                self._targets.move_to_end(key)
+                return self._targets[key]
+            self.misses += 1
+
+        targets = calc_rpn_targets(C, img_data, width, height, resized_width, resized_height,
+                                   img_length_calc_function)
+        for array in targets[1:]:
+            array.setflags(write=False)
+
+        with self._lock:
+            if key in self._targets:
+                # computed meanwhile by another thread (anchor_gt_dataset)
+                return self._targets[key]
+            self._targets[key] = targets
+            self.nbytes += self._targets_nbytes(targets)
+            while self.nbytes > max_bytes and self._targets:
+                _, evicted = self._targets.popitem(last=False)
+                self.nbytes -= self._targets_nbytes(evicted)
+                self.evictions += 1
+        return targets
+
+    @staticmethod
+    def _targets_nbytes(targets):
+        return sum(array.nbytes for array in targets[1:])
+
+
+# Rpn targets of the augmented images, computed once per image and geometric variant
+rpn_target_cache = RpnTargetCache()
+
+
+def calc_rpn(C, img_data, width, height, resized_width, resized_height, img_length_calc_function):
+    """(Important part!) Calculate the rpn for all anchors
+        If feature map has shape 38x50=1900, there are 1900x9=17100 potential anchors
+
+    Args:
+        C: config
+        img_data: augmented image data
+        width: original image width (e.g. 600)
+        height: original image height (e.g. 800)
+        resized_width: resized image width according to C.im_size (e.g. 300)
+        resized_height: resized image height according to C.im_size (e.g. 400)
+        img_length_calc_function: function to calculate final layer's feature map (of base model) size according to input image size
+
+    Returns:
+        y_rpn: SparseRpnTargets, whose dense() gives
+            y_rpn_cls: list(num_bboxes, y_is_box_valid + y_rpn_overlap)
+                y_is_box_valid: 0 or 1 (0 means the box is invalid, 1 means the box is valid)
+                y_rpn_overlap: 0 or 1 (0 means the box is not an object, 1 means the box is an object)
+            y_rpn_regr: list(num_bboxes, 4*y_rpn_overlap + y_rpn_regr)
+                y_rpn_regr: x1,y1,x2,y2 bunding boxes coordinates
+        num_pos: number of positive anchors kept
+    """
+    (rows, cols, num_anchors), pos_idx, neg_idx, pos_regr = rpn_target_cache.get(
+        C, img_data, width, height, resized_width, resized_height, img_length_calc_function)
+
+    pos_valid = np.ones(len(pos_idx), dtype=bool)
+    neg_valid = np.ones(len(neg_idx), dtype=bool)
+
+    num_pos = len(pos_idx)
 
     # one issue is that the RPN has many more negative than positive regions, so we turn off some of the negative
     # regions. We also limit it to 256 regions.
     num_regions = 256
 
-    if len(pos_locs[0]) > num_regions / 2:
-        val_locs = random.sample(range(len(pos_locs[0])), len(pos_locs[0]) - num_regions / 2)
-        y_is_box_valid[0, pos_locs[0][val_locs], pos_locs[1][val_locs], pos_locs[2][val_locs]] = 0
+    if len(pos_idx) > num_regions / 2:
+        val_locs = random.sample(range(len(pos_idx)), len(pos_idx) - num_regions / 2)
+        pos_valid[val_locs] = False
         num_pos = num_regions / 2
 
-    if len(neg_locs[0]) + num_pos > num_regions:
-        val_locs = random.sample(range(len(neg_locs[0])), len(neg_locs[0]) - num_pos)
-        y_is_box_valid[0, neg_locs[0][val_locs], neg_locs[1][val_locs], neg_locs[2][val_locs]] = 0
+    if len(neg_idx) + num_pos > num_regions:
+        val_locs = random.sample(range(len(neg_idx)), len(neg_idx) - num_pos)
+        neg_valid[val_locs] = False
 
-    y_rpn_cls = np.concatenate([y_is_box_valid, y_rpn_overlap], axis=1)
-    y_rpn_regr = np.concatenate([np.repeat(y_rpn_overlap, 4, axis=1), y_rpn_regr], axis=1)
+    # from the (num_anchors, rows, cols) order of calc_rpn_targets to the order of the rpn outputs
+    def output_order(idx):
+        (anc, jy, ix) = np.unravel_index(idx, (num_anchors, rows, cols))
+        return np.ravel_multi_index((jy, ix, anc), (rows, cols, num_anchors)).astype(np.int32)
 
-    return np.copy(y_rpn_cls), np.copy(y_rpn_regr), num_pos
+    y_rpn = SparseRpnTargets((rows, cols, num_anchors),
+                             output_order(np.concatenate([pos_idx[pos_valid], neg_idx[neg_valid]])),
+                             output_order(pos_idx), pos_regr.astype(np.float32))
+    return y_rpn, num_pos
 
 
 def get_new_img_size(width, height, img_min_side=300):
@@ -650,6 +1246,218 @@ def get_new_img_size(width, height, img_min_side=300):
     return resized_width, resized_height
 
 
+def image_cache_variant(noise_reduction=None, histogram_equalization=False, gamma_correction=False, gamma_value=4.0,
+                        noise_reduction_shape=(2, 2)):
+    """Name of the image cache variant holding the images pre-processed with these settings ('raw' if none)"""
+    parts = []
+    if noise_reduction == "box_filter":
+        parts.append('box_filter{}x{}'.format(*noise_reduction_shape))
+    elif noise_reduction is not None:
+        parts.append(noise_reduction)
+    if histogram_equalization:
+        parts.append('hist_eq')
+    if gamma_correction:
+        parts.append('gamma{}'.format(gamma_value))
+    return '_'.join(parts) if parts else 'raw'
+
+
+class ImageCache:
+    """Memory-mapped store of the dataset images, resized once to the input size of the network
+
+    The images are resized so that their smallest side is img_min_side (get_new_img_size, cubic interpolation, as
+    in get_anchor_gt and format_img), so that reading them no longer requires decoding the full-resolution files.
+    Each variant (raw images, or images pre-processed at full resolution before resizing) is stored in its own
+    directory of cache_dir: the images one after another as uint8 in images.bin, read through np.memmap, and an
+    index.json giving, for each file path, the modification time of the source file, the offset and the shape of
+    the stored image.
+
+    An image is stored again when its source file has been modified, and the whole variant is rebuilt when
+    img_min_side (C.im_size) changes. The space of the replaced images is only reclaimed by the rebuild.
+
+    Args:
+        cache_dir: directory of the cache
+        img_min_side: smallest side of the stored images (C.im_size)
+        variant: name of the variant (see image_cache_variant)
+        preprocess: function applied to the full-resolution image before resizing, None for the raw variant
+    """
+
+    def __init__(self, cache_dir, img_min_side, variant='raw', preprocess=None):
+        self.img_min_side = int(img_min_side)
+        self.variant = variant
+        self.preprocess = preprocess
+        self.variant_dir = os.path.join(cache_dir, variant)
+        self.data_path = os.path.join(self.variant_dir, 'images.bin')
+        self.index_path = os.path.join(self.variant_dir, 'index.json')
+
+        os.makedirs(self.variant_dir, exist_ok=True)
+        self.entries = {}
+        if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            if index['img_min_side'] == self.img_min_side:
+                self.entries = index['images']
+        if not self.entries:
+            # new variant, or img_min_side changed: start from an empty store
+            open(self.data_path, 'wb').close()
+            _image_cache_maps.pop(self.data_path, None)
+
+    def is_valid(self, img_data):
+        entry = self.entries.get(img_data['filepath'])
+        return (entry is not None and os.path.exists(img_data['filepath'])
+                and entry['mtime'] == os.path.getmtime(img_data['filepath']))
+
+    def update(self, all_img_data):
+        """Store the images of all_img_data missing from the cache or modified since they were stored
+
+        The images which cannot be read are skipped (and reported).
+
+        Args:
+            all_img_data: list(filepath, width, height, list(bboxes)), as given by get_data
+
+        Returns:
+            the img_data of all_img_data reading their image from the cache (see cached_img_data), without the
+            images which cannot be read
+        """
+        missing = [img_data for img_data in all_img_data if not self.is_valid(img_data)]
+        unreadable = set()
+        if missing:
+            print('Caching {} images in {}'.format(len(missing), self.variant_dir))
+            with open(self.data_path, 'ab') as f:
+                for i, img_data in enumerate(missing):
+                    if (i + 1) % 100 == 0 or i + 1 == len(missing):
+                        sys.stdout.write('\r' + 'idx=' + str(i + 1))
+                    filepath = img_data['filepath']
+                    img = cv2.imread(filepath)
+                    if img is None:
+                        unreadable.add(filepath)
+                        continue
+                    mtime = os.path.getmtime(filepath)
+                    if self.preprocess is not None:
+                        img = self.preprocess(img)
+                    (height, width) = img.shape[:2]
+                    (resized_width, resized_height) = get_new_img_size(width, height, self.img_min_side)
+                    img = np.ascontiguousarray(
+                        cv2.resize(img, (resized_width, resized_height), interpolation=cv2.INTER_CUBIC),
+                        dtype=np.uint8)
+                    self.entries[filepath] = {'mtime': mtime, 'offset': f.tell(), 'shape': list(img.shape),
+                                              'source_width': width, 'source_height': height}
+                    f.write(img.tobytes())
+            print()
+            if unreadable:
+                print('Skipped {} images which cannot be read: {}'.format(len(unreadable), sorted(unreadable)))
+            # the data file of this process may be mapped on the content it had before a rebuild
+            _image_cache_maps.pop(self.data_path, None)
+            self.save_index()
+        return [self.cached_img_data(img_data) for img_data in all_img_data
+                if img_data['filepath'] not in unreadable]
+
+    def save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'img_min_side': self.img_min_side, 'variant': self.variant, 'images': self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def cached_img_data(self, img_data):
+        """Copy of img_data whose image is read from the cache by read_img
+
+        width, height and the bboxes are rescaled to the stored image, and img_data['cache'] gives the data file,
+        the offset and the shape of the image.
+        """
+        entry = self.entries[img_data['filepath']]
+        (rows, cols) = entry['shape'][:2]
+        fx = cols / float(img_data['width'])
+        fy = rows / float(img_data['height'])
+
+        cached = copy.deepcopy(img_data)
+        cached['width'] = cols
+        cached['height'] = rows
+        for bbox in cached['bboxes']:
+            bbox['x1'] *= fx
+            bbox['x2'] *= fx
+            bbox['y1'] *= fy
+            bbox['y2'] *= fy
+        cached['cache'] = (self.data_path, entry['offset'], tuple(entry['shape']))
+        return cached
+
+
+# np.memmap of the image cache data files opened by this process (read_img)
+_image_cache_maps = {}
+
+
+def read_img(img_data):
+    """Read the image of img_data: from the image cache if img_data comes from ImageCache, from the disk otherwise"""
+    if 'cache' not in img_data:
+        return cv2.imread(img_data['filepath'])
+
+    (data_path, offset, shape) = img_data['cache']
+    size = int(np.prod(shape))
+    data = _image_cache_maps.get(data_path)
+    if data is None or offset + size > data.shape[0]:
+        # first read, or images appended to the cache since the data file was mapped
+        data = np.memmap(data_path, dtype=np.uint8, mode='r')
+        _image_cache_maps[data_path] = data
+    return np.array(data[offset:offset + size]).reshape(shape)
+
+
+def use_image_cache(all_img_data, C):
+    """img_data of all_img_data read from the raw variant of the image cache at C.image_cache_path
+
+    The images missing from the cache are stored first. all_img_data is returned as is when C.image_cache_path is
+    None.
+    """
+    cache_path = getattr(C, 'image_cache_path', None)
+    if cache_path is None:
+        return all_img_data
+    return ImageCache(cache_path, C.im_size).update(all_img_data)
+
+
+def augment_bboxes(bboxes, rows, cols, horizontal_flip, vertical_flip, angle):
+    """Move the bboxes of an image of rows x cols pixels (in place) as augment() moves the image
+
+    Args:
+        bboxes: bboxes of the image, as in img_data['bboxes']
+        rows, cols: height and width of the image before the augmentation
+        horizontal_flip, vertical_flip: True if the image is flipped
+        angle: rotation of the image after the flips (0, 90, 180 or 270)
+    """
+    if horizontal_flip:
+        for bbox in bboxes:
+            x1 = bbox['x1']
+            x2 = bbox['x2']
+            bbox['x2'] = cols - x1
+            bbox['x1'] = cols - x2
+
+    if vertical_flip:
+        for bbox in bboxes:
+            y1 = bbox['y1']
+            y2 = bbox['y2']
+            bbox['y2'] = rows - y1
+            bbox['y1'] = rows - y2
+
+    for bbox in bboxes:
+        x1 = bbox['x1']
+        x2 = bbox['x2']
+        y1 = bbox['y1']
+        y2 = bbox['y2']
+        if angle == 270:
+            bbox['x1'] = y1
+            bbox['x2'] = y2
+            bbox['y1'] = cols - x2
+            bbox['y2'] = cols - x1
+        elif angle == 180:
+            bbox['x2'] = cols - x1
+            bbox['x1'] = cols - x2
+            bbox['y2'] = rows - y1
+            bbox['y1'] = rows - y2
+        elif angle == 90:
+            bbox['x1'] = rows - y2
+            bbox['x2'] = rows - y1
+            bbox['y1'] = x1
+            bbox['y2'] = x2
+        elif angle == 0:
+            pass
+
+
 def augment(img_data, config, augment=True):
     assert 'filepath' in img_data
     assert 'bboxes' in img_data
@@ -658,31 +1466,24 @@ def augment(img_data, config, augment=True):
 
     img_data_aug = copy.deepcopy(img_data)
 
-    img = cv2.imread(img_data_aug['filepath'])
+    img = read_img(img_data_aug)
 
     if augment:
         rows, cols = img.shape[:2]
 
-        if config.use_horizontal_flips and np.random.randint(0, 2) == 0:
+        horizontal_flip = config.use_horizontal_flips and np.random.randint(0, 2) == 0
+        if horizontal_flip:
             img = cv2.flip(img, 1)
-            for bbox in img_data_aug['bboxes']:
-                x1 = bbox['x1']
-                x2 = bbox['x2']
-                bbox['x2'] = cols - x1
-                bbox['x1'] = cols - x2
 
-        if config.use_vertical_flips and np.random.randint(0, 2) == 0:
+        vertical_flip = config.use_vertical_flips and np.random.randint(0, 2) == 0
+        if vertical_flip:
             img = cv2.flip(img, 0)
-            for bbox in img_data_aug['bboxes']:
-                y1 = bbox['y1']
-                y2 = bbox['y2']
-                bbox['y2'] = rows - y1
-                bbox['y1'] = rows - y2
 
         if config.use_brightness_jitter:
             alpha = 1.0 + random.uniform(-config.brightness_jitter_bound, config.brightness_jitter_bound)
             img = cv2.addWeighted(img, alpha, np.zeros(img.shape, img.dtype), 0, 0)
 
+        angle = 0
         if config.rot_90:
             angle = np.random.choice([0, 90, 180, 270], 1)[0]
             if angle == 270:
@@ -696,34 +1497,62 @@ def augment(img_data, config, augment=True):
             elif angle == 0:
                 pass
 
-            for bbox in img_data_aug['bboxes']:
-                x1 = bbox['x1']
-                x2 = bbox['x2']
-                y1 = bbox['y1']
-                y2 = bbox['y2']
-                if angle == 270:
-                    bbox['x1'] = y1
-                    bbox['x2'] = y2
-                    bbox['y1'] = cols - x2
-                    bbox['y2'] = cols - x1
-                elif angle == 180:
-                    bbox['x2'] = cols - x1
-                    bbox['x1'] = cols - x2
-                    bbox['y2'] = rows - y1
-                    bbox['y1'] = rows - y2
-                elif angle == 90:
-                    bbox['x1'] = rows - y2
-                    bbox['x2'] = rows - y1
-                    bbox['y1'] = x1
-                    bbox['y2'] = x2
-                elif angle == 0:
-                    pass
+        augment_bboxes(img_data_aug['bboxes'], rows, cols, horizontal_flip, vertical_flip, angle)
 
     img_data_aug['width'] = img.shape[1]
     img_data_aug['height'] = img.shape[0]
     return img_data_aug, img
 
 
+def anchor_gt_sample(img_data_aug, x_img, C, img_length_calc_function):
+    """Resize and pre-process an augmented image and compute its rpn targets (the sample of get_anchor_gt)
+
+    Args:
+        img_data_aug: augmented image data
+        x_img: augmented image (BGR, uint8), of the size of img_data_aug
+
+    Returns:
+        x_img, Y, debug_img and num_pos of get_anchor_gt, None if calc_rpn failed on the image
+    """
+    (width, height) = (img_data_aug['width'], img_data_aug['height'])
+    (rows, cols, _) = x_img.shape
+
+    assert cols == width
+    assert rows == height
+
+    # get image dimensions for resizing
+    (resized_width, resized_height) = get_new_img_size(width, height, C.im_size)
+
+    # resize the image so that smalles side is length = 300px
+    x_img = cv2.resize(x_img, (resized_width, resized_height), interpolation=cv2.INTER_CUBIC)
+    debug_img = x_img.copy()
+
+    try:
+        y_rpn, num_pos = calc_rpn(C, img_data_aug, width, height, resized_width, resized_height,
+                                  img_length_calc_function)
+    except:
+        return None
+
+    # Zero-center by mean pixel, and preprocess image
+
+    x_img = preprocess_img(x_img, C)
+    x_img = x_img[:, :, (2, 1, 0)]  # BGR -> RGB
+    x_img = x_img.astype(np.float32)
+    x_img[:, :, 0] -= C.img_channel_mean[0]
+    x_img[:, :, 1] -= C.img_channel_mean[1]
+    x_img[:, :, 2] -= C.img_channel_mean[2]
+    x_img /= C.img_scaling_factor
+
+    x_img = np.transpose(x_img, (2, 0, 1))
+    x_img = np.expand_dims(x_img, axis=0)
+
+    y_rpn.pos_regr *= C.std_scaling
+
+    x_img = np.transpose(x_img, (0, 2, 3, 1))
+
+    return x_img, y_rpn, debug_img, num_pos
+
+
 def get_anchor_gt(all_img_data, C, img_length_calc_function, mode='train'):
     """ Yield the ground-truth anchors as Y (labels)
 
@@ -735,7 +1564,7 @@ def get_anchor_gt(all_img_data, C, img_length_calc_function, mode='train'):
 
     Returns:
         x_img: image data after resized and scaling (smallest size = 300px)
-        Y: [y_rpn_cls, y_rpn_regr]
+        Y: SparseRpnTargets, Y.dense() gives [y_rpn_cls, y_rpn_regr]
         img_data_aug: augmented image data (original image with augmentation)
         debug_img: show image for debug
         num_pos: show number of positive anchors for debug
@@ -750,176 +1579,650 @@ def get_anchor_gt(all_img_data, C, img_length_calc_function, mode='train'):
             else:
                 img_data_aug, x_img = augment(img_data, C, augment=False)
 
-            (width, height) = (img_data_aug['width'], img_data_aug['height'])
-            (rows, cols, _) = x_img.shape
+            sample = anchor_gt_sample(img_data_aug, x_img, C, img_length_calc_function)
+            if sample is None:
+                continue
+
+            (x_img, y_rpn, debug_img, num_pos) = sample
+            yield np.copy(x_img), y_rpn, img_data_aug, debug_img, num_pos
+
+        except Exception as e:
+            print(e)
+            continue
+
+
+class PrefetchLoader:
+    """Load items ahead of their use with a pool of threads, keeping at most `prefetch` of them in memory
+
+    Iterating over the loader yields load_fn(item) for all the items, in order. While the consumer works on one
+    result, the next ones are loaded (reading and decoding images with cv2 releases the GIL). The loader records
+    how long the consumer waited for a result that was not ready (wait_time, over total_time for the whole
+    iteration) and how many results were ready each time one was requested (queue_depths).
+
+    Args:
+        items: list of the items to load (e.g. image paths)
+        load_fn: function loading one item (e.g. reading and pre-processing an image)
+        prefetch: number of items loaded ahead, 0 to load them in the consumer thread
+        workers: number of loading threads
+    """
+
+    def __init__(self, items, load_fn, prefetch=4, workers=2):
+        self.items = items
+        self.load_fn = load_fn
+        self.prefetch = prefetch
+        self.workers = workers
+        self.wait_time = 0.0
+        self.total_time = 0.0
+        self.queue_depths = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        st = time.time()
+
+        if self.prefetch <= 0:
+            for item in self.items:
+                start = time.time()
+                result = self.load_fn(item)
+                self.wait_time += time.time() - start
+                self.queue_depths.append(0)
+                yield result
+        else:
+            items = iter(self.items)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = deque(executor.submit(self.load_fn, item) for item in itertools.islice(items, self.prefetch))
+                while pending:
+                    future = pending.popleft()
+                    self.queue_depths.append(int(future.done()) + sum(f.done() for f in pending))
+
+                    start = time.time()
+                    result = future.result()
+                    self.wait_time += time.time() - start
+
+                    # keep `prefetch` items on their way
+                    for item in itertools.islice(items, 1):
+                        pending.append(executor.submit(self.load_fn, item))
+
+                    yield result
+
+        self.total_time += time.time() - st
+
+    def summary(self):
+        """Summarize the waiting time and the queue depth, to know if the loop is I/O-bound or compute-bound"""
+        mean_depth = np.mean(self.queue_depths) if self.queue_depths else 0.0
+        return 'Loaded {} items: waited {:.2f}s on loading out of {:.2f}s ({:.0f}%), mean queue depth {:.1f}/{}'.format(
+            len(self.queue_depths), self.wait_time, self.total_time, 100 * self.wait_time / max(self.total_time, 1e-9),
+            mean_depth, self.prefetch)
+
+
+def _cache_counters():
+    """Counters of the caches of the training targets in this process, in the order of CACHE_COUNTERS"""
+    return [anchor_grid_cache.hits, anchor_grid_cache.misses, rpn_target_cache.hits, rpn_target_cache.misses,
+            rpn_target_cache.evictions, rpn_target_cache.nbytes]
+
+
+CACHE_COUNTERS = ('anchor_grid_hits', 'anchor_grid_misses', 'rpn_target_hits', 'rpn_target_misses',
+                  'rpn_target_evictions', 'rpn_target_nbytes')
+
+
+def cache_stats(pool=None):
+    """Counters of the caches of the training targets (anchor_grid_cache and rpn_target_cache), summed over this
+    process and the worker processes of pool
+
+    The workers of an AnchorGtPool have their own caches, which the counters of this process do not see.
+
+    Args:
+        pool: get_anchor_gt_pool result, or None
+
+    Returns:
+        dict of the counters of CACHE_COUNTERS
+    """
+    counters = _cache_counters()
+    if isinstance(pool, AnchorGtPool):
+        counters = [count + worker_count for count, worker_count in zip(counters, pool.cache_counters())]
+    return dict(zip(CACHE_COUNTERS, counters))
+
+
+def _anchor_gt_worker(C, img_length_calc_function, mode, seed, task_queue, result_queue, cancelled_epoch, stop_event,
+                      cache_counters):
+    """Prepare the samples of get_anchor_gt in a worker process of AnchorGtPool
+
+    The worker gets (epoch, list of img_data) tasks and puts one (epoch, result) per image in the result queue: the
+    sample, or None if get_anchor_gt skipped the image. The rest of a task is dropped as soon as its epoch is cancelled
+    (closed before its end). The worker exits on a None task or when stop_event is set. The counters of its caches are
+    copied to cache_counters (shared with the pool) before each result is put.
+    """
+    # seed the augmentation (augment) and the anchor sampling (calc_rpn) of this worker
+    random.seed(seed)
+    np.random.seed(seed % (2 ** 32))
+
+    while not stop_event.is_set():
+        try:
+            task = task_queue.get(timeout=0.1)
+        except Empty:
+            continue
+        if task is None:
+            break
+
+        epoch, all_img_data = task
+        for img_data in all_img_data:
+            if epoch <= cancelled_epoch.value or stop_event.is_set():
+                break
+            sample = next(get_anchor_gt([img_data], C, img_length_calc_function, mode=mode), None)
+            cache_counters[:] = _cache_counters()
+
+            while epoch > cancelled_epoch.value and not stop_event.is_set():
+                try:
+                    result_queue.put((epoch, sample), timeout=0.1)
+                    break
+                except Full:
+                    continue
+
+    # do not wait for the samples left in the queue to be consumed before exiting
+    result_queue.cancel_join_thread()
+
+
+class AnchorGtPool:
+    """Prepare the samples of get_anchor_gt in worker processes
+
+    The workers are started once and prepare the images of every epoch given to epoch(). They are started with the
+    'spawn' method, since forking a process which already runs TensorFlow (or OpenCV) threads may deadlock the child.
+    Worker i prepares the images i, i + workers, i + 2 * workers... of an epoch with its own seed and puts them in its
+    own bounded queue.
+
+    Args:
+        C: config
+        img_length_calc_function: function to calculate final layer's feature map (of base model) size according to input image size
+        mode: 'train' or 'test'; 'train' mode need augmentation
+        workers: number of worker processes
+        prefetch: number of samples prepared ahead (shared between the workers)
+        seed: seed of the first worker (seed + i for worker i), drawn from `random` if None
+
+    Each worker has its own rpn_target_cache: C.rpn_target_cache_size is shared between them.
+    """
 
-            assert cols == width
-            assert rows == height
+    def __init__(self, C, img_length_calc_function, mode='train', workers=2, prefetch=8, seed=None):
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        C = copy.copy(C)
+        C.rpn_target_cache_size = getattr(C, 'rpn_target_cache_size', 0) / workers
+
+        context = multiprocessing.get_context('spawn')
+        self.workers = workers
+        self.num_epochs = 0
+        self.stop_event = context.Event()
+        self.cancelled_epoch = context.Value('i', 0)
+        self.task_queues = [context.Queue() for _ in range(workers)]
+        self.queues = [context.Queue(maxsize=max(1, -(-prefetch // workers))) for _ in range(workers)]
+        self.worker_cache_counters = [context.Array('q', len(CACHE_COUNTERS)) for _ in range(workers)]
+        self.processes = [context.Process(target=_anchor_gt_worker,
+                                          args=(C, img_length_calc_function, mode, seed + i, self.task_queues[i],
+                                                self.queues[i], self.cancelled_epoch, self.stop_event,
+                                                self.worker_cache_counters[i]),
+                                          daemon=True)
+                          for i in range(workers)]
+        for process in self.processes:
+            process.start()
+
+    def epoch(self, all_img_data, close_pool=False):
+        """Prepare the samples of all_img_data in the workers
+
+        The previous epoch must be finished or closed first.
+
+        Args:
+            all_img_data: list(filepath, width, height, list(bboxes))
+            close_pool: stop the workers at the end of the epoch
+
+        Returns:
+            AnchorGtPoolEpoch, drop-in replacement of the get_anchor_gt generator (next() and close()) giving the
+            samples in the order of all_img_data
+        """
+        self.num_epochs += 1
+        for i, task_queue in enumerate(self.task_queues):
+            task_queue.put((self.num_epochs, all_img_data[i::self.workers]))
+        return AnchorGtPoolEpoch(self, self.num_epochs, len(all_img_data), close_pool=close_pool)
+
+    def qsize(self):
+        """Number of samples ready in the queues (approximate, not available on every platform)"""
+        try:
+            return sum(queue.qsize() for queue in self.queues)
+        except NotImplementedError:
+            return -1
+
+    def cache_counters(self):
+        """Counters of the caches of the workers (see cache_stats), summed over the workers"""
+        return [sum(counters) for counters in zip(*(counters[:] for counters in self.worker_cache_counters))]
+
+    def close(self):
+        """Stop the workers and release the queues"""
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=1.0)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for queue in self.task_queues + self.queues:
+            queue.cancel_join_thread()
+            queue.close()
+
+
+class AnchorGtPoolEpoch:
+    """Samples of an epoch of AnchorGtPool, in the order of its img_data
+
+    The queues of the workers are read in turn. The samples left by a previous epoch closed before its end are dropped.
+    """
 
-            # get image dimensions for resizing
-            (resized_width, resized_height) = get_new_img_size(width, height, C.im_size)
+    def __init__(self, pool, epoch, num_samples, close_pool=False):
+        self.pool = pool
+        self.epoch = epoch
+        self.num_samples = num_samples
+        self.close_pool = close_pool
+        self.next_idx = 0
 
-            # resize the image so that smalles side is length = 300px
-            x_img = cv2.resize(x_img, (resized_width, resized_height), interpolation=cv2.INTER_CUBIC)
-            debug_img = x_img.copy()
+    def __iter__(self):
+        return self
 
+    def __next__(self):
+        while self.next_idx < self.num_samples:
+            worker = self.next_idx % self.pool.workers
             try:
-                y_rpn_cls, y_rpn_regr, num_pos = calc_rpn(C, img_data_aug, width, height, resized_width,
-                                                          resized_height, img_length_calc_function)
-            except:
+                epoch, sample = self.pool.queues[worker].get(timeout=1.0)
+            except Empty:
+                if self.pool.processes[worker].is_alive():
+                    continue
+                print('Data worker {} stopped unexpectedly'.format(worker))
+                break
+
+            if epoch != self.epoch:
                 continue
+            self.next_idx += 1
+            if sample is not None:
+                return sample
 
-            # Zero-center by mean pixel, and preprocess image
+        self.close()
+        raise StopIteration
 
-            x_img = preprocess_img(x_img, C)
-            x_img = x_img[:, :, (2, 1, 0)]  # BGR -> RGB
-            x_img = x_img.astype(np.float32)
-            x_img[:, :, 0] -= C.img_channel_mean[0]
-            x_img[:, :, 1] -= C.img_channel_mean[1]
-            x_img[:, :, 2] -= C.img_channel_mean[2]
-            x_img /= C.img_scaling_factor
+    def qsize(self):
+        """Number of samples ready in the queues (approximate, not available on every platform)"""
+        return self.pool.qsize()
 
-            x_img = np.transpose(x_img, (2, 0, 1))
-            x_img = np.expand_dims(x_img, axis=0)
+    def close(self):
+        """Stop preparing the samples of this epoch (and the workers if close_pool)"""
+        self.next_idx = self.num_samples
+        with self.pool.cancelled_epoch.get_lock():
+            self.pool.cancelled_epoch.value = max(self.pool.cancelled_epoch.value, self.epoch)
+        if self.close_pool:
+            self.pool.close()
 
-            y_rpn_regr[:, y_rpn_regr.shape[1] // 2:, :, :] *= C.std_scaling
 
-            x_img = np.transpose(x_img, (0, 2, 3, 1))
-            y_rpn_cls = np.transpose(y_rpn_cls, (0, 2, 3, 1))
-            y_rpn_regr = np.transpose(y_rpn_regr, (0, 2, 3, 1))
+def augment_tf(img, draws, C):
+    """augment() of an image with TensorFlow ops, for anchor_gt_dataset
 
-            yield np.copy(x_img), [np.copy(y_rpn_cls), np.copy(y_rpn_regr)], img_data_aug, debug_img, num_pos
+    Args:
+        img: shape=(rows, cols, 3), uint8, BGR image
+        draws: shape=(4,), uniform draws in [0, 1) of the horizontal flip, the vertical flip, the brightness jitter
+            and the rotation
+        C: config (use_horizontal_flips, use_vertical_flips, use_brightness_jitter, brightness_jitter_bound, rot_90)
 
-        except Exception as e:
-            print(e)
-            continue
+    Returns:
+        the augmented image, and the horizontal_flip, vertical_flip and angle of augment_bboxes
+    """
+    horizontal_flip = tf.logical_and(C.use_horizontal_flips, draws[0] < 0.5)
+    img = tf.cond(horizontal_flip, lambda: tf.image.flip_left_right(img), lambda: img)
 
+    vertical_flip = tf.logical_and(C.use_vertical_flips, draws[1] < 0.5)
+    img = tf.cond(vertical_flip, lambda: tf.image.flip_up_down(img), lambda: img)
 
-def non_max_suppression_fast(boxes, probs, overlap_thresh=0.9, max_boxes=300):
-    # code used from here: http://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
-    # if there are no boxes, return an empty list
+    if C.use_brightness_jitter:
+        # rounded and saturated to uint8 as by cv2.addWeighted
+        alpha = 1.0 + C.brightness_jitter_bound * (2.0 * draws[2] - 1.0)
+        img = tf.cast(tf.clip_by_value(tf.round(tf.cast(img, tf.float32) * alpha), 0.0, 255.0), tf.uint8)
 
-    # Process explanation:
-    #   Step 1: Sort the probs list
-    #   Step 2: Find the larget prob 'Last' in the list and save it to the pick list
-    #   Step 3: Calculate the IoU with 'Last' box and other boxes in the list. If the IoU is larger than overlap_threshold, delete the box from list
-    #   Step 4: Repeat step 2 and step 3 until there is no item in the probs list
-    if len(boxes) == 0:
-        return []
+    # quarter turns of the clockwise rotation of augment(), tf.image.rot90 turns counterclockwise
+    quarter_turns = tf.cast(draws[3] * 4, tf.int32) if C.rot_90 else tf.constant(0)
+    img = tf.image.rot90(img, k=(4 - quarter_turns) % 4)
 
-    # grab the coordinates of the bounding boxes
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
+    return img, horizontal_flip, vertical_flip, 90 * quarter_turns
 
-    np.testing.assert_array_less(x1, x2)
-    np.testing.assert_array_less(y1, y2)
 
-    # if the bounding boxes integers, convert them to floats --
-    # this is important since we'll be doing a bunch of divisions
-    if boxes.dtype.kind == "i":
-        boxes = boxes.astype("float")
+def augmented_img_data(img_data, rows, cols, horizontal_flip, vertical_flip, angle):
+    """img_data of an image of rows x cols pixels augmented by augment_tf (img_data_aug of augment)"""
+    img_data_aug = copy.deepcopy(img_data)
+    augment_bboxes(img_data_aug['bboxes'], rows, cols, horizontal_flip, vertical_flip, angle)
+    (img_data_aug['width'], img_data_aug['height']) = (rows, cols) if angle in (90, 270) else (cols, rows)
+    return img_data_aug
 
-    # initialize the list of picked indexes
-    pick = []
 
-    # calculate the areas
-    area = (x2 - x1) * (y2 - y1)
+def img_dataset(all_img_data, num_parallel_calls):
+    """tf.data.Dataset of the (filepath, image) of all_img_data, read by read_img in num_parallel_calls threads
 
-    # sort the bounding boxes
-    idxs = np.argsort(probs)
+    The unreadable images are skipped.
+    """
+    img_datas = {img_data['filepath']: img_data for img_data in all_img_data}
 
-    # keep looping while some indexes still remain in the indexes
-    # list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the
-        # index value to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
-        pick.append(i)
+    def read(filepath):
+        img = read_img(img_datas[filepath.decode()])
+        if img is None:
+            print('Cannot read {}'.format(filepath.decode()))
+            return np.zeros((0, 0, 3), dtype=np.uint8)
+        return img
 
-        # find the intersection
+    dataset = tf.data.Dataset.from_tensor_slices([img_data['filepath'] for img_data in all_img_data])
+    dataset = dataset.map(lambda filepath: (filepath, tf.numpy_function(read, [filepath], tf.uint8)),
+                          num_parallel_calls=num_parallel_calls)
+    return dataset.filter(lambda filepath, img: tf.size(img) > 0)
 
-        xx1_int = np.maximum(x1[i], x1[idxs[:last]])
-        yy1_int = np.maximum(y1[i], y1[idxs[:last]])
-        xx2_int = np.minimum(x2[i], x2[idxs[:last]])
-        yy2_int = np.minimum(y2[i], y2[idxs[:last]])
 
-        ww_int = np.maximum(0, xx2_int - xx1_int)
-        hh_int = np.maximum(0, yy2_int - yy1_int)
+class ImgDatasetCache:
+    """Images read by anchor_gt_dataset, kept in memory for the next datasets of the same images (C.data_cache)
 
-        area_int = ww_int * hh_int
+    One img_dataset is cached per image set until close(). Each holds the decoded images of its set, as read by
+    read_img: rows x cols x 3 bytes per image, e.g. 360 kB for an image resized to 300 x 400 by the image cache, but
+    6 MB for a full-resolution 1080p image.
+    """
 
-        # find the union
-        area_union = area[i] + area[idxs[:last]] - area_int
+    def __init__(self):
+        self.datasets = {}
 
-        # compute the ratio of overlap
-        overlap = area_int / (area_union + 1e-6)
+    def dataset(self, all_img_data, num_parallel_calls):
+        """Cached img_dataset of the images of all_img_data, sorted by filepath"""
+        img_datas = {img_data['filepath']: img_data for img_data in all_img_data}
+        key = tuple(sorted(img_datas))
+        if key not in self.datasets:
+            self.datasets[key] = img_dataset([img_datas[filepath] for filepath in key], num_parallel_calls).cache()
+        return self.datasets[key]
 
-        # delete all indexes from the index list that have
-        idxs = np.delete(idxs, np.concatenate(([last],
-                                               np.where(overlap > overlap_thresh)[0])))
+    def close(self):
+        """Release the images kept in memory"""
+        self.datasets = {}
 
-        if len(pick) >= max_boxes:
-            break
 
-    # return only the bounding boxes that were picked using the integer data type
-    boxes = boxes[pick].astype("int")
-    probs = probs[pick]
-    return boxes, probs
+def anchor_gt_dataset(all_img_data, C, img_length_calc_function, mode='train', num_parallel_calls=None, cache=None,
+                      seed=None):
+    """tf.data pipeline preparing the samples of get_anchor_gt
 
+    The images are read by read_img (img_dataset), augmented with TensorFlow ops (augment_tf), and resized and
+    pre-processed with their rpn targets computed by anchor_gt_sample, in NumPy through tf.numpy_function. Each
+    stage prepares num_parallel_calls images in parallel. The augmentation of the i-th image is drawn from
+    (seed, i); the sampling of the anchors by calc_rpn still draws from `random`.
 
-def non_max_suppression_fast_with_all_probs(boxes, probs, all_probs, overlap_thresh=0.9, max_boxes=300):
-    # code used from here: http://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
-    # if there are no boxes, return an empty list
+    Args:
+        all_img_data: list(filepath, width, height, list(bboxes))
+        C: config
+        img_length_calc_function: function to calculate final layer's feature map (of base model) size according to input image size
+        mode: 'train' or 'test'; 'train' mode need augmentation
+        num_parallel_calls: number of images prepared in parallel, tf.data.experimental.AUTOTUNE if None
+        cache: ImgDatasetCache keeping the images read in memory, for the next datasets of the same images, None to
+            read them again. With a cache, the images come in a random order instead of the order of all_img_data
+        seed: seed of the augmentation, drawn from `random` if None
+
+    Returns:
+        tf.data.Dataset of (filepath, x_img, rows, cols, horizontal_flip, vertical_flip, angle, rpn_shape, valid_idx,
+        pos_idx, pos_regr, num_pos): the image before its batch axis, the size of the image before the
+        augmentation, the augmentation (augmented_img_data) and the fields of the SparseRpnTargets
+    """
+    if num_parallel_calls is None:
+        num_parallel_calls = tf.data.experimental.AUTOTUNE
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+
+    img_datas = {img_data['filepath']: img_data for img_data in all_img_data}
+
+    if cache is not None:
+        # the images come out of the cache in the same order for every dataset
+        dataset = cache.dataset(all_img_data, num_parallel_calls).shuffle(len(img_datas), seed=seed)
+    else:
+        dataset = img_dataset(all_img_data, num_parallel_calls)
+
+    def augment_img(index, element):
+        (filepath, img) = element
+        (rows, cols) = (tf.shape(img)[0], tf.shape(img)[1])
+        if mode == 'train':
+            draws = tf.random.stateless_uniform([4], seed=tf.stack([tf.constant(seed, dtype=tf.int64), index]))
+            (img, horizontal_flip, vertical_flip, angle) = augment_tf(img, draws, C)
+        else:
+            (horizontal_flip, vertical_flip, angle) = (tf.constant(False), tf.constant(False), tf.constant(0))
+        return filepath, img, rows, cols, horizontal_flip, vertical_flip, angle
+
+    def prepare_sample(filepath, img, rows, cols, horizontal_flip, vertical_flip, angle):
+        # resize and pre-process the augmented image, and compute its rpn targets
+        try:
+            img_data_aug = augmented_img_data(img_datas[filepath.decode()], int(rows), int(cols),
+                                              bool(horizontal_flip), bool(vertical_flip), int(angle))
+            sample = anchor_gt_sample(img_data_aug, img, C, img_length_calc_function)
+        except Exception as e:
+            print(e)
+            sample = None
+
+        if sample is None:
+            return (False, np.zeros((0, 0, 3), dtype=np.float32), np.zeros(3, dtype=np.int64),
+                    np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros((0, 4), dtype=np.float32),
+                    np.int64(0))
+
+        (x_img, y_rpn, _, num_pos) = sample
+        return (True, x_img[0], np.array(y_rpn.shape, dtype=np.int64), y_rpn.valid_idx.astype(np.int32),
+                y_rpn.pos_idx.astype(np.int32), y_rpn.pos_regr.astype(np.float32), np.int64(num_pos))
+
+    def sample(filepath, img, rows, cols, horizontal_flip, vertical_flip, angle):
+        outputs = tf.numpy_function(prepare_sample, [filepath, img, rows, cols, horizontal_flip, vertical_flip, angle],
+                                    [tf.bool, tf.float32, tf.int64, tf.int32, tf.int32, tf.float32, tf.int64])
+        return outputs[0], (filepath, outputs[1], rows, cols, horizontal_flip, vertical_flip, angle) + tuple(outputs[2:])
+
+    dataset = dataset.enumerate().map(augment_img, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.map(sample, num_parallel_calls=num_parallel_calls)
+    # skip the images whose sample failed, as get_anchor_gt
+    dataset = dataset.filter(lambda ok, sample: ok)
+    dataset = dataset.map(lambda ok, sample: sample)
+    return dataset
+
+
+class AnchorGtDataset:
+    """Prepare the samples of get_anchor_gt with a tf.data pipeline (anchor_gt_dataset)
+
+    Drop-in replacement of the get_anchor_gt generator (next() and close()). The samples come in the order of
+    all_img_data (in a random order with a cache) and debug_img is None.
+
+    Args:
+        all_img_data: list(filepath, width, height, list(bboxes))
+        C: config
+        img_length_calc_function: function to calculate final layer's feature map (of base model) size according to input image size
+        mode: 'train' or 'test'; 'train' mode need augmentation
+        num_parallel_calls: number of images prepared in parallel, tf.data.experimental.AUTOTUNE if None
+        prefetch: number of samples prepared ahead
+        cache: ImgDatasetCache keeping the images read in memory for the next epochs, None to read them again (see
+            anchor_gt_dataset)
+        seed: seed of the augmentation, drawn from `random` if None
+    """
+
+    def __init__(self, all_img_data, C, img_length_calc_function, mode='train', num_parallel_calls=None, prefetch=8,
+                 cache=None, seed=None):
+        self.img_datas = {img_data['filepath']: img_data for img_data in all_img_data}
+        self.dataset = anchor_gt_dataset(all_img_data, C, img_length_calc_function, mode=mode,
+                                         num_parallel_calls=num_parallel_calls, cache=cache,
+                                         seed=seed).prefetch(prefetch)
+        self.iterator = iter(self.dataset)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            raise StopIteration
+
+        (filepath, x_img, rows, cols, horizontal_flip, vertical_flip, angle, rpn_shape, valid_idx, pos_idx, pos_regr,
+         num_pos) = [tensor.numpy() for tensor in next(self.iterator)]
+
+        img_data_aug = augmented_img_data(self.img_datas[filepath.decode()], int(rows), int(cols),
+                                          bool(horizontal_flip), bool(vertical_flip), int(angle))
+        y_rpn = SparseRpnTargets(rpn_shape, valid_idx, pos_idx, pos_regr)
+        return np.expand_dims(x_img, axis=0), y_rpn, img_data_aug, None, int(num_pos)
+
+    def close(self):
+        """Stop the pipeline (the images prepared ahead are dropped)"""
+        self.iterator = None
+
+
+def get_anchor_gt_pool(C, img_length_calc_function, mode='train'):
+    """What get_anchor_gt_loader reuses from an epoch to the next one, to close at the end of the training: the
+    AnchorGtPool of C.data_workers processes, the ImgDatasetCache of the tf.data pipeline when C.data_cache, or None"""
+    workers = getattr(C, 'data_workers', 0)
+    if getattr(C, 'data_pipeline', 'python') == 'tf.data':
+        return ImgDatasetCache() if getattr(C, 'data_cache', False) else None
+    if workers <= 0:
+        return None
+    return AnchorGtPool(C, img_length_calc_function, mode=mode, workers=workers,
+                        prefetch=getattr(C, 'data_prefetch', 8))
+
+
+def get_anchor_gt_loader(all_img_data, C, img_length_calc_function, mode='train', pool=None):
+    """get_anchor_gt, prepared by a tf.data pipeline (AnchorGtDataset) when C.data_pipeline is 'tf.data', or run by
+    C.data_workers processes (AnchorGtPool) when C.data_workers > 0
+
+    The worker processes, or the images kept in memory by the tf.data pipeline, are the ones of pool (see
+    get_anchor_gt_pool) if given. Otherwise the worker processes are started for this epoch only and the images are
+    not kept in memory."""
+    workers = getattr(C, 'data_workers', 0)
+    if getattr(C, 'data_pipeline', 'python') == 'tf.data':
+        return AnchorGtDataset(all_img_data, C, img_length_calc_function, mode=mode,
+                               num_parallel_calls=workers if workers > 0 else None,
+                               prefetch=getattr(C, 'data_prefetch', 8), cache=pool)
+    if pool is not None:
+        return pool.epoch(all_img_data)
+    if workers > 0:
+        return get_anchor_gt_pool(C, img_length_calc_function, mode=mode).epoch(all_img_data, close_pool=True)
+    return get_anchor_gt(all_img_data, C, img_length_calc_function, mode=mode)
+
+
+def batch_by_aspect_ratio(samples, batch_size, bucket_width=0.25):
+    """Group the samples of get_anchor_gt in batches of images of close aspect ratios
+
+    The samples are put in buckets according to the aspect ratio of their (augmented) image, and a bucket is
+    yielded as a batch as soon as it holds batch_size samples, so the images stacked by stack_anchor_gt_batch need
+    little padding. The samples left in the buckets at the end are yielded as smaller batches. With batch_size=1,
+    the samples are yielded one by one, in order.
+
+    Args:
+        samples: iterable over the samples of get_anchor_gt (or of get_anchor_gt_loader)
+        batch_size: number of samples per batch
+        bucket_width: width of the buckets in log2(width / height)
+
+    Yields:
+        list of at most batch_size samples
+    """
+    buckets = {}
+    for sample in samples:
+        (_, rows, cols, _) = sample[0].shape
+        key = int(round(math.log2(cols / rows) / bucket_width))
+        bucket = buckets.setdefault(key, [])
+        bucket.append(sample)
+        if len(bucket) == batch_size:
+            yield buckets.pop(key)
+
+    for bucket in buckets.values():
+        yield bucket
+
+
+def stack_anchor_gt_batch(batch):
+    """Stack the samples of a batch of batch_by_aspect_ratio into the inputs and targets of model_rpn
+
+    The images are padded with zeros (the mean pixel) at the bottom and at the right to the largest height and width
+    of the batch, and the rpn targets of the padded part of the feature map are not valid anchors, so the padding is
+    ignored by the rpn losses.
+
+    Returns:
+        X: shape=(batch_size, rows, cols, 3), images
+        Y: [y_rpn_cls, y_rpn_regr], shape=(batch_size, feature map rows, feature map cols, 2/8*num_anchors)
+        img_datas: augmented image data of the images
+    """
+    rows = max(X.shape[1] for X, _, _, _, _ in batch)
+    cols = max(X.shape[2] for X, _, _, _, _ in batch)
+    (rpn_rows, rpn_cols) = (max(Y.shape[0] for _, Y, _, _, _ in batch), max(Y.shape[1] for _, Y, _, _, _ in batch))
+    num_anchors = batch[0][1].shape[2]
+
+    X_batch = np.zeros((len(batch), rows, cols, 3), dtype=np.float32)
+    y_rpn_cls = np.zeros((len(batch), rpn_rows, rpn_cols, 2 * num_anchors), dtype=np.float32)
+    y_rpn_regr = np.zeros((len(batch), rpn_rows, rpn_cols, 8 * num_anchors), dtype=np.float32)
+    for i, (X, Y, _, _, _) in enumerate(batch):
+        X_batch[i, :X.shape[1], :X.shape[2]] = X[0]
+        (y_cls, y_regr) = Y.dense()
+        y_rpn_cls[i, :Y.shape[0], :Y.shape[1]] = y_cls[0]
+        y_rpn_regr[i, :Y.shape[0], :Y.shape[1]] = y_regr[0]
+
+    return X_batch, [y_rpn_cls, y_rpn_regr], [img_data for _, _, img_data, _, _ in batch]
+
+
+def non_max_suppression_pick(boxes, probs, overlap_thresh=0.9, max_boxes=300, top_k=None, class_ids=None,
+                             check_boxes=False):
+    """Find the bboxes kept by non-max-suppression
+    Code adapted from: http://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
+
+    Process explanation:
+      Step 1: Sort the bboxes by decreasing probs (and only keep the top_k first ones)
+      Step 2: Pick the first bbox that has not been suppressed yet
+      Step 3: Calculate the IoU with the picked box and all the bboxes after it. If the IoU is larger than
+              overlap_thresh, suppress the bbox
+      Step 4: Repeat step 2 and step 3 until there is no bbox left or max_boxes bboxes have been picked
 
-    # Process explanation:
-    #   Step 1: Sort the probs list
-    #   Step 2: Find the larget prob 'Last' in the list and save it to the pick list
-    #   Step 3: Calculate the IoU with 'Last' box and other boxes in the list. If the IoU is larger than overlap_threshold, delete the box from list
-    #   Step 4: Repeat step 2 and step 3 until there is no item in the probs list
+    Args:
+        boxes: shape=(N, 4) with ordering (x1,y1,x2,y2)
+        probs: shape=(N,) probability of each bbox
+        overlap_thresh: If iou with a picked bbox is larger than this threshold, drop the box
+        max_boxes: max bboxes number to pick
+        top_k: number of bboxes with the highest probs considered for the suppression (None to consider all of them)
+        class_ids: shape=(N,) class of each bbox. The bboxes of each class are shifted so that bboxes of different
+            classes never overlap, which runs the suppression of all the classes in a single pass
+        check_boxes: check that x1 < x2 and y1 < y2 for all bboxes (for debugging)
+
+    Returns:
+        pick: indexes of the picked bboxes, sorted by decreasing probs
+    """
     if len(boxes) == 0:
-        return []
+        return np.zeros(0, dtype=int)
 
-    # grab the coordinates of the bounding boxes
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
+    if check_boxes:
+        np.testing.assert_array_less(boxes[:, 0], boxes[:, 2])
+        np.testing.assert_array_less(boxes[:, 1], boxes[:, 3])
 
-    np.testing.assert_array_less(x1, x2)
-    np.testing.assert_array_less(y1, y2)
+    # sort the bounding boxes, the box with the largest prob comes first
+    order = np.argsort(probs)[::-1]
+    if top_k is not None:
+        order = order[:top_k]
 
     # if the bounding boxes integers, convert them to floats --
     # this is important since we'll be doing a bunch of divisions
-    if boxes.dtype.kind == "i":
-        boxes = boxes.astype("float")
-
-    # initialize the list of picked indexes
-    pick = []
+    x1 = boxes[order, 0].astype(np.float64)
+    y1 = boxes[order, 1].astype(np.float64)
+    x2 = boxes[order, 2].astype(np.float64)
+    y2 = boxes[order, 3].astype(np.float64)
 
     # calculate the areas
     area = (x2 - x1) * (y2 - y1)
 
-    # sort the bounding boxes
-    idxs = np.argsort(probs)
+    if class_ids is not None:
+        # move the bboxes of each class to their own region of the plane
+        offset = np.asarray(class_ids)[order] * (np.max(boxes[order]) - np.min(boxes[order]) + 1.0)
+        x1 = x1 + offset
+        y1 = y1 + offset
+        x2 = x2 + offset
+        y2 = y2 + offset
+
+    pick = []
+    suppressed = np.zeros(len(order), dtype=bool)
 
-    # keep looping while some indexes still remain in the indexes
-    # list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the
-        # index value to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
         pick.append(i)
 
-        # find the intersection
+        if len(pick) >= max_boxes:
+            break
 
-        xx1_int = np.maximum(x1[i], x1[idxs[:last]])
-        yy1_int = np.maximum(y1[i], y1[idxs[:last]])
-        xx2_int = np.minimum(x2[i], x2[idxs[:last]])
-        yy2_int = np.minimum(y2[i], y2[idxs[:last]])
+        # find the intersection with all the following bboxes
+        xx1_int = np.maximum(x1[i], x1[i + 1:])
+        yy1_int = np.maximum(y1[i], y1[i + 1:])
+        xx2_int = np.minimum(x2[i], x2[i + 1:])
+        yy2_int = np.minimum(y2[i], y2[i + 1:])
 
         ww_int = np.maximum(0, xx2_int - xx1_int)
         hh_int = np.maximum(0, yy2_int - yy1_int)
@@ -927,23 +2230,51 @@ def non_max_suppression_fast_with_all_probs(boxes, probs, all_probs, overlap_thr
         area_int = ww_int * hh_int
 
         # find the union
-        area_union = area[i] + area[idxs[:last]] - area_int
+        area_union = area[i] + area[i + 1:] - area_int
 
         # compute the ratio of overlap
         overlap = area_int / (area_union + 1e-6)
 
-        # delete all indexes from the index list that have
-        idxs = np.delete(idxs, np.concatenate(([last],
-                                               np.where(overlap > overlap_thresh)[0])))
+        # suppress all the bboxes that overlap too much with the picked one
+        suppressed[i + 1:] |= overlap > overlap_thresh
 
-        if len(pick) >= max_boxes:
-            break
+    return order[pick]
+
+
+def non_max_suppression(boxes, probs, *payloads, overlap_thresh=0.9, max_boxes=300, top_k=None, class_ids=None,
+                        check_boxes=False):
+    """Apply non-max-suppression to bboxes and to the data attached to them
+
+    Args:
+        boxes: shape=(N, 4) with ordering (x1,y1,x2,y2)
+        probs: shape=(N,) probability of each bbox
+        payloads: arrays of shape (N, ...) carried along with the bboxes (e.g. the probs of all the classes)
+        overlap_thresh, max_boxes, top_k, class_ids, check_boxes: see non_max_suppression_pick
+
+    Returns:
+        boxes, probs, *payloads of the picked bboxes, sorted by decreasing probs. The boxes are converted to int
+    """
+    pick = non_max_suppression_pick(boxes, probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes, top_k=top_k,
+                                    class_ids=class_ids, check_boxes=check_boxes)
 
     # return only the bounding boxes that were picked using the integer data type
-    boxes = boxes[pick].astype("int")
-    probs = probs[pick]
-    all_probs = all_probs[pick]
-    return boxes, probs, all_probs
+    return (boxes[pick].astype("int"), probs[pick]) + tuple(payload[pick] for payload in payloads)
+
+
+def non_max_suppression_fast(boxes, probs, overlap_thresh=0.9, max_boxes=300):
+    # if there are no boxes, return an empty list
+    if len(boxes) == 0:
+        return []
+
+    return non_max_suppression(boxes, probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes)
+
+
+def non_max_suppression_fast_with_all_probs(boxes, probs, all_probs, overlap_thresh=0.9, max_boxes=300):
+    # if there are no boxes, return an empty list
+    if len(boxes) == 0:
+        return []
+
+    return non_max_suppression(boxes, probs, all_probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes)
 
 
 def apply_regr_np(X, T):
@@ -1014,11 +2345,62 @@ def apply_regr(x, y, w, h, tx, ty, tw, th):
         return x, y, w, h
 
 
-def calc_iou(R, img_data, C, class_mapping):
-    """Converts from (x1,y1,x2,y2) to (x,y,w,h) format
+def decode_classifier_output(P_cls, P_regr, ROIs, C, bbox_threshold=0.0):
+    """Convert the classifier outputs of the rois of one image into bboxes, grouped by class
 
     Args:
-        R: bboxes, probs
+        P_cls: shape=(1, num_rois, nb_classes) class probabilities, 'bg' being the last class
+        P_regr: shape=(1, num_rois, 4 * (nb_classes - 1)) class-specific regressions
+        ROIs: shape=(1, num_rois, 4) rois on the feature map, with ordering (x, y, w, h)
+        C: config
+        bbox_threshold: rois whose highest class probability is lower are dropped
+
+    Returns:
+        dict class number -> (bboxes, probs, all_probs), in order of first appearance among the rois
+        bboxes: shape=(n, 4) regressed (x1, y1, x2, y2) on the resized image
+        probs: shape=(n,) probability of the class
+        all_probs: shape=(n, nb_classes) probabilities of all the classes
+    """
+    P_cls = P_cls[0]
+    nb_classes = P_cls.shape[1]
+
+    cls_num = np.argmax(P_cls, axis=1)
+    probs = P_cls[np.arange(P_cls.shape[0]), cls_num]
+
+    # Ignore 'bg' class and the rois under the threshold
+    keep = np.where((probs >= bbox_threshold) & (cls_num != nb_classes - 1))[0]
+    cls_num = cls_num[keep]
+
+    # Regression of the predicted class of every roi
+    regr = P_regr[0, keep].reshape((len(keep), nb_classes - 1, 4))[np.arange(len(keep)), cls_num]
+    tx, ty, tw, th = (regr.astype(np.float64) / np.array(C.classifier_regr_std)).T
+    x, y, w, h = ROIs[0, keep].astype(np.float64).T
+
+    # Same transform as apply_regr, the rois whose regression overflows are kept as they are
+    with np.errstate(over='ignore', invalid='ignore'):
+        cx1 = tx * w + (x + w / 2.)
+        cy1 = ty * h + (y + h / 2.)
+        w1 = np.exp(tw) * w
+        h1 = np.exp(th) * h
+        regressed = np.round([cx1 - w1 / 2., cy1 - h1 / 2., w1, h1])
+    valid = np.all(np.isfinite(regressed), axis=0)
+    x, y, w, h = np.where(valid, regressed, [x, y, w, h])
+
+    bboxes = C.rpn_stride * np.stack([x, y, x + w, y + h], axis=1)
+
+    detections = OrderedDict()
+    for cls in cls_num[np.sort(np.unique(cls_num, return_index=True)[1])]:
+        idx = np.where(cls_num == cls)[0]
+        detections[cls] = (bboxes[idx], probs[keep[idx]], P_cls[keep[idx]])
+
+    return detections
+
+
+def feature_map_gt_boxes(img_data, C):
+    """GT bboxes of an image on the feature map
+
+    Returns:
+        gta: shape=(num_bboxes, 4) with ordering (x1,x2,y1,y2)
     """
     bboxes = img_data['bboxes']
     (width, height) = (img_data['width'], img_data['height'])
@@ -1035,90 +2417,85 @@ def calc_iou(R, img_data, C, class_mapping):
         gta[bbox_num, 2] = int(round(bbox['y1'] * (resized_height / float(height))/C.rpn_stride))
         gta[bbox_num, 3] = int(round(bbox['y2'] * (resized_height / float(height))/C.rpn_stride))
 
-    x_roi = []
-    y_class_num = []
-    y_class_regr_coords = []
-    y_class_regr_label = []
-    IoUs = [] # for debugging only
-
-    # R.shape[0]: number of bboxes (=300 from non_max_suppression)
-    for ix in range(R.shape[0]):
-        (x1, y1, x2, y2) = R[ix, :]
-        x1 = int(round(x1))
-        y1 = int(round(y1))
-        x2 = int(round(x2))
-        y2 = int(round(y2))
+    return gta
 
-        best_iou = 0.0
-        best_bbox = -1
-        # Iterate through all the ground-truth bboxes to calculate the iou
-        for bbox_num in range(len(bboxes)):
-            curr_iou = iou([gta[bbox_num, 0], gta[bbox_num, 2], gta[bbox_num, 1], gta[bbox_num, 3]], [x1, y1, x2, y2])
 
-            # Find out the corresponding ground-truth bbox_num with larget iou
-            if curr_iou > best_iou:
-                best_iou = curr_iou
-                best_bbox = bbox_num
+def calc_iou(R, img_data, C, class_mapping):
+    """Converts from (x1,y1,x2,y2) to (x,y,w,h) format
 
-        if best_iou < C.classifier_min_overlap:
-                continue
-        else:
-            w = x2 - x1
-            h = y2 - y1
-            x_roi.append([x1, y1, w, h])
-            IoUs.append(best_iou)
-
-            if C.classifier_min_overlap <= best_iou < C.classifier_max_overlap:
-                # hard negative example
-                cls_name = 'bg'
-            elif C.classifier_max_overlap <= best_iou:
-                cls_name = bboxes[best_bbox]['class']
-                cxg = (gta[best_bbox, 0] + gta[best_bbox, 1]) / 2.0
-                cyg = (gta[best_bbox, 2] + gta[best_bbox, 3]) / 2.0
-
-                cx = x1 + w / 2.0
-                cy = y1 + h / 2.0
-
-                tx = (cxg - cx) / float(w)
-                ty = (cyg - cy) / float(h)
-                tw = np.log((gta[best_bbox, 1] - gta[best_bbox, 0]) / float(w))
-                th = np.log((gta[best_bbox, 3] - gta[best_bbox, 2]) / float(h))
-            else:
-                print('roi = {}'.format(best_iou))
-                raise RuntimeError
-
-        class_num = class_mapping[cls_name]
-        class_label = len(class_mapping) * [0]
-        class_label[class_num] = 1
-        y_class_num.append(copy.deepcopy(class_label))
-        coords = [0] * 4 * (len(class_mapping) - 1)
-        labels = [0] * 4 * (len(class_mapping) - 1)
-        if cls_name != 'bg':
-            label_pos = 4 * class_num
-            sx, sy, sw, sh = C.classifier_regr_std
-            coords[label_pos:4+label_pos] = [sx*tx, sy*ty, sw*tw, sh*th]
-            labels[label_pos:4+label_pos] = [1, 1, 1, 1]
-            y_class_regr_coords.append(copy.deepcopy(coords))
-            y_class_regr_label.append(copy.deepcopy(labels))
-        else:
-            y_class_regr_coords.append(copy.deepcopy(coords))
-            y_class_regr_label.append(copy.deepcopy(labels))
+    Args:
+        R: bboxes, probs
+    """
+    bboxes = img_data['bboxes']
+    gta = feature_map_gt_boxes(img_data, C)
 
-    if len(x_roi) == 0:
+    if len(bboxes) == 0:
         return None, None, None, None
 
+    # R.shape[0]: number of bboxes (=300 from non_max_suppression)
+    rois = np.round(R[:, :4]).astype(int)
+
+    # IOU of every ground-truth bbox (rows) with every bbox (columns)
+    overlaps = iou_np(gta[:, (0, 2, 1, 3)], rois)
+
+    # Find out the corresponding ground-truth bbox_num with larget iou
+    best_bbox = np.argmax(overlaps, axis=0)
+    best_iou = overlaps[best_bbox, np.arange(rois.shape[0])]
+
     # bboxes that iou > C.classifier_min_overlap for all gt bboxes in 300 non_max_suppression bboxes
-    X = np.array(x_roi)
+    keep = np.where(best_iou >= C.classifier_min_overlap)[0]
+    if len(keep) == 0:
+        return None, None, None, None
+
+    rois = rois[keep]
+    best_bbox = best_bbox[keep]
+    best_iou = best_iou[keep]
+    IoUs = best_iou.tolist() # for debugging only
+
+    (x1, y1, x2, y2) = (rois[:, 0], rois[:, 1], rois[:, 2], rois[:, 3])
+    w = x2 - x1
+    h = y2 - y1
+    X = np.stack([x1, y1, w, h], axis=1)
+
+    # C.classifier_min_overlap <= best_iou < C.classifier_max_overlap: hard negative example
+    # C.classifier_max_overlap <= best_iou: class of the best ground-truth bbox
+    bbox_class_num = np.array([class_mapping[bbox['class']] for bbox in bboxes], dtype=int)
+    class_num = np.where(best_iou >= C.classifier_max_overlap, bbox_class_num[best_bbox], class_mapping['bg'])
+
     # one hot code for bboxes from above => x_roi (X)
-    Y1 = np.array(y_class_num)
+    Y1 = np.zeros((len(keep), len(class_mapping)), dtype=int)
+    Y1[np.arange(len(keep)), class_num] = 1
+
     # corresponding labels and corresponding gt bboxes
-    Y2 = np.concatenate([np.array(y_class_regr_label),np.array(y_class_regr_coords)],axis=1)
+    y_class_regr_label = np.zeros((len(keep), 4 * (len(class_mapping) - 1)))
+    y_class_regr_coords = np.zeros((len(keep), 4 * (len(class_mapping) - 1)))
 
-    return np.expand_dims(X, axis=0), np.expand_dims(Y1, axis=0), np.expand_dims(Y2, axis=0), IoUs
+    regr_idx = np.where(class_num != class_mapping['bg'])[0]
+    if len(regr_idx) > 0:
+        gt = gta[best_bbox[regr_idx]]
+        cxg = (gt[:, 0] + gt[:, 1]) / 2.0
+        cyg = (gt[:, 2] + gt[:, 3]) / 2.0
+
+        cx = x1[regr_idx] + w[regr_idx] / 2.0
+        cy = y1[regr_idx] + h[regr_idx] / 2.0
+
+        tx = (cxg - cx) / w[regr_idx].astype(float)
+        ty = (cyg - cy) / h[regr_idx].astype(float)
+        tw = np.log((gt[:, 1] - gt[:, 0]) / w[regr_idx].astype(float))
+        th = np.log((gt[:, 3] - gt[:, 2]) / h[regr_idx].astype(float))
 
+        sx, sy, sw, sh = C.classifier_regr_std
+        label_pos = 4 * class_num[regr_idx]
+        for i, t in enumerate([sx * tx, sy * ty, sw * tw, sh * th]):
+            y_class_regr_coords[regr_idx, label_pos + i] = t
+            y_class_regr_label[regr_idx, label_pos + i] = 1
 
+    Y2 = np.concatenate([y_class_regr_label, y_class_regr_coords], axis=1)
 
-def rpn_to_roi(rpn_layer, regr_layer, C, dim_ordering, use_regr=True, max_boxes=300, overlap_thresh=0.9):
+    return np.expand_dims(X, axis=0), np.expand_dims(Y1, axis=0), np.expand_dims(Y2, axis=0), IoUs
+
+
+def rpn_to_roi(rpn_layer, regr_layer, C, dim_ordering, use_regr=True, max_boxes=300, overlap_thresh=0.9, mode='test'):
     """Convert rpn layer to roi bboxes
 
     Args: (num_anchors = 9)
@@ -1132,6 +2509,8 @@ def rpn_to_roi(rpn_layer, regr_layer, C, dim_ordering, use_regr=True, max_boxes=
         use_regr: Wether to use bboxes regression in rpn
         max_boxes: max bboxes number for non-max-suppression (NMS)
         overlap_thresh: If iou in NMS is larger than this threshold, drop the box
+        mode: 'train' or 'test'; selects the pre-NMS filtering settings of the config
+            (C.pre_nms_top_n_train/test and C.min_objectness_train/test)
 
     Returns:
         result: boxes from non-max-suppression (shape=(300, 4))
@@ -1139,66 +2518,39 @@ def rpn_to_roi(rpn_layer, regr_layer, C, dim_ordering, use_regr=True, max_boxes=
     """
     regr_layer = regr_layer / C.std_scaling
 
-    anchor_sizes = C.anchor_box_scales  # (3 in here)
-    anchor_ratios = C.anchor_box_ratios  # (3 in here)
-
     assert rpn_layer.shape[0] == 1
 
-    (rows, cols) = rpn_layer.shape[1:3]
-
-    curr_layer = 0
+    (rows, cols, num_anchors) = rpn_layer.shape[1:4]
 
     # A.shape = (4, feature_map.height, feature_map.width, num_anchors)
     # Might be (4, 18, 25, 9) if resized image is 400 width and 300
     # A is the coordinates for 9 anchors for every point in the feature map
     # => all 18x25x9=4050 anchors cooridnates
-    A = np.zeros((4, rpn_layer.shape[1], rpn_layer.shape[2], rpn_layer.shape[3]))
-
-    for anchor_size in anchor_sizes:
-        for anchor_ratio in anchor_ratios:
-            # anchor_x = (128 * 1) / 16 = 8  => width of current anchor
-            # anchor_y = (128 * 2) / 16 = 16 => height of current anchor
-            anchor_x = (anchor_size * anchor_ratio[0]) / C.rpn_stride
-            anchor_y = (anchor_size * anchor_ratio[1]) / C.rpn_stride
-
-            # curr_layer: 0~8 (9 anchors)
-            # the Kth anchor of all position in the feature map (9th in total)
-            regr = regr_layer[0, :, :, 4 * curr_layer:4 * curr_layer + 4]  # shape => (18, 25, 4)
-            regr = np.transpose(regr, (2, 0, 1))  # shape => (4, 18, 25)
-
-            # Create 18x25 mesh grid
-            # For every point in x, there are all the y points and vice versa
-            # X.shape = (18, 25)
-            # Y.shape = (18, 25)
-            X, Y = np.meshgrid(np.arange(cols), np.arange(rows))
-
-            # Calculate anchor position and size for each feature map point
-            A[0, :, :, curr_layer] = X - anchor_x / 2  # Top left x coordinate
-            A[1, :, :, curr_layer] = Y - anchor_y / 2  # Top left y coordinate
-            A[2, :, :, curr_layer] = anchor_x  # width of current anchor
-            A[3, :, :, curr_layer] = anchor_y  # height of current anchor
-
-            # Apply regression to x, y, w and h if there is rpn regression layer
-            if use_regr:
-                A[:, :, :, curr_layer] = apply_regr_np(A[:, :, :, curr_layer], regr)
-
-            # Avoid width and height exceeding 1
-            A[2, :, :, curr_layer] = np.maximum(1, A[2, :, :, curr_layer])
-            A[3, :, :, curr_layer] = np.maximum(1, A[3, :, :, curr_layer])
-
-            # Convert (x, y , w, h) to (x1, y1, x2, y2)
-            # x1, y1 is top left coordinate
-            # x2, y2 is bottom right coordinate
-            A[2, :, :, curr_layer] += A[0, :, :, curr_layer]
-            A[3, :, :, curr_layer] += A[1, :, :, curr_layer]
-
-            # Avoid bboxes drawn outside the feature map
-            A[0, :, :, curr_layer] = np.maximum(0, A[0, :, :, curr_layer])
-            A[1, :, :, curr_layer] = np.maximum(0, A[1, :, :, curr_layer])
-            A[2, :, :, curr_layer] = np.minimum(cols - 1, A[2, :, :, curr_layer])
-            A[3, :, :, curr_layer] = np.minimum(rows - 1, A[3, :, :, curr_layer])
-
-            curr_layer += 1
+    _, anchor_grid = anchor_grid_cache.get(C, rows, cols)
+    A = np.array(anchor_grid)
+
+    # Apply regression to x, y, w and h if there is rpn regression layer
+    if use_regr:
+        # the Kth anchor of all position in the feature map is regr_layer[0, :, :, 4 * K:4 * K + 4]
+        regr = np.reshape(regr_layer[0, :, :, :], (rows, cols, num_anchors, 4))
+        regr = np.transpose(regr, (3, 0, 1, 2))  # shape => (4, 18, 25, 9)
+        A = apply_regr_np(A, regr)
+
+    # Avoid width and height exceeding 1
+    A[2] = np.maximum(1, A[2])
+    A[3] = np.maximum(1, A[3])
+
+    # Convert (x, y , w, h) to (x1, y1, x2, y2)
+    # x1, y1 is top left coordinate
+    # x2, y2 is bottom right coordinate
+    A[2] += A[0]
+    A[3] += A[1]
+
+    # Avoid bboxes drawn outside the feature map
+    A[0] = np.maximum(0, A[0])
+    A[1] = np.maximum(0, A[1])
+    A[2] = np.minimum(cols - 1, A[2])
+    A[3] = np.minimum(rows - 1, A[3])
 
     all_boxes = np.reshape(A.transpose((0, 3, 1, 2)), (4, -1)).transpose((1, 0))  # shape=(4050, 4)
     all_probs = rpn_layer.transpose((0, 3, 1, 2)).reshape((-1))  # shape=(4050,)
@@ -1214,12 +2566,291 @@ def rpn_to_roi(rpn_layer, regr_layer, C, dim_ordering, use_regr=True, max_boxes=
     all_boxes = np.delete(all_boxes, idxs, 0)
     all_probs = np.delete(all_probs, idxs, 0)
 
-    # Apply non_max_suppression
+    # Drop the bboxes with a negligible objectness before the non_max_suppression
+    # (configs saved before these settings existed do not have them)
+    pre_nms_top_n = getattr(C, 'pre_nms_top_n_' + mode, None)
+    min_objectness = getattr(C, 'min_objectness_' + mode, 0.0)
+
+    if min_objectness > 0:
+        idxs = np.where(all_probs >= min_objectness)[0]
+        all_boxes = all_boxes[idxs]
+        all_probs = all_probs[idxs]
+
+    if len(all_boxes) == 0:
+        return np.zeros((0, 4), dtype=int)
+
+    # Apply non_max_suppression on the pre_nms_top_n bboxes with the highest objectness
     # Only extract the bboxes. Don't need rpn probs in the later process
-    result = non_max_suppression_fast(all_boxes, all_probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes)[0]
+    result = non_max_suppression(all_boxes, all_probs, overlap_thresh=overlap_thresh, max_boxes=max_boxes,
+                                 top_k=pre_nms_top_n)[0]
 
     return result
 
+
+'''
+    TensorFlow versions of rpn_to_roi, calc_iou and of the sampling of the rois of the classifier, run in the graph
+    of the fused training step (see frcnn_train.FusedTrainStep)
+'''
+
+
+def anchor_grid_tf(C, rows, cols):
+    """anchor_grid of AnchorGridCache.get for a feature map shape known in the graph
+
+    Returns:
+        anchor_grid: shape=(4, rows, cols, num_anchors), float64 (x,y,w,h) of the anchors on the feature map
+    """
+    anchor_x = tf.constant([(size * ratio[0]) / C.rpn_stride
+                            for size in C.anchor_box_scales for ratio in C.anchor_box_ratios], tf.float64)
+    anchor_y = tf.constant([(size * ratio[1]) / C.rpn_stride
+                            for size in C.anchor_box_scales for ratio in C.anchor_box_ratios], tf.float64)
+    shape = tf.stack([rows, cols, tf.size(anchor_x)])
+    X, Y = tf.meshgrid(tf.range(cols, dtype=tf.float64), tf.range(rows, dtype=tf.float64))
+    return tf.stack([
+        X[:, :, None] - anchor_x[None, None, :] / 2,
+        Y[:, :, None] - anchor_y[None, None, :] / 2,
+        tf.broadcast_to(anchor_x, shape),
+        tf.broadcast_to(anchor_y, shape)])
+
+
+def iou_tf(a, b):
+    """iou_np between two sets of boxes of shape (N, 4) and (M, 4) with ordering (x1,y1,x2,y2), shape=(N, M)"""
+    x = tf.maximum(a[:, None, 0], b[None, :, 0])
+    y = tf.maximum(a[:, None, 1], b[None, :, 1])
+    w = tf.minimum(a[:, None, 2], b[None, :, 2]) - x
+    h = tf.minimum(a[:, None, 3], b[None, :, 3]) - y
+    area_i = tf.where((w < 0) | (h < 0), tf.zeros_like(w), w * h)
+
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    area_u = area_a[:, None] + area_b[None, :] - area_i
+
+    overlaps = area_i / (area_u + 1e-6)
+
+    # invalid boxes have no overlap with anything
+    valid_a = (a[:, 0] < a[:, 2]) & (a[:, 1] < a[:, 3])
+    valid_b = (b[:, 0] < b[:, 2]) & (b[:, 1] < b[:, 3])
+    return tf.where(valid_a[:, None] & valid_b[None, :], overlaps, tf.zeros_like(overlaps))
+
+
+def rpn_to_roi_tf(rpn_cls, rpn_regr, C, max_boxes=300, overlap_thresh=0.9, mode='test'):
+    """rpn_to_roi (with use_regr=True) of one image in the graph
+
+    The proposals are decoded in float64 as in rpn_to_roi, the non-max-suppression is tf.image.non_max_suppression
+    (float32 IoU, ties of objectness may be broken in another order than non_max_suppression_pick).
+
+    Args:
+        rpn_cls: shape=(rows, cols, num_anchors) rpn classification of the image
+        rpn_regr: shape=(rows, cols, 4 * num_anchors) rpn regression of the image
+        C, max_boxes, overlap_thresh, mode: see rpn_to_roi
+
+    Returns:
+        boxes: shape=(n, 4) with n <= max_boxes, float64 (x1,y1,x2,y2) of the proposals on the feature map
+    """
+    (rows, cols, num_anchors) = tf.unstack(tf.shape(rpn_cls))
+    (x, y, w, h) = tf.unstack(anchor_grid_tf(C, rows, cols))
+
+    # regression of the Kth anchor of all position in the feature map: rpn_regr[:, :, 4 * K:4 * K + 4]
+    regr = tf.cast(tf.reshape(rpn_regr / C.std_scaling, (rows, cols, num_anchors, 4)), tf.float64)
+    (tx, ty, tw, th) = tf.unstack(regr, axis=-1)
+
+    # same transform as apply_regr_np
+    cx1 = tx * w + (x + w / 2.)
+    cy1 = ty * h + (y + h / 2.)
+    w1 = tf.exp(tw) * w
+    h1 = tf.exp(th) * h
+    x1 = tf.round(cx1 - w1 / 2.)
+    y1 = tf.round(cy1 - h1 / 2.)
+    w1 = tf.maximum(tf.round(w1), 1.)
+    h1 = tf.maximum(tf.round(h1), 1.)
+
+    # (x1, y1, x2, y2) kept inside the feature map, in the order of rpn_to_roi (anchor type, then y, then x)
+    boxes = tf.stack([tf.maximum(x1, 0.),
+                      tf.maximum(y1, 0.),
+                      tf.minimum(x1 + w1, tf.cast(cols - 1, tf.float64)),
+                      tf.minimum(y1 + h1, tf.cast(rows - 1, tf.float64))], axis=-1)
+    boxes = tf.reshape(tf.transpose(boxes, (2, 0, 1, 3)), (-1, 4))
+    probs = tf.reshape(tf.transpose(rpn_cls, (2, 0, 1)), (-1,))
+
+    # drop the illegal bboxes, and the bboxes with a negligible objectness
+    keep = (boxes[:, 0] - boxes[:, 2] < 0) & (boxes[:, 1] - boxes[:, 3] < 0)
+    min_objectness = getattr(C, 'min_objectness_' + mode, 0.0)
+    if min_objectness > 0:
+        keep &= probs >= min_objectness
+    boxes = tf.boolean_mask(boxes, keep)
+    probs = tf.boolean_mask(probs, keep)
+
+    # non_max_suppression on the pre_nms_top_n bboxes with the highest objectness
+    pre_nms_top_n = getattr(C, 'pre_nms_top_n_' + mode, None)
+    if pre_nms_top_n is not None:
+        (probs, top_k) = tf.math.top_k(probs, k=tf.minimum(pre_nms_top_n, tf.size(probs)))
+        boxes = tf.gather(boxes, top_k)
+
+    pick = tf.image.non_max_suppression(tf.cast(tf.gather(boxes, [1, 0, 3, 2], axis=1), tf.float32), probs,
+                                        max_boxes, iou_threshold=overlap_thresh)
+    return tf.gather(boxes, pick)
+
+
+def calc_iou_tf(R, gta, gt_classes, C, nb_classes):
+    """calc_iou of one image in the graph
+
+    Args:
+        R: shape=(n, 4) proposals of rpn_to_roi_tf
+        gta: shape=(num_bboxes, 4) float64 (x1,y1,x2,y2) of the GT bboxes on the feature map (see feature_map_gt_batch)
+        gt_classes: shape=(num_bboxes,) class numbers of the GT bboxes, -1 for the padding bboxes
+        C: config
+        nb_classes: number of classes, 'bg' being the last class
+
+    Returns:
+        X: shape=(m, 4) float64 (x,y,w,h) of the m proposals overlapping a GT bbox by C.classifier_min_overlap or more
+        Y1: shape=(m, nb_classes) one hot code of their classes
+        Y2: shape=(m, 8*(nb_classes-1)) labels and regression targets
+    """
+    # the padding bboxes never match a proposal
+    overlaps = tf.where(gt_classes[:, None] >= 0, iou_tf(gta, R), -tf.ones((), tf.float64))
+
+    # corresponding GT bbox with the largest iou, for the proposals overlapping a GT bbox enough
+    best_bbox = tf.argmax(overlaps, axis=0, output_type=tf.int32)
+    best_iou = tf.reduce_max(overlaps, axis=0)
+    keep = best_iou >= C.classifier_min_overlap
+    rois = tf.boolean_mask(R, keep)
+    best_bbox = tf.boolean_mask(best_bbox, keep)
+    best_iou = tf.boolean_mask(best_iou, keep)
+
+    (x1, y1, x2, y2) = tf.unstack(rois, axis=1)
+    w = x2 - x1
+    h = y2 - y1
+    X = tf.stack([x1, y1, w, h], axis=1)
+
+    # hard negative example under C.classifier_max_overlap, class of the best GT bbox otherwise
+    class_num = tf.where(best_iou >= C.classifier_max_overlap, tf.gather(gt_classes, best_bbox), nb_classes - 1)
+    Y1 = tf.one_hot(class_num, nb_classes, dtype=tf.float64)
+
+    (gx1, gy1, gx2, gy2) = tf.unstack(tf.gather(gta, best_bbox), axis=1)
+    (sx, sy, sw, sh) = C.classifier_regr_std
+    regr = tf.stack([sx * (((gx1 + gx2) / 2.0 - (x1 + w / 2.0)) / w),
+                     sy * (((gy1 + gy2) / 2.0 - (y1 + h / 2.0)) / h),
+                     sw * tf.math.log((gx2 - gx1) / w),
+                     sh * tf.math.log((gy2 - gy1) / h)], axis=1)
+
+    # the 4 targets of the class of every positive roi ('bg' is out of the one hot code, so the negatives have none)
+    labels = tf.repeat(tf.one_hot(class_num, nb_classes - 1, dtype=tf.float64), 4, axis=1)
+    coords = tf.where(labels > 0, tf.tile(regr, [1, nb_classes - 1]), tf.zeros_like(labels))
+    Y2 = tf.concat([labels, coords], axis=1)
+
+    return X, Y1, Y2
+
+
+def sample_rois_tf(Y1, num_rois):
+    """Balanced sampling of the rois of one image of frcnn_train.sample_rois in the graph
+
+    Up to num_rois // 2 positive rois (a positive roi one time in two with num_rois = 1) are drawn without
+    replacement, and the negative rois fill the rest, with replacement when there are not enough of them. Without
+    negative roi, where sample_rois raises, the positive rois fill the rest.
+
+    Args:
+        Y1: shape=(m, nb_classes) one hot code of the classes of the rois of calc_iou_tf, m > 0
+
+    Returns:
+        sel_samples: shape=(num_rois,) indices of the selected rois
+    """
+    is_neg = Y1[:, -1] > 0
+    pos_samples = tf.cast(tf.where(~is_neg)[:, 0], tf.int32)
+    neg_samples = tf.cast(tf.where(is_neg)[:, 0], tf.int32)
+    num_neg = tf.size(neg_samples)
+
+    if num_rois > 1:
+        max_pos = num_rois // 2
+    else:
+        max_pos = tf.random.uniform((), 0, 2, dtype=tf.int32)
+    max_pos = tf.where(num_neg > 0, max_pos, num_rois)
+    selected_pos_samples = tf.random.shuffle(pos_samples)[:max_pos]
+
+    num_fill = num_rois - tf.size(selected_pos_samples)
+    fill_samples = tf.cond(num_neg > 0, lambda: neg_samples, lambda: pos_samples)
+    num_samples = tf.size(fill_samples)
+    selected_fill_samples = tf.cond(
+        num_samples >= num_fill,
+        lambda: tf.random.shuffle(fill_samples)[:num_fill],
+        lambda: tf.gather(fill_samples, tf.random.uniform((num_fill,), 0, num_samples, dtype=tf.int32)))
+
+    return tf.concat([selected_pos_samples, selected_fill_samples], axis=0)
+
+
+def feature_map_gt_batch(img_datas, C, class_mapping):
+    """GT bboxes of a batch of images on the feature map, inputs of sample_batch_rois_tf
+
+    Args:
+        img_datas: augmented image data of the images of the batch
+        C: config
+        class_mapping: class name -> class number
+
+    Returns:
+        feature_sizes: shape=(batch_size, 2) int32 (rows, cols) of the feature maps of the images, without padding
+        gt_boxes: shape=(batch_size, max_bboxes, 4) float64 (x1,y1,x2,y2) of the GT bboxes on the feature map
+        gt_classes: shape=(batch_size, max_bboxes) int32 class numbers of the GT bboxes, -1 for the padding
+    """
+    max_bboxes = max([1] + [len(img_data['bboxes']) for img_data in img_datas])
+    feature_sizes = np.zeros((len(img_datas), 2), dtype=np.int32)
+    gt_boxes = np.zeros((len(img_datas), max_bboxes, 4))
+    gt_classes = np.full((len(img_datas), max_bboxes), -1, dtype=np.int32)
+
+    for i, img_data in enumerate(img_datas):
+        (resized_width, resized_height) = get_new_img_size(img_data['width'], img_data['height'], C.im_size)
+        (cols, rows) = get_img_output_length(resized_width, resized_height)
+        feature_sizes[i] = (rows, cols)
+
+        num_bboxes = len(img_data['bboxes'])
+        gt_boxes[i, :num_bboxes] = feature_map_gt_boxes(img_data, C)[:, (0, 2, 1, 3)]
+        gt_classes[i, :num_bboxes] = [class_mapping[bbox['class']] for bbox in img_data['bboxes']]
+
+    return feature_sizes, gt_boxes, gt_classes
+
+
+def sample_batch_rois_tf(rpn_cls, rpn_regr, feature_sizes, gt_boxes, gt_classes, C, nb_classes):
+    """frcnn_train.sample_batch_rois in the graph: rpn_to_roi_tf, calc_iou_tf and sample_rois_tf on every image
+
+    Args:
+        rpn_cls, rpn_regr: outputs of the rpn on the images of the batch
+        feature_sizes, gt_boxes, gt_classes: GT bboxes of the images, see feature_map_gt_batch
+        C: config
+        nb_classes: number of classes, 'bg' being the last class
+
+    Returns:
+        X2: shape=(n, num_rois, 4) rois of the n images of the batch with matching bboxes (n may be 0)
+        Y1: shape=(n, num_rois, nb_classes) one hot code of their classes
+        Y2: shape=(n, num_rois, 8*(nb_classes-1)) labels and regression targets
+        img_idx: shape=(n,) indices of the n images in the batch
+        num_pos: shape=(batch_size,) number of positive rois of every image before the sampling
+    """
+    def sample_image(inputs):
+        (cls, regr, feature_size, gta, classes) = inputs
+        # Keep the part of the outputs computed on the image, not on the padding
+        R = rpn_to_roi_tf(cls[:feature_size[0], :feature_size[1]], regr[:feature_size[0], :feature_size[1]], C,
+                          max_boxes=300, overlap_thresh=0.7, mode='train')
+        (X, Y1, Y2) = calc_iou_tf(R, gta, classes, C, nb_classes)
+        num_pos = tf.math.count_nonzero(Y1[:, -1] == 0, dtype=tf.int32)
+        has_rois = tf.shape(X)[0] > 0
+
+        def sample():
+            sel_samples = sample_rois_tf(Y1, C.num_rois)
+            return tf.gather(X, sel_samples), tf.gather(Y1, sel_samples), tf.gather(Y2, sel_samples)
+
+        def no_sample():
+            return (tf.zeros((C.num_rois, 4), tf.float64), tf.zeros((C.num_rois, nb_classes), tf.float64),
+                    tf.zeros((C.num_rois, 8 * (nb_classes - 1)), tf.float64))
+
+        (X, Y1, Y2) = tf.cond(has_rois, sample, no_sample)
+        return X, Y1, Y2, num_pos, has_rois
+
+    (X2, Y1, Y2, num_pos, has_rois) = tf.map_fn(
+        sample_image, (rpn_cls, rpn_regr, feature_sizes, gt_boxes, gt_classes),
+        fn_output_signature=(tf.float64, tf.float64, tf.float64, tf.int32, tf.bool))
+
+    img_idx = tf.cast(tf.where(has_rois)[:, 0], tf.int32)
+    (X2, Y1, Y2) = [K.cast(tf.gather(Y, img_idx), K.floatx()) for Y in [X2, Y1, Y2]]
+    return X2, Y1, Y2, img_idx, num_pos
+
+
 '''
     Functions related to training part
 '''
@@ -1293,7 +2924,8 @@ def class_loss_regr(num_classes):
 
 
 def class_loss_cls(y_true, y_pred):
-    return lambda_cls_class * K.mean(categorical_crossentropy(y_true[0, :, :], y_pred[0, :, :]))
+    # mean over the rois of all the images of the batch
+    return lambda_cls_class * K.mean(categorical_crossentropy(y_true, y_pred))
 
 
 
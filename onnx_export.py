@@ -0,0 +1,90 @@
+from libraries import *
+from detection_libraries import init_models, list_images, onnx_model_paths, parity_report
+
+
+def convert_model(model, path, opset=13):
+    """Convert a Keras model to ONNX with tf2onnx and save it
+
+    The batch size, the size of the images and the number of rois stay dynamic.
+
+    Args:
+        model: Keras model
+        path: path of the .onnx file
+        opset: ONNX opset of the converted model
+
+    Returns:
+        names of the inputs and of the outputs of the ONNX graph, in the order of the Keras model
+    """
+    import tf2onnx
+
+    input_signature = [tf.TensorSpec((None,) + tuple(model_input.shape[1:]), tf.float32, name=name)
+                       for model_input, name in zip(model.inputs, model.input_names)]
+    onnx_model, _ = tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=opset,
+                                               output_path=path)
+    return [x.name for x in onnx_model.graph.input], [x.name for x in onnx_model.graph.output]
+
+
+def export_onnx(opset=13):
+    """Export the RPN and the classifier of C.model_path to ONNX (see onnx_model_paths)"""
+    model_rpn, _, model_classifier = init_models(C)
+    rpn_path, classifier_path, metadata_path = onnx_model_paths(C.model_path)
+
+    names = {}
+    for key, model, path in [('rpn', model_rpn, rpn_path), ('classifier', model_classifier, classifier_path)]:
+        st = time.time()
+        names[key + '_inputs'], names[key + '_outputs'] = convert_model(model, path, opset)
+        print('{} written ({:.1f} MB) in {:.1f} s'.format(path, os.path.getsize(path) / 2 ** 20, time.time() - st))
+
+    with open(metadata_path, 'w') as f:
+        json.dump(dict(opset=opset, **names), f, indent=4)
+
+    K.clear_session()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Export a Faster R-CNN model to ONNX.')
+    parser.add_argument('--model_name', required=False,
+                        metavar="name_of_your_model", default='model',
+                        help='Name of the model being exported')
+    parser.add_argument('--opset', required=False, default=13,
+                        metavar="Integer",
+                        help='ONNX opset of the exported models')
+    parser.add_argument('--parity_images', required=False, default='./data',
+                        metavar="/path/to/images/",
+                        help='Directory of the images used for the parity report')
+    parser.add_argument('--parity_report', required=False, default="True",
+                        metavar="True/False",
+                        help="True to compare the detections of the ONNX and Keras models after the export")
+    parser.add_argument('--num_parity', required=False, default=20,
+                        metavar="Integer",
+                        help='Number of images of the parity report')
+    parser.add_argument('--bbox_threshold', required=False, default=0.611,
+                        metavar="Value from 0 to 1",
+                        help="Model probability threshold of the detections compared in the parity report")
+    parser.add_argument('--num_threads', required=False, default="None",
+                        metavar="Integer/None",
+                        help="Number of threads of the ONNX Runtime sessions (None for one per core)")
+    args = parser.parse_args()
+
+    num_threads = eval(args.num_threads)
+
+    config_output_filename = "./config/{}.pickle".format(args.model_name)
+
+    with open(config_output_filename, 'rb') as f_in:
+        C = pickle.load(f_in)
+
+    C.model_path = "./model/{}.hdf5".format(args.model_name)
+
+    export_onnx(int(args.opset))
+
+    if eval(args.parity_report):
+        random.seed(0)
+        report = parity_report(C, list_images(args.parity_images, int(args.num_parity)),
+                               float(args.bbox_threshold), 'onnx', num_threads)
+        report_path = os.path.splitext(C.model_path)[0] + '_onnx_parity.csv'
+        report.to_csv(report_path, index=0)
+        print('Parity report written to {}'.format(report_path))
@@ -36,6 +36,23 @@ if __name__ == "__main__":
     parser.add_argument('--fps', required=False, default=1,
                         metavar="integer",
                         help="Framerate of the camera")
+    parser.add_argument('--pre_nms_top_n', required=False, default="None",
+                        metavar="Integer/None",
+                        help="Number of rpn proposals with the highest objectness kept before the non-max-suppression "
+                             "(None to keep all of them)")
+    parser.add_argument('--min_objectness', required=False, default=0.0,
+                        metavar="Value from 0 to 1",
+                        help="Rpn proposals with a lower objectness are dropped before the non-max-suppression")
+    parser.add_argument('--backend', required=False, default="keras",
+                        metavar="keras/bundle/tflite/onnx",
+                        help="Runtime of the networks: keras, or the models exported by bundle_export.py (bundle), by "
+                             "tflite_export.py (tflite) or by onnx_export.py (onnx)")
+    parser.add_argument('--num_threads', required=False, default="None",
+                        metavar="Integer/None",
+                        help="Number of threads of the tflite and onnx backends (None for their default)")
+    parser.add_argument('--warm_up', required=False, default="True",
+                        metavar="True/False",
+                        help="True to run the detection once on a blank image when the model is loaded")
     args = parser.parse_args()
 
     use_gpu = eval(args.use_gpu)
@@ -46,8 +63,13 @@ if __name__ == "__main__":
 
     config_output_filename = "./config/{}.pickle".format(args.model_name)
 
-    with open(config_output_filename, 'rb') as f_in:
-        C = pickle.load(f_in)
+    if args.backend == "bundle":
+        # the config saved in the inference bundle
+        from detection_libraries import bundle_path, load_bundle_config
+        C = load_bundle_config(bundle_path("./model/{}.hdf5".format(args.model_name)))
+    else:
+        with open(config_output_filename, 'rb') as f_in:
+            C = pickle.load(f_in)
 
     C.show_images = eval(args.show_images)
 
@@ -57,6 +79,11 @@ if __name__ == "__main__":
     C.rot_90 = False
 
     C.model_path = "./model/{}.hdf5".format(args.model_name)  # UPDATE WEIGHTS PATH HERE !!!!!!!!
+    C.pre_nms_top_n_test = eval(args.pre_nms_top_n)
+    C.min_objectness_test = float(args.min_objectness)
+    C.backend = args.backend
+    C.num_threads = eval(args.num_threads)
+    C.warm_up = eval(args.warm_up)
 
 
     bbox_threshold = float(args.bbox_threshold)
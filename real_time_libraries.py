@@ -158,7 +158,7 @@ def run_detection(fps, resolution, alpha, min_area, crop_margin, use_motor, imag
 
 def run_demo(C, bbox_threshold):
     import numpy as np
-    from detection_libraries import init_models
+    from detection_libraries import Detector
     from detection_libraries import detect
     import imutils
     import time
@@ -169,7 +169,10 @@ def run_demo(C, bbox_threshold):
     # from picamera import PiCamera
 
     print("[INFO] loading model...")
-    model_rpn, class_mapping, model_classifier_only = init_models(C)
+    detector = Detector(C, backend=C.backend, num_threads=C.num_threads)
+    if C.warm_up:
+        detector.warm_up()
+    class_mapping = detector.class_mapping
     class_to_color = {class_mapping[v]: np.random.randint(0, 255, 3) for v in class_mapping}
     # initialize the video stream, allow the camera sensor to warmup,
     # and initialize the FPS counter
@@ -181,7 +184,7 @@ def run_demo(C, bbox_threshold):
         img = vs.read()
         imutils.resize(img, width=400)
 
-        detect(img, model_rpn, model_classifier_only, C, class_mapping, bbox_threshold, class_to_color)
+        detect(img, detector, bbox_threshold, class_to_color)
         cv2.imshow("Frame", img)
 
         key = cv2.waitKey(1000) & 0xFF
@@ -204,7 +207,7 @@ def run_processing(bbox_threshold, C, record_path, images_output_dir, use_gpu, f
 
     print("[INFO] processing_proc - initializing session...", flush=True)
     import numpy as np
-    from detection_libraries import init_models
+    from detection_libraries import Detector
     from detection_libraries import detect
     import csv
     import time
@@ -214,7 +217,10 @@ def run_processing(bbox_threshold, C, record_path, images_output_dir, use_gpu, f
     init_session(use_gpu)
     if C.verbose:
         print("[INFO] processing_proc - loading model...", flush=True)
-    model_rpn, class_mapping, model_classifier_only = init_models(C)
+    detector = Detector(C, backend=C.backend, num_threads=C.num_threads)
+    if C.warm_up:
+        detector.warm_up()
+    class_mapping = detector.class_mapping
     if C.verbose:
         print("[INFO] processing_proc - done loading model", flush=True)
     flag_queue.put("ready")
@@ -231,7 +237,7 @@ def run_processing(bbox_threshold, C, record_path, images_output_dir, use_gpu, f
         if C.verbose:
             print("[INFO] processing_proc - starting detection on a new image", flush=True)
             print("[INFO] processing_proc - number of frames waiting to be processed: {}".format(frame_queue.qsize()), flush=True)
-        all_dets = detect(img, model_rpn, model_classifier_only, C, class_mapping, bbox_threshold, class_to_color)
+        all_dets = detect(img, detector, bbox_threshold, class_to_color)
         if not len(all_dets) == 0:
             for detected_class, probability, ((x1, y1), (x2, y2)) in all_dets:
                 with open(record_path, 'a', newline='') as f:
@@ -0,0 +1,149 @@
+import ast
+import os
+
+import numpy as np
+import pandas as pd
+
+SPLITS = ('train', 'val', 'test')
+
+
+def save_split_manifest(path, train_imgs, val_imgs, test_imgs):
+    """Save the train/val/test split of a dataset in a split manifest (.npz)
+
+    The manifest is columnar: the images of the three splits one after another (train, then val, then test) with
+    their filepath, width and height, and the bboxes of all the images in one array, the bboxes of image i being
+    boxes[box_offsets[i]:box_offsets[i + 1]].
+
+    Args:
+        path: path of the manifest
+        train_imgs, val_imgs, test_imgs: list(filepath, width, height, list(bboxes)), as given by get_data
+    """
+    all_imgs = list(train_imgs) + list(val_imgs) + list(test_imgs)
+
+    classes = []
+    class_index = {}
+    box_offsets = np.zeros(len(all_imgs) + 1, dtype=np.int64)
+    boxes = []
+    box_classes = []
+    for i, img_data in enumerate(all_imgs):
+        for bbox in img_data['bboxes']:
+            if bbox['class'] not in class_index:
+                class_index[bbox['class']] = len(classes)
+                classes.append(bbox['class'])
+            box_classes.append(class_index[bbox['class']])
+            boxes.append((bbox['x1'], bbox['x2'], bbox['y1'], bbox['y2']))
+        box_offsets[i + 1] = len(boxes)
+
+    np.savez_compressed(path,
+                        split_offsets=np.cumsum([0, len(train_imgs), len(val_imgs), len(test_imgs)]),
+                        filepaths=np.array([img_data['filepath'] for img_data in all_imgs], dtype=str),
+                        widths=np.array([img_data['width'] for img_data in all_imgs], dtype=np.int32),
+                        heights=np.array([img_data['height'] for img_data in all_imgs], dtype=np.int32),
+                        box_offsets=box_offsets,
+                        boxes=np.array(boxes, dtype=np.int32).reshape(-1, 4),
+                        box_classes=np.array(box_classes, dtype=np.int32),
+                        classes=np.array(classes, dtype=str))
+
+
+class SplitManifest:
+    """Split manifest saved by save_split_manifest
+
+    The arrays are read from the file when first needed, and only the img_data of the requested split are built.
+    The file stays open until close() (or the end of a with block).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.load(path)
+        self.split_offsets = self.data['split_offsets']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return int(self.split_offsets[-1])
+
+    def split_range(self, split):
+        i = SPLITS.index(split)
+        return int(self.split_offsets[i]), int(self.split_offsets[i + 1])
+
+    def filepaths(self, split):
+        """Paths of the images of a split ('train', 'val' or 'test')"""
+        start, end = self.split_range(split)
+        return self.data['filepaths'][start:end].tolist()
+
+    def imgs(self, split):
+        """img_data of the images of a split ('train', 'val' or 'test'), as given by get_data"""
+        start, end = self.split_range(split)
+        filepaths = self.data['filepaths'][start:end].tolist()
+        widths = self.data['widths'][start:end].tolist()
+        heights = self.data['heights'][start:end].tolist()
+        box_offsets = self.data['box_offsets'][start:end + 1]
+        boxes = self.data['boxes'][box_offsets[0]:box_offsets[-1]].tolist()
+        box_classes = self.data['box_classes'][box_offsets[0]:box_offsets[-1]].tolist()
+        classes = self.data['classes'].tolist()
+
+        bboxes = [{'class': classes[c], 'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2}
+                  for c, (x1, x2, y1, y2) in zip(box_classes, boxes)]
+        box_offsets = (box_offsets - box_offsets[0]).tolist()
+        return [{'filepath': filepaths[i], 'width': widths[i], 'height': heights[i],
+                 'bboxes': bboxes[box_offsets[i]:box_offsets[i + 1]]} for i in range(len(filepaths))]
+
+
+def split_record_path(model_name):
+    """Path of the split of a model: ./config/<model> - imgs.npz, or the former ./config/<model> - imgs.csv when
+    only that one exists"""
+    path = "./config/{} - imgs.npz".format(model_name)
+    csv_path = "./config/{} - imgs.csv".format(model_name)
+    if not os.path.exists(path) and os.path.exists(csv_path):
+        return csv_path
+    return path
+
+
+def load_split_imgs(path, split):
+    """img_data of one split ('train', 'val' or 'test') of a split manifest, or of the last row of a former
+    '- imgs.csv' split record"""
+    if path.endswith('.csv'):
+        last_row = pd.read_csv(path).tail(1)
+        return ast.literal_eval(last_row[split].tolist()[0])
+    with SplitManifest(path) as manifest:
+        return manifest.imgs(split)
+
+
+def convert_split_csv(csv_path, path=None):
+    """Convert the last split of a '- imgs.csv' split record to a split manifest
+
+    Args:
+        csv_path: path of the .csv split record
+        path: path of the manifest (csv_path with the .npz extension by default)
+
+    Returns:
+        path of the manifest
+    """
+    if path is None:
+        path = os.path.splitext(csv_path)[0] + '.npz'
+    save_split_manifest(path, *[load_split_imgs(csv_path, split) for split in SPLITS])
+    return path
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Convert "- imgs.csv" split records to split manifests.')
+    parser.add_argument('split_img_files', nargs='+',
+                        metavar="path_to_split_image_file",
+                        help='Paths to the .csv files that contain the train/test/validation split of images')
+
+    args = parser.parse_args()
+
+    for csv_path in args.split_img_files:
+        print('{} -> {}'.format(csv_path, convert_split_csv(csv_path)))
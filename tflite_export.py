@@ -0,0 +1,120 @@
+from libraries import *
+from detection_libraries import init_models, list_images, parity_report, tflite_model_paths
+
+
+def load_rpn_input(filepath):
+    """Image formatted for the RPN model: shape=(1, height, width, 3)"""
+    X, _ = format_img(cv2.imread(filepath), C)
+    return np.transpose(X, (0, 2, 3, 1))
+
+
+def rpn_calibration_data(model_rpn, filepaths):
+    """Representative inputs of the RPN model for the int8 calibration"""
+    def dataset():
+        for filepath in filepaths:
+            yield {model_rpn.input_names[0]: load_rpn_input(filepath)}
+    return dataset
+
+
+def convert_model(model, quantization=None, representative_dataset=None):
+    """Convert a Keras model to TFLite
+
+    Args:
+        model: Keras model
+        quantization: None for a float32 model, 'int8' for an int8 post-training quantization: calibrated on
+            representative_dataset if given (the ops without int8 kernel, and the inputs and outputs, stay float32),
+            of the weights only otherwise (the activations are quantized on the fly by the int8 kernels)
+        representative_dataset: function returning a generator of the inputs of the model
+
+    Returns:
+        the TFLite flatbuffer
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if representative_dataset is not None:
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+                                                   tf.lite.OpsSet.TFLITE_BUILTINS]
+    elif quantization is not None:
+        print('Unknown quantization {}, exporting a float32 model'.format(quantization))
+    return converter.convert()
+
+
+def export_tflite(quantization=None, calibration_paths=()):
+    """Export the RPN and the classifier of C.model_path to TFLite (see tflite_model_paths)"""
+    model_rpn, _, model_classifier = init_models(C)
+    rpn_path, classifier_path, metadata_path = tflite_model_paths(C.model_path)
+
+    # the TFLite calibration does not support the loop of the roi pooling, so only the weights of the classifier
+    # are quantized (most of them are in its dense layers)
+    for model, path, dataset in [(model_rpn, rpn_path, rpn_calibration_data(model_rpn, calibration_paths)),
+                                 (model_classifier, classifier_path, None)]:
+        st = time.time()
+        tflite_model = convert_model(model, quantization, dataset)
+        with open(path, 'wb') as f:
+            f.write(tflite_model)
+        print('{} written ({:.1f} MB) in {:.1f} s'.format(path, len(tflite_model) / 2 ** 20, time.time() - st))
+
+    with open(metadata_path, 'w') as f:
+        json.dump({'quantization': quantization,
+                   'rpn_inputs': model_rpn.input_names, 'rpn_outputs': model_rpn.output_names,
+                   'classifier_inputs': model_classifier.input_names,
+                   'classifier_outputs': model_classifier.output_names}, f, indent=4)
+
+    K.clear_session()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Export a Faster R-CNN model to TFLite.')
+    parser.add_argument('--model_name', required=False,
+                        metavar="name_of_your_model", default='model',
+                        help='Name of the model being exported')
+    parser.add_argument('--quantization', required=False, default="None",
+                        metavar="None/int8",
+                        help="int8 for an int8 post-training quantization (RPN calibrated on --calibration_images, "
+                             "weights only for the classifier), None for a float32 model")
+    parser.add_argument('--calibration_images', required=False, default='./data',
+                        metavar="/path/to/images/",
+                        help='Directory of the images used for the int8 calibration and for the parity report')
+    parser.add_argument('--num_calibration', required=False, default=100,
+                        metavar="Integer",
+                        help='Number of images used for the int8 calibration')
+    parser.add_argument('--parity_report', required=False, default="True",
+                        metavar="True/False",
+                        help="True to compare the detections of the TFLite and Keras models after the export")
+    parser.add_argument('--num_parity', required=False, default=20,
+                        metavar="Integer",
+                        help='Number of images of the parity report')
+    parser.add_argument('--bbox_threshold', required=False, default=0.611,
+                        metavar="Value from 0 to 1",
+                        help="Model probability threshold of the detections compared in the parity report")
+    parser.add_argument('--num_threads', required=False, default="None",
+                        metavar="Integer/None",
+                        help="Number of threads of the TFLite interpreters (None for the TFLite default)")
+    args = parser.parse_args()
+
+    quantization = None if args.quantization == "None" else args.quantization
+    num_threads = eval(args.num_threads)
+
+    config_output_filename = "./config/{}.pickle".format(args.model_name)
+
+    with open(config_output_filename, 'rb') as f_in:
+        C = pickle.load(f_in)
+
+    C.model_path = "./model/{}.hdf5".format(args.model_name)
+
+    random.seed(0)
+    calibration_paths = list_images(args.calibration_images, int(args.num_calibration))
+    export_tflite(quantization, calibration_paths if quantization == 'int8' else ())
+
+    if eval(args.parity_report):
+        report = parity_report(C, list_images(args.calibration_images, int(args.num_parity)),
+                               float(args.bbox_threshold), 'tflite', num_threads)
+        report_path = os.path.splitext(C.model_path)[0] + '_tflite_parity.csv'
+        report.to_csv(report_path, index=0)
+        print('Parity report written to {}'.format(report_path))